@@ -1,5 +1,8 @@
 from accounts.models import UserProfile
+from accounts.services import UserService
 from django.contrib.auth.models import User
+from django.db.models import Q
+from friendships.services import FriendshipService
 from rest_framework import exceptions, serializers
 
 
@@ -13,30 +16,79 @@ class UserSerializer(serializers.ModelSerializer):
 class UserSerializerWithProfile(UserSerializer):
     nickname = serializers.CharField(source='profile.nickname')  # obj.profile.nickname
     avatar_url = serializers.SerializerMethodField()  # from get_avatar_url()
+    followers_count = serializers.SerializerMethodField()
+    followings_count = serializers.SerializerMethodField()
 
     def get_avatar_url(self, obj):
         if obj.profile.avatar:
             return obj.profile.avatar.url
         return None
 
+    def get_followers_count(self, obj):
+        # Redis 里的 counter，O(1)
+        return FriendshipService.get_follower_count(obj.id)
+
+    def get_followings_count(self, obj):
+        return FriendshipService.get_following_count(obj.id)
+
     class Meta:
         model = User
-        fields = ('id', 'username', 'nickname', 'avatar_url',)
+        fields = (
+            'id',
+            'username',
+            'nickname',
+            'avatar_url',
+            'followers_count',
+            'followings_count',
+        )
 
 
-class UserSerializerForTweet(UserSerializerWithProfile):
+avatar_storage = UserProfile._meta.get_field('avatar').storage
+
+
+class UserCardSerializer(serializers.BaseSerializer):
+    """
+    嵌套在 tweets / comments / friendships / likes 列表里的 user 不需要 counts
+    serialize 的对象是 user_id（也可以是 User），数据来自 memcached 里的 user card，
+    列表的 serializers 可以先用 prefetch 批量加载一整页的 cards 放进 context['user_cards']
+    """
+    def to_representation(self, instance):
+        user_id = instance.id if isinstance(instance, User) else instance
+        card = self.context.get('user_cards', {}).get(user_id)
+        if card is None:
+            card = UserService.get_user_card(user_id)
+        if card is None:
+            return None
+        avatar = card['avatar']
+        return {
+            'id': card['id'],
+            'username': card['username'],
+            'nickname': card['nickname'],
+            # storage 每次生成新的 url，S3 的签名链接不会过期
+            'avatar_url': avatar_storage.url(avatar) if avatar else None,
+        }
+
+    @classmethod
+    def prefetch(cls, user_ids, context):
+        cards = context.setdefault('user_cards', {})
+        cards.update(UserService.get_user_cards([
+            user_id for user_id in user_ids if user_id not in cards
+        ]))
+
+
+class UserSerializerForTweet(UserCardSerializer):
     pass
 
 
-class UserSerializerForComment(UserSerializerWithProfile):
+class UserSerializerForComment(UserCardSerializer):
     pass
 
 
-class UserSerializerForFriendship(UserSerializerWithProfile):
+class UserSerializerForFriendship(UserCardSerializer):
     pass
 
 
-class UserSerializerForLike(UserSerializerWithProfile):
+class UserSerializerForLike(UserCardSerializer):
     pass
 
 
@@ -61,11 +113,17 @@ class SignupSerializer(serializers.ModelSerializer):
         fields = ('username', 'email', 'password')
 
     def validate(self, attrs):
-        if User.objects.filter(username=attrs.get('username').lower()).exists():
+        username = attrs.get('username').lower()
+        email = attrs.get('email').lower()
+        # 1 次查询同时检查 username 和 email
+        occupied = list(User.objects.filter(
+            Q(username=username) | Q(email=email),
+        ).values_list('username', 'email')[:2])
+        if any(row[0] == username for row in occupied):
             raise exceptions.ValidationError({
                 'username': ['This username has been occupied.']
             })
-        if User.objects.filter(email=attrs.get('email').lower()).exists():
+        if occupied:
             raise exceptions.ValidationError({
                 'email': ['This email has been occupied.']
             })
@@ -81,6 +139,6 @@ class SignupSerializer(serializers.ModelSerializer):
             email=email,
             password=password,
         )
-        # Create UserProfile object
-        user.profile
+        # Create UserProfile object, 读 user.profile 的时候不会再创建
+        UserProfile.objects.create(user=user)
         return user
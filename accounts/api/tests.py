@@ -1,5 +1,7 @@
 from accounts.models import UserProfile
+from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
 from rest_framework import status
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
@@ -152,6 +154,43 @@ class AccountApiTests(TestCase):
         response = self.client.get(LOGIN_STATUS_URL)
         self.assertEqual(response.data['has_logged_in'], True)
 
+        # username and email are checked in a single query
+        client = APIClient()
+        with self.assertNumQueries(1):
+            response = client.post(SIGNUP_URL, {**data, 'email': 'other@jiuzhang.com'})
+        self.assertEqual(response.data['errors']['username'][0], 'This username has been occupied.')
+        response = client.post(SIGNUP_URL, {**data, 'username': 'another'})
+        self.assertEqual(response.data['errors']['email'][0], 'This email has been occupied.')
+
+    def test_login_queries_and_rehash(self):
+        # wrong password only looks up the user once
+        with self.assertNumQueries(1):
+            response = self.client.post(LOGIN_URL, {
+                'username': self.user.username,
+                'password': 'incorrect password',
+            })
+        self.assertEqual(response.status_code, 400)
+
+        # the password is rehashed with the new iterations on login
+        old_password = self.user.password
+        with override_settings(PASSWORD_HASH_ITERATIONS=1000):
+            response = self.client.post(LOGIN_URL, {
+                'username': self.user.username,
+                'password': 'correct password',
+            })
+        self.assertEqual(response.status_code, 200)
+        new_password = User.objects.get(id=self.user.id).password
+        self.assertNotEqual(new_password, old_password)
+        self.assertEqual(new_password.split('$')[:2], ['pbkdf2_sha256', '1000'])
+
+        # inactive users cannot log in
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        response = self.client.post(LOGIN_URL, {
+            'username': self.user.username,
+            'password': 'correct password',
+        })
+        self.assertEqual(response.status_code, 400)
+
 
 class UserProfileApiTests(TestCase):
     def setUp(self):
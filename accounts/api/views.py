@@ -9,16 +9,15 @@ from accounts.models import UserProfile
 from django.contrib.auth import (
     login as django_login,
     logout as django_logout,
-    authenticate as django_authenticate
 )
 from django.contrib.auth.models import User
 from django.utils.decorators import method_decorator
-from ratelimit.decorators import ratelimit
 from rest_framework import permissions, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.request import Request
 from rest_framework.response import Response
 from utils.permissions import IsObjectOwner
+from utils.ratelimit import ratelimit
 
 
 class UserViewSet(viewsets.ReadOnlyModelViewSet):
@@ -44,7 +43,7 @@ class AccountViewSet(viewsets.ViewSet):
     serializer_class = SignupSerializer
 
     @action(methods=["GET"], detail=False)
-    @method_decorator(ratelimit(key='ip', rate='3/s', method='GET', block=True))
+    @method_decorator(ratelimit(key='ip', rate='3/s', method='GET', block=True, local=True))
     def login_status(self, request: Request) -> Response:
         data = {
             'has_logged_in': request.user.is_authenticated,
@@ -74,13 +73,13 @@ class AccountViewSet(viewsets.ViewSet):
         return Response(data)
 
     @action(methods=['POST'], detail=False)
-    @method_decorator(ratelimit(key='ip', rate='3/s', method='POST', block=True))
+    @method_decorator(ratelimit(key='ip', rate='3/s', method='POST', block=True, local=True))
     def logout(self, request: Request) -> Response:
         django_logout(request)
         return Response({'success': True})
 
     @action(methods=['POST'], detail=False)
-    @method_decorator(ratelimit(key='ip', rate='3/s', method='POST', block=True))
+    @method_decorator(ratelimit(key='ip', rate='3/s', method='POST', block=True, local=True))
     def login(self, request: Request) -> Response:
         serializer = LoginSerializer(data=request.data)
         # validate request
@@ -94,16 +93,18 @@ class AccountViewSet(viewsets.ViewSet):
         # validate required fields
         username = serializer.validated_data.get('username')
         password = serializer.validated_data.get('password')
-        if not User.objects.filter(username=username).exists():
+        # 只查询 1 次 user，而不是 exists() 之后再由 django_authenticate 查询一次
+        user = User.objects.filter(username=username).first()
+        if user is None:
             return Response({
                 'success': False,
                 'message': 'Please check input',
                 'errors': {'username': ['User does not exist']},
             }, status=400)
 
-        # check password
-        user = django_authenticate(username=username, password=password)  # (request=request) works as well
-        if not user or user.is_anonymous:
+        # check password, 和 ModelBackend.authenticate 一样也要求 user.is_active
+        # hash 的参数过期的时候 check_password 会重新 hash 并保存 password
+        if not user.check_password(password) or not user.is_active:
             return Response({
                 'success': False,
                 'message': 'Username and password does not match.',
@@ -117,7 +118,7 @@ class AccountViewSet(viewsets.ViewSet):
         })
 
     @action(methods=['POST'], detail=False)
-    @method_decorator(ratelimit(key='ip', rate='3/s', method='POST', block=True))
+    @method_decorator(ratelimit(key='ip', rate='3/s', method='POST', block=True, local=True))
     def signup(self, request: Request) -> Response:
         serializer = SignupSerializer(data=request.data)
         # validate request
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+
+
+class ConfigurablePBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    和 Django 自带的 PBKDF2PasswordHasher 使用相同的 algorithm 名字，已有的 password hash 都可以直接验证
+    iterations 由 settings.PASSWORD_HASH_ITERATIONS 决定，修改之后 must_update 会返回 True，
+    用户下一次登陆的时候 check_password 会用新的 iterations 重新 hash 并保存（rehash-on-login）
+    """
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASH_ITERATIONS
@@ -3,3 +3,11 @@ def profile_changed(sender, instance, **kwargs):
     from accounts.services import UserService
     # 这里不是 id 而是 user_id，id 对应的是 profile，我们需要清除的是 user_id
     UserService.invalidate_profile(instance.user_id)
+
+
+def user_changed(sender, instance, **kwargs):
+    from accounts.services import UserService
+    from utils.listeners import invalidate_object_cache
+    invalidate_object_cache(sender, instance, **kwargs)
+    # username 改变之后 user card 也需要失效
+    UserService.invalidate_user_card(instance.id)
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, get_hasher, make_password
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Measure how many password checks (i.e. logins) per second a single core can do.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=5)
+        # 可以指定多个 iterations 做对比，默认使用 settings.PASSWORD_HASH_ITERATIONS
+        parser.add_argument('--iterations', type=int, action='append', dest='iterations_list')
+
+    def handle(self, *args, **options):
+        iterations_list = options['iterations_list'] or [settings.PASSWORD_HASH_ITERATIONS]
+        for iterations in iterations_list:
+            with override_settings(PASSWORD_HASH_ITERATIONS=iterations):
+                rate = self.benchmark(options['seconds'])
+            self.stdout.write('{} {} iterations: {:.1f} logins/sec per core'.format(
+                get_hasher().algorithm,
+                iterations,
+                rate,
+            ))
+
+    def benchmark(self, seconds):
+        encoded = make_password('benchmark password')
+        count = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            check_password('benchmark password', encoded)
+            count += 1
+        return count / (time.perf_counter() - start)
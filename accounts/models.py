@@ -1,8 +1,7 @@
-from accounts.listeners import profile_changed
+from accounts.listeners import profile_changed, user_changed
 from django.contrib.auth.models import User
 from django.db import models
 from django.db.models.signals import post_save, pre_delete
-from utils.listeners import invalidate_object_cache
 
 
 class UserProfile(models.Model):
@@ -23,7 +22,7 @@ class UserProfile(models.Model):
 
 # 定义一个 profile 的 property 方法，植入到 User 这个 model 里
 # 这样当我们通过 user 的一个实例化对象访问 profile 的时候，即 user_instance.profile
-# 就会在 UserProfile 中进行 get_or_create 来获得对应的 profile 的 object
+# 就会通过 cache 读到对应的 profile 的 object
 # 这种写法实际上是一个利用 Python 的灵活性进行 hack 的方法，这样会方便我们通过 user 快速
 # 访问到对应的 profile 信息。
 def get_profile(user: User):
@@ -32,9 +31,8 @@ def get_profile(user: User):
     # 如果多次对这个 object 调用，就不需要重复的查询数据库
     if hasattr(user, '_cached_user_profile'):
         return getattr(user, '_cached_user_profile')
-    # 这里用 get_or_create 是因为有可能某个 user 并没有 profile，所以 get 不到
-    # 对于这种 user，我们给它创建一个空 profile
-    # profile, _ = UserProfile.objects.get_or_create(user=user)
+    # profile 在 signup 的时候创建，这里只读不写，不再 get_or_create
+    # 没有 profile 的 user 拿到的是一个没有保存过的空 profile，save() 之后才会写入 db
     profile = UserService.get_profile_through_cache(user.id)
     # 使用 user 对象的属性进行 cache，避免多次调用同一个 user 的 profile 时对数据库重复查询
     setattr(user, '_cached_user_profile', profile)
@@ -53,8 +51,8 @@ def get_profile(user: User):
 User.profile = property(get_profile)
 
 # hook up with listeners to invalidate cache
-pre_delete.connect(invalidate_object_cache, sender=User)
-post_save.connect(invalidate_object_cache, sender=User)
+pre_delete.connect(user_changed, sender=User)
+post_save.connect(user_changed, sender=User)
 
 pre_delete.connect(profile_changed, sender=UserProfile)
 post_save.connect(profile_changed, sender=UserProfile)
@@ -1,7 +1,8 @@
 from accounts.models import UserProfile
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.core.cache import caches
-from twitter.cache import USER_PROFILE_PATTERN
+from twitter.cache import USER_CARD_PATTERN, USER_PROFILE_PATTERN
 
 cache = caches['testing'] if getattr(settings, 'TESTING', False) else caches['default']
 
@@ -9,21 +10,91 @@ cache = caches['testing'] if getattr(settings, 'TESTING', False) else caches['de
 class UserService:
     @classmethod
     def get_profile_through_cache(cls, user_id):
-        key = USER_PROFILE_PATTERN.format(user_id=user_id)
+        return cls.get_profiles_many([user_id])[int(user_id)]
+
+    @classmethod
+    def get_profiles_many(cls, user_ids):
+        """
+        返回 {user_id: profile}，1 次 get_many + 1 次 filter(user_id__in=...)
+        读的路径上不会 get_or_create，profile 在 signup 的时候就已经创建好了。
+        没有 profile 的 user 返回一个没有保存过的空 profile（pk is None），并且同样放进 cache，
+        避免每次都去 db 确认一遍。profile 被创建之后 profile_changed 会清掉这个 negative cache
+        """
+        user_ids = list({int(user_id) for user_id in user_ids})
+        keys = {user_id: USER_PROFILE_PATTERN.format(user_id=user_id) for user_id in user_ids}
+        cached = cache.get_many(list(keys.values()))
+        profiles = {
+            user_id: cached[key]
+            for user_id, key in keys.items()
+            if key in cached
+        }
+
+        missed_ids = [user_id for user_id in user_ids if user_id not in profiles]
+        if not missed_ids:
+            return profiles
+        missed_profiles = {
+            profile.user_id: profile
+            for profile in UserProfile.objects.using('default').filter(user_id__in=missed_ids)
+        }
+        for user_id in missed_ids:
+            missed_profiles.setdefault(user_id, UserProfile(user_id=user_id))
+        cache.set_many({keys[user_id]: profile for user_id, profile in missed_profiles.items()})
+        profiles.update(missed_profiles)
+        return profiles
+
+    @classmethod
+    def get_user_card(cls, user_id):
+        return cls.get_user_cards([user_id]).get(int(user_id))
+
+    @classmethod
+    def get_user_cards(cls, user_ids):
+        """
+        嵌套在 tweets / comments / friendships / likes 里的 user 只需要 id, username, nickname
+        和 avatar。这几个字段单独作为一个很小的 user card 放在 memcached 里，
+        而不是分别读 pickle 之后的整个 User（包括 password hash）和 UserProfile
+        返回 {user_id: card}，1 次 get_many，cache miss 的 users 用 1 次 LEFT JOIN 查询
+        不存在的 users 不会出现在返回值里
+        """
+        user_ids = list({int(user_id) for user_id in user_ids if user_id is not None})
+        keys = {user_id: USER_CARD_PATTERN.format(user_id=user_id) for user_id in user_ids}
+        cached = cache.get_many(list(keys.values()))
+        cards = {
+            user_id: cached[key]
+            for user_id, key in keys.items()
+            if key in cached
+        }
 
-        # read from cache first
-        profile = cache.get(key)
-        # cache hit return
-        if profile is not None:
-            return profile
+        missed_ids = [user_id for user_id in user_ids if user_id not in cards]
+        if not missed_ids:
+            return cards
+        rows = User.objects.using('default').filter(id__in=missed_ids).values(
+            'id',
+            'username',
+            'userprofile__nickname',
+            'userprofile__avatar',
+        )
+        # avatar 只存文件名，url 在 serialize 的时候再生成。S3 的 url 是有时效的签名链接，
+        # 不能和 card 一起 cache 一整天
+        missed_cards = {
+            row['id']: {
+                'id': row['id'],
+                'username': row['username'],
+                'nickname': row['userprofile__nickname'],
+                'avatar': row['userprofile__avatar'] or None,
+            }
+            for row in rows
+        }
+        cache.set_many({keys[user_id]: card for user_id, card in missed_cards.items()})
+        cards.update(missed_cards)
+        return cards
 
-        # cache miss, read from db
-        # For a user without a profile, create am empty profile for it
-        profile, _ = UserProfile.objects.get_or_create(user_id=user_id)
-        cache.set(key, profile)
-        return profile
+    @classmethod
+    def invalidate_user_card(cls, user_id):
+        key = USER_CARD_PATTERN.format(user_id=user_id)
+        cache.delete(key)
 
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
         cache.delete(key)
+        cls.invalidate_user_card(user_id)
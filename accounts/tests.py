@@ -1,5 +1,12 @@
 from testing.testcases import TestCase
 from accounts.models import UserProfile
+from accounts.services import UserService
+from accounts.api.serializers import (
+    UserSerializerForTweet,
+    UserSerializerWithProfile,
+    avatar_storage,
+)
+from unittest import mock
 
 
 class UserProfileTests(TestCase):
@@ -11,4 +18,74 @@ class UserProfileTests(TestCase):
         self.assertEqual(UserProfile.objects.count(), 0)
         ann_profile = ann.profile
         self.assertEqual(isinstance(ann_profile, UserProfile), True)
+        # reading the profile never creates it
+        self.assertEqual(ann_profile.pk, None)
+        self.assertEqual(UserProfile.objects.count(), 0)
+        ann_profile.save()
         self.assertEqual(UserProfile.objects.count(), 1)
+
+    def test_get_profiles_many(self):
+        ann = self.create_user('ann')
+        bob = self.create_user('bob')
+        UserProfile.objects.create(user=ann, nickname='ann_nickname')
+
+        with self.assertNumQueries(1):
+            profiles = UserService.get_profiles_many([ann.id, bob.id])
+        self.assertEqual(profiles[ann.id].nickname, 'ann_nickname')
+        self.assertEqual(profiles[bob.id].pk, None)
+
+        # missing profiles are cached as well
+        with self.assertNumQueries(0):
+            profiles = UserService.get_profiles_many([ann.id, bob.id])
+        self.assertEqual(profiles[bob.id].pk, None)
+
+        # creating the profile invalidates the negative cache
+        UserProfile.objects.create(user=bob, nickname='bob_nickname')
+        self.assertEqual(UserService.get_profile_through_cache(bob.id).nickname, 'bob_nickname')
+
+    def test_user_serializer_with_profile(self):
+        ann = self.create_user('ann')
+        bob = self.create_user('bob')
+        self.create_friendship(ann, bob)
+        data = UserSerializerWithProfile(bob).data
+        self.assertEqual(data['followers_count'], 1)
+        self.assertEqual(data['followings_count'], 0)
+        # nested users don't carry the counts
+        self.assertEqual('followers_count' in UserSerializerForTweet(bob).data, False)
+
+    def test_get_user_cards(self):
+        ann = self.create_user('ann')
+        bob = self.create_user('bob')
+        UserProfile.objects.create(user=ann, nickname='ann_nickname')
+
+        # 1 LEFT JOIN query for users and profiles
+        with self.assertNumQueries(1):
+            cards = UserService.get_user_cards([ann.id, bob.id, -1])
+        self.assertEqual(cards, {
+            ann.id: {'id': ann.id, 'username': 'ann', 'nickname': 'ann_nickname', 'avatar': None},
+            bob.id: {'id': bob.id, 'username': 'bob', 'nickname': None, 'avatar': None},
+        })
+        with self.assertNumQueries(0):
+            self.assertEqual(UserService.get_user_card(ann.id)['nickname'], 'ann_nickname')
+
+        # profile and user changes invalidate the cards
+        profile = UserProfile.objects.get(user=ann)
+        profile.nickname = 'new_nickname'
+        profile.save()
+        bob.username = 'bobby'
+        bob.save()
+        cards = UserService.get_user_cards([ann.id, bob.id])
+        self.assertEqual(cards[ann.id]['nickname'], 'new_nickname')
+        self.assertEqual(cards[bob.id]['username'], 'bobby')
+        self.assertEqual(
+            UserSerializerForTweet(bob).data,
+            {'id': bob.id, 'username': 'bobby', 'nickname': None, 'avatar_url': None},
+        )
+
+        # the avatar url is generated on every serialization, not cached with the card
+        profile.avatar = 'avatars/ann.png'
+        profile.save()
+        self.assertEqual(UserService.get_user_card(ann.id)['avatar'], 'avatars/ann.png')
+        with mock.patch.object(avatar_storage, 'url', side_effect=['signed-url-1', 'signed-url-2']):
+            self.assertEqual(UserSerializerForTweet(ann.id).data['avatar_url'], 'signed-url-1')
+            self.assertEqual(UserSerializerForTweet(ann.id).data['avatar_url'], 'signed-url-2')
@@ -1,9 +1,23 @@
-from accounts.api.serializers import UserSerializerForComment
+from accounts.api.serializers import UserCardSerializer, UserSerializerForComment
 from comments.models import Comment
+from django.db import models
 from likes.services import LikeService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+
+
+class CommentListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        comments = list(data.all() if isinstance(data, models.Manager) else data)
+        UserCardSerializer.prefetch([comment.user_id for comment in comments], self.context)
+        self.context['comment_counts'] = RedisHelper.get_counts(comments, ['likes_count'])
+        self.context['comment_has_liked'] = LikeService.has_liked_many(
+            self.context['request'].user,
+            comments,
+        )
+        return super(CommentListSerializer, self).to_representation(comments)
 
 
 class CommentSerializer(serializers.ModelSerializer):
@@ -14,7 +28,8 @@ class CommentSerializer(serializers.ModelSerializer):
     #         ...
     #     }
     # }
-    user = UserSerializerForComment()
+    # 使用 memcached 里的 user card，cache 里的 comments 也不会因为 user 去访问 db
+    user = UserSerializerForComment(source='user_id')
     has_liked = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
 
@@ -29,12 +44,20 @@ class CommentSerializer(serializers.ModelSerializer):
             'likes_count',
             'has_liked',
         )
+        list_serializer_class = CommentListSerializer
 
     def get_has_liked(self, obj):
+        has_liked = self.context.get('comment_has_liked', {}).get(obj.id)
+        if has_liked is not None:
+            return has_liked
         return LikeService.has_liked(self.context['request'].user, obj)
 
     def get_likes_count(self, obj):
-        return obj.like_set.count()
+        # 用 de-normalized 的 likes_count 代替 obj.like_set.count()
+        counts = self.context.get('comment_counts', {}).get(obj.id)
+        if counts is not None:
+            return counts['likes_count']
+        return RedisHelper.get_count(obj, 'likes_count')
 
 
 class CommentSerializerForCreate(serializers.ModelSerializer):
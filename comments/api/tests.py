@@ -3,6 +3,7 @@ from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from utils.paginations import EndlessPagination
 
 COMMENT_URL = '/api/comments/'
 TWEET_LIST_API = '/api/tweets/'
@@ -114,25 +115,70 @@ class CommentApiTests(TestCase):
             'tweet_id': self.tweet.id,
         })
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data['comments']), 0)
+        self.assertEqual(len(response.data['results']), 0)
+        self.assertEqual(response.data['has_next_page'], False)
 
-        # 评论按照时间顺序排序
+        # 评论按照时间倒序排序
         self.create_comment(self.ann, self.tweet, '1')
         self.create_comment(self.bob, self.tweet, '2')
         self.create_comment(self.bob, self.create_tweet(self.bob), '3')
         response = self.anonymous_client.get(COMMENT_URL, {
             'tweet_id': self.tweet.id,
         })
-        self.assertEqual(len(response.data['comments']), 2)
-        self.assertEqual(response.data['comments'][0]['content'], '1')
-        self.assertEqual(response.data['comments'][1]['content'], '2')
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(response.data['results'][0]['content'], '2')
+        self.assertEqual(response.data['results'][1]['content'], '1')
 
         # 同时踢动 user_id 和 tweet_id 只有 tweet_id 会在 filter 中生效
         response = self.anonymous_client.get(COMMENT_URL, {
             'tweet_id': self.tweet.id,
             'user_id': self.ann.id,
         })
-        self.assertEqual(len(response.data['comments']), 2)
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_list_pagination(self):
+        page_size = EndlessPagination.page_size
+        comments = [
+            self.create_comment(self.bob, self.tweet, 'comment {}'.format(i))
+            for i in range(page_size * 2)
+        ]
+        comments = comments[::-1]
+
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['results']],
+            [comment.id for comment in comments[:page_size]],
+        )
+
+        # pull the second page
+        response = self.anonymous_client.get(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+            'created_at__lt': comments[page_size - 1].created_at,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [comment['id'] for comment in response.data['results']],
+            [comment.id for comment in comments[page_size:]],
+        )
+
+        # pull latest comments
+        new_comment = self.create_comment(self.ann, self.tweet, 'new comment')
+        response = self.anonymous_client.get(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+            'created_at__gt': comments[0].created_at,
+        })
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['id'], new_comment.id)
+
+        # updated and deleted comments are not served from a stale cache
+        url = '{}{}/'.format(COMMENT_URL, new_comment.id)
+        self.ann_client.put(url, {'content': 'updated'})
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['results'][0]['content'], 'updated')
+        self.ann_client.delete(url)
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['results'][0]['id'], comments[0].id)
 
     def test_comment_count(self):
         # test tweet detail API
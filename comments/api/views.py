@@ -4,14 +4,17 @@ from comments.api.serializers import (
     CommentSerializerForUpdate,
 )
 from comments.models import Comment
+from comments.services import CommentService
 from django.utils.decorators import method_decorator
 from inbox.services import NotificationService
-from ratelimit.decorators import ratelimit
 from rest_framework import viewsets, status
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
-from utils.decorators import required_params
+from twitter.cache import TWEET_COMMENTS_PATTERN
+from utils.decorators import read_from_replica, required_params
+from utils.paginations import EndlessPagination
 from utils.permissions import IsObjectOwner
+from utils.ratelimit import ratelimit
 
 
 class CommentViewSet(viewsets.GenericViewSet):
@@ -19,6 +22,7 @@ class CommentViewSet(viewsets.GenericViewSet):
     # 不实现 retrieve （查询单个comment） 的方法，因为没有这个需求
     serializer_class = CommentSerializerForCreate
     queryset = Comment.objects.all()
+    pagination_class = EndlessPagination
     # https://www.django-rest-framework.org/api-guide/filtering/
     # 这里表示可以用上面的 queryset 来 filter 'tweet_id'
     # 要得到 filter 之后的 queryset， 见 list()
@@ -26,6 +30,7 @@ class CommentViewSet(viewsets.GenericViewSet):
 
     @required_params(params=['tweet_id'])
     @method_decorator(ratelimit(key='user', rate='10/s', method='GET', block=True))
+    @read_from_replica
     def list(self, request, *args, **kwargs):
         # request.query_params['tweet_id'] -> GET /api/comments/?tweet_id=1 -> list
         # if 'tweet_id' not in request.query_params:
@@ -36,11 +41,21 @@ class CommentViewSet(viewsets.GenericViewSet):
         #         },
         #         status=status.HTTP_400_BAD_REQUEST,
         #     )
+        tweet_id = request.query_params['tweet_id']
+        # 先从 Redis 里取，cache 里没有的翻页再去 db 查询
+        cached_comments = CommentService.get_cached_comments(tweet_id)
         queryset = self.get_queryset()  # 取出本 class 的queryset
         # 根据 filterset_fields 里面指定的属性对 queryset 进行筛选
-        comments = self.filter_queryset(queryset).order_by('created_at')
+        # 这个 query 会使用 (tweet, created_at) 的索引
+        comments = self.filter_queryset(queryset)
+        page = self.paginator.paginate_cached_list(
+            cached_comments,
+            request,
+            queryset=comments,
+            cache_key=TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id),
+        )
         serializer = CommentSerializer(
-            comments,
+            page,
             context={'request': request},
             many=True,
         )
@@ -48,10 +63,7 @@ class CommentViewSet(viewsets.GenericViewSet):
         # tweet_id = request.query_params['tweet_id']
         # comments = Comment.objects.filter(tweet_id=tweet_id)
         # serializer = CommentSerializer(comments, many=True)
-        return Response(
-            {'comments': serializer.data},
-            status=status.HTTP_200_OK,
-        )
+        return self.get_paginated_response(serializer.data)
 
     def get_permissions(self):
         """
@@ -1,3 +1,4 @@
+from django.conf import settings
 from utils.listeners import invalidate_object_cache
 from utils.redis_helper import RedisHelper
 
@@ -9,6 +10,11 @@ def incr_comments_count(sender, instance, created, **kwargs):
     if not created:
         return
 
+    if settings.COUNTER_WRITE_BEHIND:
+        # 只写 Redis，由 comments.tasks.flush_comments_count_task 定期写回 MySQL
+        RedisHelper.incr_count_write_behind(Tweet, instance.tweet_id, 'comments_count')
+        return
+
     # handle new comment
     Tweet.objects.filter(id=instance.tweet_id).update(
         comments_count=F('comments_count') + 1
@@ -20,8 +26,32 @@ def decr_comments_count(sender, instance, **kwargs):
     from tweets.models import Tweet
     from django.db.models import F
 
+    if settings.COUNTER_WRITE_BEHIND:
+        RedisHelper.incr_count_write_behind(Tweet, instance.tweet_id, 'comments_count', -1)
+        return
+
     # handle comment deletion
     Tweet.objects.filter(id=instance.tweet_id).update(
         comments_count=F('comments_count') - 1
     )
     RedisHelper.decr_count(instance.tweet, 'comments_count')
+
+
+def push_comment_to_cache(sender, instance, created, **kwargs):
+    from comments.services import CommentService
+
+    if instance.tweet_id is None:
+        return
+    if created:
+        CommentService.push_comment_to_cache(instance)
+        return
+    # content 被修改了，cache 里的 comment 已经过期
+    CommentService.invalidate_comments_cache(instance.tweet_id)
+
+
+def invalidate_comments_cache(sender, instance, **kwargs):
+    from comments.services import CommentService
+
+    if instance.tweet_id is None:
+        return
+    CommentService.invalidate_comments_cache(instance.tweet_id)
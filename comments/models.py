@@ -1,8 +1,13 @@
-from comments.listeners import incr_comments_count, decr_comments_count
+from comments.listeners import (
+    decr_comments_count,
+    incr_comments_count,
+    invalidate_comments_cache,
+    push_comment_to_cache,
+)
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from likes.models import Like
 from tweets.models import Tweet
 from utils.memcached_helper import MemcachedHelper
@@ -46,3 +51,5 @@ class Comment(models.Model):
 
 post_save.connect(incr_comments_count, sender=Comment)
 pre_delete.connect(decr_comments_count, sender=Comment)
+post_save.connect(push_comment_to_cache, sender=Comment)
+post_delete.connect(invalidate_comments_cache, sender=Comment)
@@ -0,0 +1,26 @@
+from comments.models import Comment
+from twitter.cache import TWEET_COMMENTS_PATTERN
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+
+class CommentService(object):
+    @classmethod
+    def get_cached_comments(cls, tweet_id, limit=None):
+        # 使用 (tweet, created_at) 的索引，按时间倒序
+        queryset = Comment.objects.filter(tweet_id=tweet_id).order_by('-created_at', '-id')
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id)
+        return RedisHelper.load_objects(key, queryset, limit=limit)
+
+    @classmethod
+    def push_comment_to_cache(cls, comment):
+        queryset = Comment.objects.filter(tweet_id=comment.tweet_id).order_by('-created_at', '-id')
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=comment.tweet_id)
+        RedisHelper.push_object(key, comment, queryset)
+
+    # UPDATE & DELETE comment will call this method
+    @classmethod
+    def invalidate_comments_cache(cls, tweet_id):
+        # 修改和删除都比较少，直接删掉整个 list，下次读的时候重新加载
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id)
+        RedisClient.get_connection().delete(key)
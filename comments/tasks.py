@@ -0,0 +1,11 @@
+from celery import shared_task
+from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_comments_count_task():
+    # write-behind 模式下把 Redis 里累积的 comments_count 增量批量写回 MySQL
+    flushed_count = RedisHelper.flush_count_deltas(Tweet, 'comments_count')
+    return '{} comments_count flushed.'.format(flushed_count)
@@ -70,13 +70,15 @@ class HBaseModel:
         return value
 
     @classmethod
-    def serialize_row_key(cls, data):
+    def serialize_row_key(cls, data, is_prefix=False):
         """
         serialize dict to bytes (not str)
         {key1: val1} -> b"val1"
         {key1: val1, key2:val2} -> b"val1:val2"
         {key1: val1, key2:val2, key3:val3} -> b"val1:val2:val3"
         Note: ORDER MATTERS!
+        is_prefix=True 的时候允许只给出前面的几个 keys，用于 scan
+        {key1: val1} -> b"val1:"
         """
         field_hash = cls.get_field_hash()  # get all HBaseField fields from the model
         values = []
@@ -85,13 +87,28 @@ class HBaseModel:
                 continue
             value = data.get(key)
             if value is None:
-                raise BadRowKeyError(f"{key} is missing in row key")
+                if not is_prefix:
+                    raise BadRowKeyError(f"{key} is missing in row key")
+                # 以 ':' 结尾，避免 prefix 匹配到更长的 value
+                values.append('')
+                break
             value = cls.serialize_field(field, value)
             if ':' in value:
                 raise BadRowKeyError(f"{key} should not contain ':' in value: {value}")
             values.append(value)
         return bytes(':'.join(values), encoding='utf-8')
 
+    @classmethod
+    def serialize_row_key_from_tuple(cls, row_key_tuple):
+        # (val1, val2) -> {key1: val1, key2: val2} -> b"val1:val2"
+        if row_key_tuple is None:
+            return None
+        data = {
+            key: value
+            for key, value in zip(cls.Meta.row_key, row_key_tuple)
+        }
+        return cls.serialize_row_key(data, is_prefix=True)
+
     @classmethod
     def deserialize_row_key(cls, row_key):
         """
@@ -163,12 +180,20 @@ class HBaseModel:
         if cls.get_table_name() in tables:  # if the table exists, we don't duplicate it
             return
         column_families = {
-            field.column_family: dict()
+            field.column_family: cls.get_column_family_options()
             for key, field in cls.get_field_hash().items()
             if field.column_family is not None
         }
         conn.create_table(cls.get_table_name(), column_families)
 
+    @classmethod
+    def get_column_family_options(cls):
+        # Meta 里可以指定 ttl (in seconds)，过期的 cells 会被 HBase 自动删除
+        ttl = getattr(cls.Meta, 'ttl', None)
+        if ttl is None:
+            return dict()
+        return dict(time_to_live=ttl)
+
     @property
     def row_key(self):
         return self.serialize_row_key(self.__dict__)
@@ -202,3 +227,48 @@ class HBaseModel:
         table = cls.get_table()
         row = table.row(row_key)
         return cls.init_from_row(row_key, row)
+
+    def delete(self):
+        table = self.get_table()
+        table.delete(self.row_key)
+
+    @classmethod
+    def filter(cls, start=None, stop=None, prefix=None, limit=None, reverse=False):
+        """
+        scan 一段连续的 row keys，start / stop / prefix 都是 row key 的 tuple，可以只给出前缀部分
+        e.g. HBaseFollower.filter(prefix=(to_user_id,)) 取出 to_user_id 的所有 followers
+        reverse=True 的时候 start 要比 stop 大
+        """
+        row_start = cls.serialize_row_key_from_tuple(start)
+        row_stop = cls.serialize_row_key_from_tuple(stop)
+        row_prefix = cls.serialize_row_key_from_tuple(prefix)
+
+        table = cls.get_table()
+        # happybase 不允许 row_prefix 和 row_start / row_stop 同时使用
+        if row_prefix is not None:
+            rows = table.scan(row_prefix=row_prefix, limit=limit, reverse=reverse)
+        else:
+            rows = table.scan(row_start=row_start, row_stop=row_stop, limit=limit, reverse=reverse)
+        return [
+            cls.init_from_row(row_key, row_data)
+            for row_key, row_data in rows
+        ]
+
+    @classmethod
+    def batch_create(cls, instances, batch_size=1000):
+        # 用 batch 一次发送多个 puts，用于大量数据的写入，比如 backfill
+        table = cls.get_table()
+        with table.batch(batch_size=batch_size) as batch:
+            for instance in instances:
+                row_data = cls.serialize_row_data(instance.__dict__)
+                if len(row_data) == 0:
+                    raise EmptyColumnError()
+                batch.put(instance.row_key, row_data)
+        return instances
+
+    @classmethod
+    def batch_delete(cls, instances, batch_size=1000):
+        table = cls.get_table()
+        with table.batch(batch_size=batch_size) as batch:
+            for instance in instances:
+                batch.delete(instance.row_key)
@@ -1,22 +1,124 @@
-from rest_framework.pagination import PageNumberPagination
+from bisect import bisect_right
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
+from utils.paginations import decode_cursor, encode_cursor
+from utils.time_helpers import MAX_TIMESTAMP, datetime_to_timestamp, timestamp_to_datetime
 
 
-class FriendshipPagination(PageNumberPagination):
+class FriendshipPagination(BasePagination):
+    """
+    基于 (created_at, id) 的 cursor 翻页，替代 PageNumberPagination
+    - 不需要 SELECT COUNT(*)，total_results 由 view 从 Redis 里的 follower / following counter 提供
+    - 不使用 OFFSET，翻到再深的页面都只是一次 (to_user_id / from_user_id, created_at)
+      索引上的 range scan，InnoDB 的二级索引里自带主键 id，所以 id 作为第二排序字段也能用上索引
+    e.g. /api/friendships/3/followers/?cursor=xxx&size=20
+    """
     # default page size, i.g. no page size specified in url
     page_size = 20
-    # default page_size_query_param == None, forbidding client specify page size
     # if we enable page_size_query_param, clients can use `size=10` to fit
     # different use cases, e.g. requirements for page size of web/mobile are different
-    # e.g. /api/friendships/3/followers/?page=2&size=20
     page_size_query_param = 'size'
     max_page_size = 20
+    cursor_query_param = 'cursor'
+
+    def __init__(self):
+        super(FriendshipPagination, self).__init__()
+        self.has_next_page = False
+        self.next_cursor = None
+        self.total_results = None
+
+    def to_html(self):
+        pass
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def paginate_queryset(self, queryset, request, view=None, total_results=None):
+        # total_results: 可选的总数，由调用方从 cache 里的 counter 得到，不会去 COUNT
+        self.total_results = total_results
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            try:
+                created_at, object_id = decode_cursor(cursor)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=object_id),
+            )
+
+        # 多取 1 个用来判断是否还有下一页
+        page = list(queryset.order_by('-created_at', '-id')[:page_size + 1])
+        self.has_next_page = len(page) > page_size
+        page = page[:page_size]
+        if self.has_next_page:
+            self.next_cursor = encode_cursor(page[-1].created_at, page[-1].id)
+        return page
+
+    def paginate_hbase(self, hbase_model_class, row_key_prefix, request, total_results=None):
+        """
+        HBaseFollower / HBaseFollowing 的 row key 是 (user_id, created_at)，
+        在 row_key_prefix 范围内按 created_at 倒序 scan，cursor 里只有 created_at 是有意义的
+        """
+        self.total_results = total_results
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        start_timestamp = MAX_TIMESTAMP
+        if cursor:
+            try:
+                created_at, _ = decode_cursor(cursor)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+            # 同一个 user 下 created_at 是 row key 的一部分，不会重复，-1 之后就不包括 cursor 自己
+            start_timestamp = datetime_to_timestamp(created_at) - 1
+
+        page = hbase_model_class.filter(
+            start=(*row_key_prefix, start_timestamp),
+            stop=row_key_prefix,
+            limit=page_size + 1,
+            reverse=True,
+        )
+        self.has_next_page = len(page) > page_size
+        page = page[:page_size]
+        if self.has_next_page:
+            self.next_cursor = encode_cursor(timestamp_to_datetime(page[-1].created_at), 0)
+        return page
+
+    def paginate_ids(self, ids, request):
+        """
+        关系图求交集得到的 ids 是升序的 array，按 id 翻页，cursor 里只有 id 是有意义的
+        交集已经整个在内存里了，总数就是它的长度
+        """
+        self.total_results = len(ids)
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        start = 0
+        if cursor:
+            try:
+                _, last_id = decode_cursor(cursor)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+            start = bisect_right(ids, last_id)
+
+        page = list(ids[start:start + page_size + 1])
+        self.has_next_page = len(page) > page_size
+        page = page[:page_size]
+        if self.has_next_page:
+            self.next_cursor = encode_cursor(timestamp_to_datetime(0), page[-1])
+        return page
 
     def get_paginated_response(self, data):
         return Response({
-            'total_results': self.page.paginator.count,
-            'total_pages': self.page.paginator.num_pages,
-            'page_number': self.page.number,
-            'has_next_page': self.page.has_next(),
+            'total_results': self.total_results,
+            'has_next_page': self.has_next_page,
+            'next_cursor': self.next_cursor,
             'results': data,
         })
@@ -1,23 +1,50 @@
-from accounts.api.serializers import UserSerializerForFriendship
+from accounts.api.serializers import UserCardSerializer, UserSerializerForFriendship
 from django.contrib.auth.models import User
+from django.db import models
+from friendships.constants import BULK_FOLLOW_LIMIT
 from friendships.models import Friendship
 from friendships.services import FriendshipService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 
-class FollowingUserIdSetMixin:
-    @property
-    def following_user_id_set(self: serializers.ModelSerializer):
-        if self.context['request'].user.is_anonymous:
-            return {}
-        if hasattr(self, '_cached_following_user_id_set'):
-            return self._cached_following_user_id_set
-        user_id_set = FriendshipService.get_following_user_id_set(
-            self.context['request'].user.id,
+class FriendshipListSerializer(serializers.ListSerializer):
+    """
+    serialize 一整页 friendships 的时候：
+    - 用 1 次 get_many 批量加载这一页 users 的 user cards，而不是每一行访问 1 次 memcached
+    - 用 1 次 SMISMEMBER 判断当前登陆用户是否关注了这一页里的所有 users，
+      结果放在 context['has_followed'] 里
+    """
+    def to_representation(self, data):
+        friendships = list(data.all() if isinstance(data, models.Manager) else data)
+        UserCardSerializer.prefetch(
+            [self.child.get_user_id(friendship) for friendship in friendships],
+            self.context,
         )
-        setattr(self, '_cached_following_user_id_set', user_id_set)
-        return user_id_set
+
+        user = self.context['request'].user
+        if user.is_anonymous:
+            self.context['has_followed'] = {}
+        else:
+            self.context['has_followed'] = FriendshipService.has_followed_many(
+                user.id,
+                [self.child.get_user_id(friendship) for friendship in friendships],
+            )
+        return super(FriendshipListSerializer, self).to_representation(friendships)
+
+
+class HasFollowedMixin:
+    def get_has_followed(self: serializers.ModelSerializer, obj):
+        user = self.context['request'].user
+        if user.is_anonymous:
+            return False
+        user_id = self.get_user_id(obj)
+        if user_id is None:
+            return False
+        has_followed = self.context.get('has_followed', {}).get(user_id)
+        if has_followed is not None:
+            return has_followed
+        return FriendshipService.has_followed_many(user.id, [user_id])[user_id]
 
 
 class FriendshipSerializerForCreate(serializers.ModelSerializer):
@@ -51,42 +78,52 @@ class FriendshipSerializerForCreate(serializers.ModelSerializer):
         )
 
 
+class FriendshipSerializerForBulkCreate(serializers.Serializer):
+    # 不存在的 users 和已经关注了的 users 由 FriendshipService.bulk_follow 静默跳过
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=BULK_FOLLOW_LIMIT,
+    )
+
+
 # 可以通过 source=xxx 指定去访问每个 model instance 的 xxx 方法
 # 即 model_instance.xxx 来获得数据
 # 在这个例子中就是 Friendship.from_user
 # https://www.django-rest-framework.org/api-guide/serializers/#specifying-fields-explicitly
-class FollowerSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
-    user = UserSerializerForFriendship(source='cached_from_user')
+class FollowerSerializer(serializers.ModelSerializer, HasFollowedMixin):
+    user = UserSerializerForFriendship(source='from_user_id')
     created_at = serializers.DateTimeField()
     has_followed = serializers.SerializerMethodField()
 
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = FriendshipListSerializer
 
     """
     查询逻辑的变化
     before: 调用 FriendshipService.has_followed(from_user, to_user)
     这里的from_user -> self.context['request'].user, to_user -> obj.from_user
-    after: 查看当前登陆用户的 following_user_id_set 里面有没有当前被查看用户的某位好友
-    也就是 obj.from_user_id
+    after: 用 1 次 SMISMEMBER 查看这一页的 from_user_id 是否在当前登陆用户的 Redis followings set 里
     举例：我的id 9，我的关注列表 {1, 2, 3, 4, 5}，当前被查看用户(id = 10)的 followers {2, 4, 6, 8}
     before: 9 关注了 2 -> True, 9 关注了 4 -> True, 9 没关注 6 -> False, 9 没关注 8 -> False
-    after: 2 in {1, 2, 3, 4, 5} -> True, 4 in {1, 2, 3, 4, 5} -> True, 
-            6 in {1, 2, 3, 4, 5} -> False, 8 in {1, 2, 3, 4, 5} -> False, 
+    after: SMISMEMBER followings:9 2 4 6 8 -> [1, 1, 0, 0]
+    不需要把整个关注列表从 cache 里取出来
     """
-    def get_has_followed(self, obj):
-        return obj.from_user_id in self.following_user_id_set
+    def get_user_id(self, obj):
+        return obj.from_user_id
 
 
-class FollowingSerializer(serializers.ModelSerializer, FollowingUserIdSetMixin):
-    user = UserSerializerForFriendship(source='cached_to_user')
+class FollowingSerializer(serializers.ModelSerializer, HasFollowedMixin):
+    user = UserSerializerForFriendship(source='to_user_id')
     created_at = serializers.DateTimeField()
     has_followed = serializers.SerializerMethodField()
 
     class Meta:
         model = Friendship
         fields = ('user', 'created_at', 'has_followed')
+        list_serializer_class = FriendshipListSerializer
 
-    def get_has_followed(self, obj):
-        return obj.to_user_id in self.following_user_id_set
+    def get_user_id(self, obj):
+        return obj.to_user_id
@@ -1,18 +1,25 @@
 from friendships.api.paginations import FriendshipPagination
 from friendships.models import Friendship
+from friendships.services import FriendshipGraphService, FriendshipService
+from django.test import override_settings
 from rest_framework import status
 from testing.testcases import TestCase
+from unittest import mock
 
 
 FOLLOW_URL = '/api/friendships/{}/follow/'
 UNFOLLOW_URL = '/api/friendships/{}/unfollow/'
 FOLLOWERS_URL = '/api/friendships/{}/followers/'
 FOLLOWINGS_URL = '/api/friendships/{}/followings/'
+FOLLOWED_BY_FOLLOWINGS_URL = '/api/friendships/{}/followed_by_followings/'
+MUTUAL_FOLLOWS_URL = '/api/friendships/{}/mutual_follows/'
+BULK_FOLLOW_URL = '/api/friendships/bulk_follow/'
 
 
 class FriendshipApiTests(TestCase):
     def setUp(self) -> None:
-        self.clear_cache()
+        # test_followers_from_hbase 需要 HBase 的 tables
+        super(FriendshipApiTests, self).setUp()
         self.make_up_friendships()
         self.max_page_size = FriendshipPagination.max_page_size
         self.page_size = FriendshipPagination.page_size
@@ -135,18 +142,18 @@ class FriendshipApiTests(TestCase):
         self._test_friendship_pagination(url)
 
         # anonymous user can view however he can't follow
-        response = self.anonymous_client.get(url, {'page': 1})
+        response = self.anonymous_client.get(url)
         for result in response.data['results']:
             self.assertEqual(result['has_followed'], False)
 
         # Bob has followed users with even id
-        response = self.bob_client.get(url, {'page': 1})
+        response = self.bob_client.get(url)
         for result in response.data['results']:
             has_followed = result['user']['id'] % 2 == 0
             self.assertEqual(result['has_followed'], has_followed)
 
         # Ann has followed all her following users
-        response = self.ann_client.get(url, {'page': 1})
+        response = self.ann_client.get(url)
         for result in response.data['results']:
             self.assertEqual(result['has_followed'], True)
 
@@ -162,48 +169,231 @@ class FriendshipApiTests(TestCase):
         self._test_friendship_pagination(url)
 
         # anonymous user can view the list, however he can't follow anyone
-        response = self.anonymous_client.get(url, {'page': 1})
+        response = self.anonymous_client.get(url)
         for result in response.data['results']:
             self.assertEqual(result['has_followed'], False)
 
         # Bob has followed users with even id
-        response = self.bob_client.get(url, {'page': 1})
+        response = self.bob_client.get(url)
         for result in response.data['results']:
             has_followed = result['user']['id'] % 2 == 0
             self.assertEqual(result['has_followed'], has_followed)
 
 
     def _test_friendship_pagination(self, url):
-        response = self.anonymous_client.get(url, {'page': 1})
+        response = self.anonymous_client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['results']), self.page_size)
-        self.assertEqual(response.data['total_pages'], 2)
         self.assertEqual(response.data['total_results'], self.page_size * 2)
-        self.assertEqual(response.data['page_number'], 1)
         self.assertEqual(response.data['has_next_page'], True)
+        first_page = response.data['results']
 
-        response = self.anonymous_client.get(url, {'page': 2})
+        response = self.anonymous_client.get(url, {'cursor': response.data['next_cursor']})
         self.assertEqual(len(response.data['results']), self.page_size)
-        self.assertEqual(response.data['total_pages'], 2)
         self.assertEqual(response.data['total_results'], self.page_size * 2)
-        self.assertEqual(response.data['page_number'], 2)
         self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(response.data['next_cursor'], None)
+        second_page = response.data['results']
+        # 两页之间没有重复，并且按照时间倒序排列
+        user_ids = [result['user']['id'] for result in first_page + second_page]
+        self.assertEqual(len(set(user_ids)), self.page_size * 2)
+        created_ats = [result['created_at'] for result in first_page + second_page]
+        self.assertEqual(created_ats, sorted(created_ats, reverse=True))
 
-        response = self.anonymous_client.get(url, {'page': 3})
+        response = self.anonymous_client.get(url, {'cursor': 'invalid'})
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
         # test customized page_size cannot exceed max_page_size
-        response = self.anonymous_client.get(url, {'page': 1, 'size': self.max_page_size + 1})
+        response = self.anonymous_client.get(url, {'size': self.max_page_size + 1})
         self.assertEqual(len(response.data['results']), self.max_page_size)
-        self.assertEqual(response.data['total_pages'], 2)
         self.assertEqual(response.data['total_results'], self.page_size * 2)
-        self.assertEqual(response.data['page_number'], 1)
         self.assertEqual(response.data['has_next_page'], True)
 
         # test a valid customized page size
-        response = self.anonymous_client.get(url, {'page': 1, 'size': 2})
+        response = self.anonymous_client.get(url, {'size': 2})
         self.assertEqual(len(response.data['results']), 2)
-        self.assertEqual(response.data['total_pages'], self.page_size)
         self.assertEqual(response.data['total_results'], self.page_size * 2)
-        self.assertEqual(response.data['page_number'], 1)
         self.assertEqual(response.data['has_next_page'], True)
+
+    def test_pagination_with_same_created_at(self):
+        followers = [self.create_user(f'follower_{i}') for i in range(5)]
+        for follower in followers:
+            Friendship.objects.create(from_user=follower, to_user=self.ann)
+        # 所有的 friendships 都有同样的 created_at，cursor 依靠 id 区分
+        friendships = Friendship.objects.filter(to_user=self.ann)
+        friendships.update(created_at=friendships.first().created_at)
+
+        url = FOLLOWERS_URL.format(self.ann.id)
+        user_ids, cursor = [], None
+        while True:
+            params = {'size': 2}
+            if cursor:
+                params['cursor'] = cursor
+            response = self.anonymous_client.get(url, params)
+            user_ids += [result['user']['id'] for result in response.data['results']]
+            cursor = response.data['next_cursor']
+            if not response.data['has_next_page']:
+                break
+        expected_ids = Friendship.objects.filter(
+            to_user=self.ann,
+        ).order_by('-id').values_list('from_user_id', flat=True)
+        self.assertEqual(user_ids, list(expected_ids))
+
+    @override_settings(FRIENDSHIP_HBASE_DUAL_WRITE=True)
+    def test_followers_from_hbase(self):
+        followers = [self.create_user(f'follower_{i}') for i in range(5)]
+        for follower in followers:
+            Friendship.objects.create(from_user=follower, to_user=self.ann)
+        Friendship.objects.create(from_user=self.ann, to_user=followers[0])
+
+        url = FOLLOWERS_URL.format(self.ann.id)
+        with override_settings(FRIENDSHIP_READ_FROM_HBASE=True):
+            user_ids, cursor = [], None
+            while True:
+                params = {'size': 2}
+                if cursor:
+                    params['cursor'] = cursor
+                response = self.ann_client.get(url, params)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data['total_results'], 5)
+                user_ids += [result['user']['id'] for result in response.data['results']]
+                cursor = response.data['next_cursor']
+                if not response.data['has_next_page']:
+                    break
+            self.assertEqual(user_ids, [follower.id for follower in followers[::-1]])
+            self.assertEqual(response.data['results'][-1]['has_followed'], True)
+
+            response = self.anonymous_client.get(FOLLOWINGS_URL.format(self.ann.id))
+            self.assertEqual(len(response.data['results']), 1)
+            self.assertEqual(response.data['results'][0]['user']['id'], followers[0].id)
+
+    def test_followers_page_queries(self):
+        for i in range(self.page_size):
+            follower = self.create_user(f'follower_{i}')
+            Friendship.objects.create(from_user=follower, to_user=self.ann)
+        url = FOLLOWERS_URL.format(self.ann.id)
+        self.clear_cache()
+        # friendship counts (2) + friendships + user cards + followings set of bob,
+        # no matter how many rows in the page
+        with self.assertNumQueries(5):
+            response = self.bob_client.get(url)
+        self.assertEqual(len(response.data['results']), self.page_size)
+        # users and profiles (including missing ones) are cached now
+        with self.assertNumQueries(1):
+            self.bob_client.get(url)
+
+    def test_followed_by_followings_and_mutual_follows(self):
+        users = [self.create_user(f'user{i}') for i in range(3)]
+        for user in users:
+            Friendship.objects.create(from_user=self.bob, to_user=user)
+            Friendship.objects.create(from_user=user, to_user=self.bob)
+        for user in users[:2]:
+            Friendship.objects.create(from_user=user, to_user=self.ann)
+
+        url = FOLLOWED_BY_FOLLOWINGS_URL.format(self.ann.id)
+        # 需要登陆
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.status_code, 403)
+        response = self.bob_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_results'], 2)
+        self.assertEqual(
+            [user['id'] for user in response.data['results']],
+            [users[0].id, users[1].id],
+        )
+
+        response = self.anonymous_client.get(MUTUAL_FOLLOWS_URL.format(self.bob.id), {'size': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_results'], 3)
+        self.assertEqual(
+            [user['id'] for user in response.data['results']],
+            [users[0].id, users[1].id],
+        )
+        self.assertEqual(response.data['results'][0]['username'], 'user0')
+        self.assertEqual(response.data['has_next_page'], True)
+
+        # next page starts after the last id of the previous page
+        response = self.anonymous_client.get(MUTUAL_FOLLOWS_URL.format(self.bob.id), {
+            'size': 2,
+            'cursor': response.data['next_cursor'],
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['total_results'], 3)
+        self.assertEqual([user['id'] for user in response.data['results']], [users[2].id])
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(response.data['next_cursor'], None)
+
+        response = self.anonymous_client.get(MUTUAL_FOLLOWS_URL.format(self.bob.id), {'cursor': 'xxx'})
+        self.assertEqual(response.status_code, 404)
+        # non-numeric pk is a 404 instead of a 500
+        response = self.anonymous_client.get(MUTUAL_FOLLOWS_URL.format('abc'))
+        self.assertEqual(response.status_code, 404)
+        response = self.bob_client.get(FOLLOWED_BY_FOLLOWINGS_URL.format('abc'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_bulk_follow(self):
+        users = [self.create_user(f'suggested_{i}') for i in range(50)]
+        user_ids = [user.id for user in users]
+
+        # 需要登陆
+        response = self.anonymous_client.post(BULK_FOLLOW_URL, {'user_ids': user_ids}, format='json')
+        self.assertEqual(response.status_code, 403)
+        response = self.ann_client.post(BULK_FOLLOW_URL, {'user_ids': []}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.ann_client.post(BULK_FOLLOW_URL, {'user_ids': list(range(1, 200))}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        # ann already follows users[0], non-existing users and ann herself are skipped
+        Friendship.objects.create(from_user=self.ann, to_user=users[0])
+        self.assertEqual(FriendshipService.get_following_count(self.ann.id), 1)
+        self.assertEqual(FriendshipService.has_followed_many(self.ann.id, user_ids[:2]), {
+            user_ids[0]: True, user_ids[1]: False,
+        })
+        # validate users + existing friendships + bulk insert + inserted friendships
+        with self.assertNumQueries(4):
+            response = self.ann_client.post(
+                BULK_FOLLOW_URL,
+                {'user_ids': user_ids + [self.ann.id, 0x7fffffff]},
+                format='json',
+            )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['followed_user_ids'], user_ids[1:])
+        self.assertEqual(Friendship.objects.filter(from_user=self.ann).count(), 50)
+
+        # caches and counters are updated without reloading from db
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.get_following_count(self.ann.id), 50)
+            has_followed = FriendshipService.has_followed_many(self.ann.id, user_ids)
+        self.assertEqual(set(has_followed.values()), {True})
+        self.assertEqual(
+            list(FriendshipGraphService.get_followee_ids(self.ann.id)),
+            sorted(user_ids),
+        )
+
+        # follow them again, nothing happens
+        response = self.ann_client.post(BULK_FOLLOW_URL, {'user_ids': user_ids}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['followed_user_ids'], [])
+        self.assertEqual(FriendshipService.get_following_count(self.ann.id), 50)
+
+    def test_bulk_follow_with_concurrent_follow(self):
+        users = [self.create_user(f'suggested_{i}') for i in range(3)]
+        self.assertEqual(FriendshipService.get_follower_count(users[0].id), 0)
+        self.assertEqual(FriendshipService.get_following_count(self.ann.id), 0)
+        bulk_create = Friendship.objects.bulk_create
+
+        def follow_then_bulk_create(*args, **kwargs):
+            # a concurrent follow request inserts users[0] first
+            Friendship.objects.create(from_user=self.ann, to_user=users[0])
+            return bulk_create(*args, **kwargs)
+
+        with mock.patch.object(Friendship.objects, 'bulk_create', side_effect=follow_then_bulk_create):
+            friendships = FriendshipService.bulk_follow(self.ann.id, [user.id for user in users])
+        # only the inserted friendships are counted again
+        self.assertEqual([f.to_user_id for f in friendships], [users[1].id, users[2].id])
+        self.assertEqual(FriendshipService.get_follower_count(users[0].id), 1)
+        self.assertEqual(FriendshipService.get_following_count(self.ann.id), 3)
+        self.assertEqual(
+            list(FriendshipGraphService.get_followee_ids(self.ann.id)),
+            [user.id for user in users],
+        )
@@ -1,17 +1,25 @@
+from accounts.api.serializers import UserSerializerForFriendship
+from accounts.services import UserService
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.utils.decorators import method_decorator
 from friendships.api.paginations import FriendshipPagination
 from friendships.api.serializers import (
     FollowerSerializer,
     FollowingSerializer,
+    FriendshipSerializerForBulkCreate,
     FriendshipSerializerForCreate,
 )
+from friendships.hbase_models import HBaseFollower, HBaseFollowing
 from friendships.models import Friendship
-from ratelimit.decorators import ratelimit
+from friendships.services import FriendshipGraphService, FriendshipService
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
+from utils.decorators import read_from_replica
+from utils.ratelimit import ratelimit
 
 
 class FriendshipViewSet(viewsets.GenericViewSet):
@@ -28,24 +36,89 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     pagination_class = FriendshipPagination
 
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
-    @method_decorator(ratelimit(key='user_or_ip', rate='3/s', method='GET', block=True))
+    @method_decorator(ratelimit(key='user_or_ip', rate='3/s', method='GET', block=True, local=True))
+    @read_from_replica
     def followers(self, request, pk):
-        friendships = Friendship.objects.filter(to_user_id=pk).order_by('-created_at')
-        # 这里的 self.paginate_queryset() 先把 friendships 这个 queryset 传给
-        # GenericAPIView 的 paginate_queryset, 它会去调用 PageNumberPagination 下的
-        # paginate_queryset(queryset, request, self) 来返回请求页面的数据
-        page = self.paginate_queryset(friendships)
+        # 总数来自 Redis 里的 counter，不会对所有的 friendships 做 COUNT
+        total_results = FriendshipService.get_follower_count(pk)
+        if settings.FRIENDSHIP_READ_FROM_HBASE:
+            hbase_followers = self.paginator.paginate_hbase(
+                HBaseFollower,
+                (int(pk),),
+                request,
+                total_results=total_results,
+            )
+            page = FriendshipService.hbase_rows_to_friendships(hbase_followers)
+        else:
+            friendships = Friendship.objects.filter(to_user_id=pk)
+            # FriendshipPagination 按 (created_at, id) 的 cursor 翻页，使用 (to_user_id, created_at) 索引
+            page = self.paginator.paginate_queryset(
+                friendships,
+                request,
+                view=self,
+                total_results=total_results,
+            )
         serializer = FollowerSerializer(page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
 
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
-    @method_decorator(ratelimit(key='user_or_ip', rate='3/s', method='GET', block=True))
+    @method_decorator(ratelimit(key='user_or_ip', rate='3/s', method='GET', block=True, local=True))
+    @read_from_replica
     def followings(self, request, pk):
-        friendships = Friendship.objects.filter(from_user_id=pk).order_by('-created_at')
-        page = self.paginate_queryset(friendships)
+        total_results = FriendshipService.get_following_count(pk)
+        if settings.FRIENDSHIP_READ_FROM_HBASE:
+            hbase_followings = self.paginator.paginate_hbase(
+                HBaseFollowing,
+                (int(pk),),
+                request,
+                total_results=total_results,
+            )
+            page = FriendshipService.hbase_rows_to_friendships(hbase_followings)
+        else:
+            friendships = Friendship.objects.filter(from_user_id=pk)
+            page = self.paginator.paginate_queryset(
+                friendships,
+                request,
+                view=self,
+                total_results=total_results,
+            )
         serializer = FollowingSerializer(page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
 
+    @action(methods=['GET'], detail=True, permission_classes=[IsAuthenticated])
+    @method_decorator(ratelimit(key='user', rate='3/s', method='GET', block=True))
+    def followed_by_followings(self, request, pk):
+        # 我关注的人里面有哪些也关注了 pk，i.e. "Followed by xxx and 10 others you follow"
+        user_ids = FriendshipGraphService.get_followings_who_follow(
+            request.user.id,
+            self._parse_user_id(pk),
+        )
+        return self._graph_response(request, user_ids)
+
+    @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
+    @method_decorator(ratelimit(key='user_or_ip', rate='3/s', method='GET', block=True, local=True))
+    def mutual_follows(self, request, pk):
+        user_ids = FriendshipGraphService.get_mutual_follow_ids(self._parse_user_id(pk))
+        return self._graph_response(request, user_ids)
+
+    def _parse_user_id(self, pk):
+        # 这两个 actions 不会调用 get_object()，非数字的 pk 也当作 user 不存在
+        try:
+            return int(pk)
+        except ValueError:
+            raise NotFound('User not found')
+
+    def _graph_response(self, request, user_ids):
+        # 按 id cursor 翻页，总数是交集的大小
+        page_ids = self.paginator.paginate_ids(user_ids, request)
+        user_cards = UserService.get_user_cards(page_ids)
+        serializer = UserSerializerForFriendship(
+            [user_id for user_id in page_ids if user_id in user_cards],
+            many=True,
+            context={'user_cards': user_cards},
+        )
+        return self.get_paginated_response(serializer.data)
+
     # IsAuthenticated -> 如果没有登陆，会返回403 Forbidden
     @action(methods=['POST'], detail=True, permission_classes=[IsAuthenticated])
     @method_decorator(ratelimit(key='user', rate='10/s', method='POST', block=True))
@@ -86,6 +159,27 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             status=status.HTTP_201_CREATED,
         )
 
+    @action(methods=['POST'], detail=False, permission_classes=[IsAuthenticated])
+    @method_decorator(ratelimit(key='user', rate='1/s', method='POST', block=True))
+    def bulk_follow(self, request):
+        # POST /api/friendships/bulk_follow/ {"user_ids": [1, 2, 3]}
+        # 用于账号迁移和 onboarding，一次请求关注多个 users
+        serializer = FriendshipSerializerForBulkCreate(data=request.data)
+        if not serializer.is_valid():
+            return Response({
+                'success': False,
+                'errors': serializer.errors,
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        friendships = FriendshipService.bulk_follow(
+            request.user.id,
+            serializer.validated_data['user_ids'],
+        )
+        return Response({
+            'success': True,
+            'followed_user_ids': [friendship.to_user_id for friendship in friendships],
+        }, status=status.HTTP_201_CREATED)
+
     @action(methods=['POST'], detail=True, permission_classes=[IsAuthenticated])
     @method_decorator(ratelimit(key='user', rate='10/s', method='POST', block=True))
     def unfollow(self, request, pk):
@@ -0,0 +1,10 @@
+from django.conf import settings
+
+# 校准 follower / following counts 的时候，每个 GROUP BY 查询包含的 users 个数
+RECONCILE_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+# 关系图里每个 user 的 followee / follower ids 的增量超过这个数量之后合并进 Redis 里的 sorted array
+GRAPH_DELTA_COMPACT_SIZE = 100 if not settings.TESTING else 3
+
+# 一次 bulk follow 最多可以关注的 users 个数
+BULK_FOLLOW_LIMIT = 100
@@ -1,4 +1,18 @@
 def friendship_changed(sender, instance, **kwargs):
     # import inside function to avoid loop dependency
-    from friendships.services import FriendshipService
-    FriendshipService.invalidate_following_cache(instance.from_user_id)
+    from django.conf import settings
+    from friendships.services import FriendshipGraphService, FriendshipService
+
+    # post_save 会带上 created，pre_delete 没有
+    if 'created' not in kwargs:
+        FriendshipService.remove_from_following_cache(instance)
+        FriendshipService.incr_friendship_counts(instance, -1)
+        FriendshipGraphService.remove_friendship(instance)
+        if settings.FRIENDSHIP_HBASE_DUAL_WRITE:
+            FriendshipService.delete_from_hbase(instance)
+    elif kwargs['created']:
+        FriendshipService.add_to_following_cache(instance)
+        FriendshipService.incr_friendship_counts(instance, 1)
+        FriendshipGraphService.add_friendship(instance)
+        if settings.FRIENDSHIP_HBASE_DUAL_WRITE:
+            FriendshipService.save_to_hbase(instance)
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from friendships.hbase_models import HBaseFollower, HBaseFollowing
+from friendships.models import Friendship
+from friendships.services import FriendshipService
+
+
+class Command(BaseCommand):
+    help = 'Copy MySQL friendships into HBaseFollowing and HBaseFollower.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        # 中途失败的时候可以从上一次输出的 id 继续
+        parser.add_argument('--start-id', type=int, default=0)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = options['start_id']
+        total = 0
+        while True:
+            # 按主键 keyset 翻页，不使用 OFFSET
+            friendships = list(
+                Friendship.objects.filter(id__gt=last_id).order_by('id')[:batch_size]
+            )
+            if not friendships:
+                break
+            followings, followers = [], []
+            for friendship in friendships:
+                if friendship.from_user_id is None or friendship.to_user_id is None:
+                    continue
+                following, follower = FriendshipService.get_hbase_rows(friendship)
+                followings.append(following)
+                followers.append(follower)
+            # 写入是幂等的，重复执行只会覆盖相同的 row
+            HBaseFollowing.batch_create(followings, batch_size=batch_size)
+            HBaseFollower.batch_create(followers, batch_size=batch_size)
+
+            total += len(followings)
+            last_id = friendships[-1].id
+            self.stdout.write('{} friendships backfilled, last id {}'.format(total, last_id))
+        self.stdout.write(self.style.SUCCESS('Done, {} friendships backfilled.'.format(total)))
@@ -0,0 +1,93 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from friendships.hbase_models import HBaseFollower, HBaseFollowing
+from friendships.models import Friendship
+from friendships.services import FriendshipService
+from utils.time_helpers import datetime_to_timestamp
+
+
+class Command(BaseCommand):
+    help = 'Compare MySQL friendships with HBaseFollowing / HBaseFollower, optionally fix the differences.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, action='append', dest='user_ids')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--fix', action='store_true')
+
+    def handle(self, *args, **options):
+        self.fix = options['fix']
+        self.missing_count, self.extra_count = 0, 0
+        for user_id in self.iter_user_ids(options['user_ids'], options['batch_size']):
+            self.check(
+                HBaseFollower,
+                (user_id,),
+                Friendship.objects.filter(to_user_id=user_id),
+                'from_user_id',
+            )
+            self.check(
+                HBaseFollowing,
+                (user_id,),
+                Friendship.objects.filter(from_user_id=user_id),
+                'to_user_id',
+            )
+
+        message = '{} rows missing in HBase, {} extra rows in HBase.'.format(
+            self.missing_count,
+            self.extra_count,
+        )
+        if self.missing_count or self.extra_count:
+            if self.fix:
+                message += ' Fixed.'
+            self.stdout.write(self.style.WARNING(message))
+        else:
+            self.stdout.write(self.style.SUCCESS(message))
+
+    def iter_user_ids(self, user_ids, batch_size):
+        if user_ids:
+            yield from user_ids
+            return
+        last_id = 0
+        while True:
+            batch_ids = list(
+                User.objects.filter(id__gt=last_id).order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not batch_ids:
+                return
+            yield from batch_ids
+            last_id = batch_ids[-1]
+
+    def check(self, hbase_model_class, row_key_prefix, friendships, column_key):
+        # 用 (另一个 user 的 id, created_at) 作为比较的 key
+        friendships_by_key = {
+            (getattr(friendship, column_key), datetime_to_timestamp(friendship.created_at)): friendship
+            for friendship in friendships
+            if friendship.from_user_id is not None and friendship.to_user_id is not None
+        }
+        hbase_rows_by_key = {
+            (getattr(hbase_row, column_key), hbase_row.created_at): hbase_row
+            for hbase_row in hbase_model_class.filter(prefix=row_key_prefix)
+        }
+        missing_keys = friendships_by_key.keys() - hbase_rows_by_key.keys()
+        extra_keys = hbase_rows_by_key.keys() - friendships_by_key.keys()
+        self.missing_count += len(missing_keys)
+        self.extra_count += len(extra_keys)
+        for key in missing_keys:
+            self.stdout.write('{} missing in {}'.format(
+                friendships_by_key[key],
+                hbase_model_class.get_table_name(),
+            ))
+        for key in extra_keys:
+            self.stdout.write('{} extra in {}'.format(
+                hbase_rows_by_key[key].row_key,
+                hbase_model_class.get_table_name(),
+            ))
+        if not self.fix:
+            return
+
+        following_or_follower_index = 0 if hbase_model_class is HBaseFollowing else 1
+        hbase_model_class.batch_create([
+            FriendshipService.get_hbase_rows(friendships_by_key[key])[following_or_follower_index]
+            for key in missing_keys
+        ])
+        hbase_model_class.batch_delete([hbase_rows_by_key[key] for key in extra_keys])
@@ -2,7 +2,6 @@ from django.contrib.auth.models import User
 from django.db import models
 from django.db.models.signals import post_save, pre_delete
 from friendships.listeners import friendship_changed
-from utils.memcached_helper import MemcachedHelper
 
 
 class Friendship(models.Model):
@@ -38,14 +37,6 @@ class Friendship(models.Model):
     def __str__(self):
         return f'{self.from_user_id} followed {self.to_user_id}'
 
-    @property
-    def cached_from_user(self):
-        return MemcachedHelper.get_object_through_cache(User, self.from_user_id)
-
-    @property
-    def cached_to_user(self):
-        return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
-
 
 # hook up with listeners to invalidate cache
 pre_delete.connect(friendship_changed, sender=Friendship)
@@ -1,10 +1,23 @@
+from array import array
 from django.conf import settings
-from django.core.cache import caches
+from django.contrib.auth.models import User
+from django.db.models import Count
+from friendships.constants import GRAPH_DELTA_COMPACT_SIZE
+from friendships.hbase_models import HBaseFollower, HBaseFollowing
 from friendships.models import Friendship
-from twitter.cache import FOLLOWINGS_PATTERN
+from redis.exceptions import WatchError
+from twitter.cache import (
+    FOLLOWEE_IDS_PATTERN,
+    FOLLOWER_IDS_PATTERN,
+    FOLLOWERS_COUNT_PATTERN,
+    FOLLOWINGS_COUNT_PATTERN,
+    FOLLOWINGS_PATTERN,
+)
+from utils.redis_client import RedisClient
+from utils.time_helpers import datetime_to_timestamp, timestamp_to_datetime
 
-# cache = caches['testing'] if settings.TESTING else caches['default']
-cache = caches['testing'] if getattr(settings, 'TESTING', False) else caches['default']
+# followings set 里的特殊 member，表示 set 已经从 db 加载过了，user id 都是正整数，不会冲突
+LOADED_SENTINEL = 0
 
 
 class FriendshipService(object):
@@ -24,34 +37,412 @@ class FriendshipService(object):
 
     @classmethod
     def has_followed(cls, from_user, to_user):
-        return Friendship.objects.filter(
-            from_user=from_user,
-            to_user=to_user,
-        ).exists()
+        return cls.has_followed_many(from_user.id, [to_user.id])[to_user.id]
 
     @classmethod
     def get_follower_ids(cls, to_user_id):
+        if settings.FRIENDSHIP_READ_FROM_HBASE:
+            # 一次 prefix scan，row key 以 to_user_id 开头
+            followers = HBaseFollower.filter(prefix=(to_user_id,))
+            return [follower.from_user_id for follower in followers]
         friendships = Friendship.objects.filter(to_user_id=to_user_id)
         return [f.from_user_id for f in friendships]
 
+    @classmethod
+    def has_followed_many(cls, from_user_id, to_user_ids):
+        """
+        返回 {to_user_id: True / False}
+        只用 1 次 SMISMEMBER 判断一整页的 users，不需要把整个 followings set 取出来
+        """
+        to_user_ids = list({
+            int(to_user_id) for to_user_id in to_user_ids if to_user_id is not None
+        })
+        if not to_user_ids:
+            return {}
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        conn = RedisClient.get_connection()
+        loaded, *results = conn.execute_command(
+            'SMISMEMBER', key, LOADED_SENTINEL, *to_user_ids,
+        )
+        if not loaded:
+            cls._load_following_user_id_set(from_user_id)
+            results = conn.execute_command('SMISMEMBER', key, *to_user_ids)
+        return {
+            to_user_id: bool(result)
+            for to_user_id, result in zip(to_user_ids, results)
+        }
+
     @classmethod
     def get_following_user_id_set(cls, from_user_id):
         # followings:from_user_id
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        user_id_set = cache.get(key)
-        if user_id_set is not None:
-            return user_id_set
-
-        friendships = Friendship.objects.filter(from_user_id=from_user_id)
-        user_id_set = set([
-            fs.to_user_id for fs in friendships
-        ])
-        cache.set(key, user_id_set)
+        conn = RedisClient.get_connection()
+        if not conn.sismember(key, LOADED_SENTINEL):
+            return cls._load_following_user_id_set(from_user_id)
+        return {
+            int(user_id) for user_id in conn.smembers(key)
+        } - {LOADED_SENTINEL}
+
+    @classmethod
+    def _load_following_user_id_set(cls, from_user_id):
+        # set 之后会被增量更新，从 primary 读，replica 的延迟不会一直留在 set 里
+        user_id_set = set(Friendship.objects.using('default').filter(
+            from_user_id=from_user_id,
+        ).values_list('to_user_id', flat=True))
+        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        pipe = RedisClient.get_connection().pipeline()
+        # 加上 LOADED_SENTINEL，没有关注任何人的 user 也会有一个非空的 set
+        pipe.sadd(key, LOADED_SENTINEL, *user_id_set)
+        pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipe.execute()
         return user_id_set
 
-    # CREATE & DELETE friendship will call this method
+    # CREATE & DELETE friendship will call these methods
     @classmethod
-    def invalidate_following_cache(cls, from_user_id):
-        # followings:from_user_id
+    def add_to_following_cache(cls, friendship):
+        cls._update_following_cache(friendship, 'sadd')
+
+    @classmethod
+    def remove_from_following_cache(cls, friendship):
+        cls._update_following_cache(friendship, 'srem')
+
+    @classmethod
+    def _update_following_cache(cls, friendship, method):
+        if friendship.from_user_id is None or friendship.to_user_id is None:
+            return
+        cls._update_following_cache_many(friendship.from_user_id, [friendship.to_user_id], method)
+
+    @classmethod
+    def _update_following_cache_many(cls, from_user_id, to_user_ids, method):
+        # 增量更新，避免每次 follow / unfollow 之后都要重新加载整个 set
+        if not to_user_ids:
+            return
         key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        cache.delete(key)
+        conn = RedisClient.get_connection()
+        # set 不存在的时候不需要更新，下次读的时候会从 db 加载
+        if not conn.exists(key):
+            return
+        getattr(conn, method)(key, *to_user_ids)
+
+    @classmethod
+    def get_follower_count(cls, to_user_id):
+        return cls.get_friendship_counts([to_user_id])[int(to_user_id)]['followers_count']
+
+    @classmethod
+    def get_following_count(cls, from_user_id):
+        return cls.get_friendship_counts([from_user_id])[int(from_user_id)]['followings_count']
+
+    @classmethod
+    def get_friendship_counts(cls, user_ids):
+        """
+        返回 {user_id: {'followers_count': x, 'followings_count': y}}
+        counts 存在 Redis 里，由 friendship_changed listener 维护，1 次 MGET 取出
+        cache miss 的 users 用 GROUP BY 从 db 里 back-fill
+        """
+        user_ids = [int(user_id) for user_id in user_ids]
+        keys = []
+        for user_id in user_ids:
+            keys.append(FOLLOWERS_COUNT_PATTERN.format(user_id=user_id))
+            keys.append(FOLLOWINGS_COUNT_PATTERN.format(user_id=user_id))
+        conn = RedisClient.get_connection()
+        values = conn.mget(keys) if keys else []
+
+        counts, missed_ids = {}, []
+        for index, user_id in enumerate(user_ids):
+            followers_count, followings_count = values[index * 2: index * 2 + 2]
+            if followers_count is None or followings_count is None:
+                missed_ids.append(user_id)
+                continue
+            counts[user_id] = {
+                'followers_count': int(followers_count),
+                'followings_count': int(followings_count),
+            }
+        if missed_ids:
+            counts.update(cls.reconcile_friendship_counts(missed_ids))
+        return counts
+
+    @classmethod
+    def reconcile_friendship_counts(cls, user_ids):
+        # 用 db 里的值覆盖 Redis 里的 counts，用于 back-fill 和定期校准
+        # 之后的 INCR 都以这个值为基础，从 primary 读
+        followers_counts = dict(
+            Friendship.objects.using('default').filter(to_user_id__in=user_ids)
+            .values_list('to_user_id').annotate(count=Count('id')).order_by()
+        )
+        followings_counts = dict(
+            Friendship.objects.using('default').filter(from_user_id__in=user_ids)
+            .values_list('from_user_id').annotate(count=Count('id')).order_by()
+        )
+        counts = {}
+        pipe = RedisClient.get_connection().pipeline()
+        for user_id in user_ids:
+            counts[user_id] = {
+                'followers_count': followers_counts.get(user_id, 0),
+                'followings_count': followings_counts.get(user_id, 0),
+            }
+            pipe.set(
+                FOLLOWERS_COUNT_PATTERN.format(user_id=user_id),
+                counts[user_id]['followers_count'],
+                ex=settings.REDIS_KEY_EXPIRE_TIME,
+            )
+            pipe.set(
+                FOLLOWINGS_COUNT_PATTERN.format(user_id=user_id),
+                counts[user_id]['followings_count'],
+                ex=settings.REDIS_KEY_EXPIRE_TIME,
+            )
+        pipe.execute()
+        return counts
+
+    # CREATE & DELETE friendship will call this method
+    @classmethod
+    def incr_friendship_counts(cls, friendship, delta):
+        cls.incr_friendship_counts_many([friendship], delta)
+
+    @classmethod
+    def incr_friendship_counts_many(cls, friendships, delta):
+        deltas = {}
+        for friendship in friendships:
+            for key in [
+                FOLLOWERS_COUNT_PATTERN.format(user_id=friendship.to_user_id),
+                FOLLOWINGS_COUNT_PATTERN.format(user_id=friendship.from_user_id),
+            ]:
+                deltas[key] = deltas.get(key, 0) + delta
+        if not deltas:
+            return
+        conn = RedisClient.get_connection()
+        keys = list(deltas.keys())
+        pipe = conn.pipeline()
+        for key in keys:
+            pipe.exists(key)
+        # key 不存在的时候不需要更新，下次读的时候会从 db back-fill
+        existing_keys = [key for key, exists in zip(keys, pipe.execute()) if exists]
+        if not existing_keys:
+            return
+        pipe = conn.pipeline()
+        for key in existing_keys:
+            pipe.incrby(key, deltas[key])
+        pipe.execute()
+
+    @classmethod
+    def get_hbase_rows(cls, friendship):
+        # 一个 Friendship 对应 HBaseFollowing 和 HBaseFollower 里各一行
+        created_at = datetime_to_timestamp(friendship.created_at)
+        following = HBaseFollowing(
+            from_user_id=friendship.from_user_id,
+            created_at=created_at,
+            to_user_id=friendship.to_user_id,
+        )
+        follower = HBaseFollower(
+            to_user_id=friendship.to_user_id,
+            created_at=created_at,
+            from_user_id=friendship.from_user_id,
+        )
+        return following, follower
+
+    # CREATE & DELETE friendship will call these methods when dual-write is on
+    @classmethod
+    def save_to_hbase(cls, friendship):
+        if friendship.from_user_id is None or friendship.to_user_id is None:
+            return
+        for hbase_row in cls.get_hbase_rows(friendship):
+            hbase_row.save()
+
+    @classmethod
+    def batch_save_to_hbase(cls, friendships):
+        # 两张表各一个 batch，而不是每条 friendship 2 次 put
+        hbase_rows = [cls.get_hbase_rows(friendship) for friendship in friendships]
+        HBaseFollowing.batch_create([following for following, _ in hbase_rows])
+        HBaseFollower.batch_create([follower for _, follower in hbase_rows])
+
+    @classmethod
+    def delete_from_hbase(cls, friendship):
+        if friendship.from_user_id is None or friendship.to_user_id is None:
+            return
+        for hbase_row in cls.get_hbase_rows(friendship):
+            hbase_row.delete()
+
+    @classmethod
+    def bulk_follow(cls, from_user_id, to_user_ids):
+        """
+        一次关注多个 users，用于账号迁移和新用户 onboarding 时关注推荐的账号
+        不存在的 users、自己、已经关注了的 users 会被跳过，返回新创建的 friendships
+        bulk_create 不会触发 post_save，所以这里批量完成 friendship_changed listener 的工作
+        """
+        to_user_ids = {int(to_user_id) for to_user_id in to_user_ids} - {int(from_user_id)}
+        if not to_user_ids:
+            return []
+
+        # 1 次查询校验 users 是否存在，1 次查询去掉已经关注了的
+        to_user_ids = set(User.objects.filter(id__in=to_user_ids).values_list('id', flat=True))
+        to_user_ids -= set(Friendship.objects.filter(
+            from_user_id=from_user_id,
+            to_user_id__in=to_user_ids,
+        ).values_list('to_user_id', flat=True))
+        if not to_user_ids:
+            return []
+
+        friendships = [
+            Friendship(from_user_id=from_user_id, to_user_id=to_user_id)
+            for to_user_id in sorted(to_user_ids)
+        ]
+        # 前端连点或者并发请求的时候，unique_together 会让重复的 friendship 被忽略
+        Friendship.objects.bulk_create(friendships, ignore_conflicts=True)
+        # ignore_conflicts 的时候不知道哪些 rows 真的被插入了（MySQL 也不会返回 ids），从 primary 重新查询一次，
+        # created_at 和这次 bulk_create 设置的相同的才是这次插入的。被忽略的 friendships 是并发的 follow 插入的，
+        # counters、caches 和 HBase 已经由它们自己的 listener 更新过了
+        created_at = {friendship.to_user_id: friendship.created_at for friendship in friendships}
+        friendships = [
+            friendship
+            for friendship in Friendship.objects.using('default').filter(
+                from_user_id=from_user_id,
+                to_user_id__in=created_at.keys(),
+            ).order_by('to_user_id')
+            if friendship.created_at == created_at[friendship.to_user_id]
+        ]
+        if not friendships:
+            return []
+
+        cls._update_following_cache_many(from_user_id, [
+            friendship.to_user_id for friendship in friendships
+        ], 'sadd')
+        cls.incr_friendship_counts_many(friendships, 1)
+        FriendshipGraphService.add_friendships(friendships)
+        if settings.FRIENDSHIP_HBASE_DUAL_WRITE:
+            cls.batch_save_to_hbase(friendships)
+        return friendships
+
+    @classmethod
+    def hbase_rows_to_friendships(cls, hbase_rows):
+        # 转换成不保存的 Friendship objects，serializers 可以不做修改直接使用
+        return [
+            Friendship(
+                from_user_id=hbase_row.from_user_id,
+                to_user_id=hbase_row.to_user_id,
+                created_at=timestamp_to_datetime(hbase_row.created_at),
+            )
+            for hbase_row in hbase_rows
+        ]
+
+
+class FriendshipGraphService(object):
+    """
+    关系图的索引：每个 user 的 followee ids 和 follower ids 以排好序的 array('q')
+    （每个 id 8 bytes）存在 Redis 里，10 万条边也只有 800KB，一次 GET 就能取出来
+    交集在 C 实现的 set 上完成，不需要多次 join Friendship 表
+
+    follow / unfollow 不会重写整个 array，而是记在 <key>:added 和 <key>:removed 两个 Redis set 里，
+    一个 id 只会出现在其中一个 set 里，反映的是最后一次操作，所以不论 array 是在操作之前还是之后
+    生成的，合并之后都是正确的。增量超过 GRAPH_DELTA_COMPACT_SIZE 的时候在读的时候合并进 array
+    """
+
+    @classmethod
+    def get_followee_ids(cls, user_id):
+        return cls._get_ids(FOLLOWEE_IDS_PATTERN, user_id, 'from_user_id', 'to_user_id')
+
+    @classmethod
+    def get_follower_ids(cls, user_id):
+        return cls._get_ids(FOLLOWER_IDS_PATTERN, user_id, 'to_user_id', 'from_user_id')
+
+    @classmethod
+    def intersect(cls, ids1, ids2):
+        # 用小的那个建 set，再和大的 array 求交集
+        if len(ids1) > len(ids2):
+            ids1, ids2 = ids2, ids1
+        return array('q', sorted(set(ids1).intersection(ids2)))
+
+    @classmethod
+    def get_followings_who_follow(cls, user_id, target_user_id):
+        # user_id 关注的人里面，有哪些也关注了 target_user_id
+        return cls.intersect(cls.get_followee_ids(user_id), cls.get_follower_ids(target_user_id))
+
+    @classmethod
+    def get_mutual_follow_ids(cls, user_id):
+        # 和 user_id 互相关注的人
+        return cls.intersect(cls.get_followee_ids(user_id), cls.get_follower_ids(user_id))
+
+    # CREATE & DELETE friendship will call these methods
+    @classmethod
+    def add_friendship(cls, friendship):
+        cls.add_friendships([friendship])
+
+    @classmethod
+    def remove_friendship(cls, friendship):
+        cls._update_deltas([friendship], 'removed', 'added')
+
+    @classmethod
+    def add_friendships(cls, friendships):
+        cls._update_deltas(friendships, 'added', 'removed')
+
+    @classmethod
+    def _update_deltas(cls, friendships, add_to, remove_from):
+        pipe = RedisClient.get_connection().pipeline()
+        for friendship in friendships:
+            if friendship.from_user_id is None or friendship.to_user_id is None:
+                continue
+            for key, member in [
+                (FOLLOWEE_IDS_PATTERN.format(user_id=friendship.from_user_id), friendship.to_user_id),
+                (FOLLOWER_IDS_PATTERN.format(user_id=friendship.to_user_id), friendship.from_user_id),
+            ]:
+                pipe.srem('{}:{}'.format(key, remove_from), member)
+                pipe.sadd('{}:{}'.format(key, add_to), member)
+                # 增量比 array 后过期，保证 array 过期之前增量不会丢失
+                pipe.expire('{}:{}'.format(key, add_to), settings.REDIS_KEY_EXPIRE_TIME)
+        pipe.execute()
+
+    @classmethod
+    def _get_ids(cls, pattern, user_id, filter_field, value_field):
+        key = pattern.format(user_id=user_id)
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        pipe.get(key)
+        pipe.smembers(key + ':added')
+        pipe.smembers(key + ':removed')
+        data, added, removed = pipe.execute()
+
+        ids = array('q')
+        if data is None:
+            # cache miss, 使用 (from_user_id / to_user_id, created_at) 的索引从 primary 加载
+            ids.extend(sorted(Friendship.objects.using('default').filter(
+                **{filter_field: user_id},
+            ).values_list(value_field, flat=True)))
+            conn.set(key, ids.tobytes(), ex=settings.REDIS_KEY_EXPIRE_TIME)
+        else:
+            ids.frombytes(data)
+        if not added and not removed:
+            return ids
+
+        ids = cls._merge_deltas(ids, added, removed)
+        if len(added) + len(removed) >= GRAPH_DELTA_COMPACT_SIZE:
+            cls._compact_deltas(conn, key)
+        return ids
+
+    @classmethod
+    def _merge_deltas(cls, ids, added, removed):
+        id_set = set(ids)
+        id_set.update(int(member) for member in added)
+        id_set.difference_update(int(member) for member in removed)
+        return array('q', sorted(id_set))
+
+    @classmethod
+    def _compact_deltas(cls, conn, key):
+        # 在 WATCH 之下重新读一遍 array 和增量再合并，期间有 follow / unfollow 或者别的读者先合并了，
+        # EXEC 会失败，放弃这一次合并，留给下一次读。否则旧的 array 可能覆盖掉新的，或者删掉还没合并的增量
+        with conn.pipeline() as pipe:
+            try:
+                pipe.watch(key, key + ':added', key + ':removed')
+                data = pipe.get(key)
+                if data is None:
+                    return
+                ids = array('q')
+                ids.frombytes(data)
+                ids = cls._merge_deltas(
+                    ids,
+                    pipe.smembers(key + ':added'),
+                    pipe.smembers(key + ':removed'),
+                )
+                pipe.multi()
+                pipe.set(key, ids.tobytes(), ex=settings.REDIS_KEY_EXPIRE_TIME)
+                pipe.delete(key + ':added', key + ':removed')
+                pipe.execute()
+            except WatchError:
+                pass
@@ -0,0 +1,25 @@
+from celery import shared_task
+from friendships.constants import RECONCILE_BATCH_SIZE
+from friendships.services import FriendshipService
+from twitter.cache import FOLLOWERS_COUNT_PATTERN
+from utils.redis_client import RedisClient
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def reconcile_friendship_counts_task():
+    # listener 里的 exists + incr 不是原子的，定期用 db 里的值校准 Redis 里已经存在的 counts
+    conn = RedisClient.get_connection()
+    pattern = FOLLOWERS_COUNT_PATTERN.format(user_id='*')
+    prefix = pattern[:-1]
+    user_ids, reconciled_count = [], 0
+    for key in conn.scan_iter(match=pattern, count=RECONCILE_BATCH_SIZE):
+        user_ids.append(int(key.decode('utf-8')[len(prefix):]))
+        if len(user_ids) >= RECONCILE_BATCH_SIZE:
+            FriendshipService.reconcile_friendship_counts(user_ids)
+            reconciled_count += len(user_ids)
+            user_ids = []
+    if user_ids:
+        FriendshipService.reconcile_friendship_counts(user_ids)
+        reconciled_count += len(user_ids)
+    return '{} users reconciled.'.format(reconciled_count)
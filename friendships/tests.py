@@ -1,9 +1,17 @@
+from django.core.management import call_command
+from django.test import override_settings
 from django_hbase.models import EmptyColumnError, BadRowKeyError
 from friendships.hbase_models import HBaseFollower, HBaseFollowing
 from friendships.models import Friendship
-from friendships.services import FriendshipService
+from friendships.services import FriendshipGraphService, FriendshipService
+from friendships.tasks import reconcile_friendship_counts_task
 from testing.testcases import TestCase
+from twitter.cache import FOLLOWEE_IDS_PATTERN, FOLLOWERS_COUNT_PATTERN
+from unittest import mock
+from utils.redis_client import RedisClient
+from utils.time_helpers import datetime_to_timestamp
 
+from io import StringIO
 import time
 
 
@@ -27,6 +35,143 @@ class FriendshipServiceTests(TestCase):
         self.assertSetEqual(user_id_set, {user1.id, user2.id})
 
 
+    def test_has_followed_many(self):
+        user1 = self.create_user('user1')
+        user2 = self.create_user('user2')
+        Friendship.objects.create(from_user=self.ann, to_user=user1)
+        self.assertEqual(
+            FriendshipService.has_followed_many(self.ann.id, [user1.id, user2.id, self.bob.id]),
+            {user1.id: True, user2.id: False, self.bob.id: False},
+        )
+        # a user following nobody still gets a loaded set
+        self.assertEqual(FriendshipService.has_followed_many(self.bob.id, [self.ann.id]), {
+            self.ann.id: False,
+        })
+        self.assertEqual(FriendshipService.get_following_user_id_set(self.bob.id), set())
+
+        # the loaded set is updated incrementally, no reload from db
+        Friendship.objects.create(from_user=self.ann, to_user=user2)
+        Friendship.objects.filter(from_user=self.ann, to_user=user1).delete()
+        with self.assertNumQueries(0):
+            has_followed = FriendshipService.has_followed_many(
+                self.ann.id,
+                [user1.id, user2.id, self.bob.id],
+            )
+        self.assertEqual(has_followed, {user1.id: False, user2.id: True, self.bob.id: False})
+        self.assertEqual(FriendshipService.has_followed(self.ann, user2), True)
+
+    def test_friendship_counts(self):
+        user1 = self.create_user('user1')
+        self.assertEqual(FriendshipService.get_follower_count(self.bob.id), 0)
+        self.assertEqual(FriendshipService.get_following_count(self.ann.id), 0)
+
+        # counters are maintained by the listener
+        Friendship.objects.create(from_user=self.ann, to_user=self.bob)
+        Friendship.objects.create(from_user=user1, to_user=self.bob)
+        Friendship.objects.create(from_user=self.ann, to_user=user1)
+        counts = FriendshipService.get_friendship_counts([self.ann.id, self.bob.id, user1.id])
+        self.assertEqual(counts, {
+            self.ann.id: {'followers_count': 0, 'followings_count': 2},
+            self.bob.id: {'followers_count': 2, 'followings_count': 0},
+            user1.id: {'followers_count': 1, 'followings_count': 1},
+        })
+
+        Friendship.objects.filter(from_user=self.ann, to_user=self.bob).delete()
+        self.assertEqual(FriendshipService.get_follower_count(self.bob.id), 1)
+        self.assertEqual(FriendshipService.get_following_count(self.ann.id), 1)
+
+        # cache miss, back-fill from db
+        RedisClient.clear()
+        self.assertEqual(FriendshipService.get_follower_count(self.bob.id), 1)
+        self.assertEqual(FriendshipService.get_following_count(self.ann.id), 1)
+
+        # counters drifted away from db are fixed by reconciliation
+        conn = RedisClient.get_connection()
+        for user in [self.ann, self.bob, user1, self.create_user('user2')]:
+            FriendshipService.get_follower_count(user.id)
+            conn.set(FOLLOWERS_COUNT_PATTERN.format(user_id=user.id), 100)
+        self.assertEqual(FriendshipService.get_follower_count(self.bob.id), 100)
+        self.assertEqual(reconcile_friendship_counts_task(), '4 users reconciled.')
+        self.assertEqual(FriendshipService.get_follower_count(self.bob.id), 1)
+        self.assertEqual(FriendshipService.get_follower_count(self.ann.id), 0)
+
+    def test_graph_index(self):
+        users = [self.create_user(f'user{i}') for i in range(4)]
+        for user in users:
+            Friendship.objects.create(from_user=self.ann, to_user=user)
+        for user in users[1:3] + [self.bob]:
+            Friendship.objects.create(from_user=user, to_user=self.ann)
+        for user in users[:2]:
+            Friendship.objects.create(from_user=user, to_user=self.bob)
+
+        self.assertEqual(list(FriendshipGraphService.get_followee_ids(self.ann.id)), [
+            user.id for user in users
+        ])
+        self.assertEqual(list(FriendshipGraphService.get_mutual_follow_ids(self.ann.id)), [
+            users[1].id, users[2].id,
+        ])
+        self.assertEqual(
+            list(FriendshipGraphService.get_followings_who_follow(self.ann.id, self.bob.id)),
+            [users[0].id, users[1].id],
+        )
+
+        # arrays are cached, changes are merged from the deltas
+        Friendship.objects.filter(from_user=self.ann, to_user=users[1]).delete()
+        Friendship.objects.create(from_user=self.ann, to_user=self.bob)
+        with self.assertNumQueries(0):
+            mutual_ids = FriendshipGraphService.get_mutual_follow_ids(self.ann.id)
+        self.assertEqual(list(mutual_ids), sorted([users[2].id, self.bob.id]))
+
+        # follow and unfollow again, only the last change is kept
+        Friendship.objects.filter(from_user=self.ann, to_user=self.bob).delete()
+        Friendship.objects.create(from_user=self.ann, to_user=self.bob)
+        Friendship.objects.filter(from_user=self.ann, to_user=users[0]).delete()
+        # 3 deltas reach GRAPH_DELTA_COMPACT_SIZE, they are compacted into the array
+        self.assertEqual(list(FriendshipGraphService.get_followee_ids(self.ann.id)), sorted([
+            users[2].id, users[3].id, self.bob.id,
+        ]))
+        key = FOLLOWEE_IDS_PATTERN.format(user_id=self.ann.id)
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.exists(key + ':added', key + ':removed'), 0)
+        self.assertEqual(list(FriendshipGraphService.get_followee_ids(self.ann.id)), sorted([
+            users[2].id, users[3].id, self.bob.id,
+        ]))
+
+        # cache miss, load from db
+        RedisClient.clear()
+        self.assertEqual(list(FriendshipGraphService.get_followee_ids(self.ann.id)), sorted([
+            users[2].id, users[3].id, self.bob.id,
+        ]))
+
+
+    def test_graph_index_compaction_race(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(4)]
+        for user in users[:3]:
+            Friendship.objects.create(from_user=self.ann, to_user=user)
+        FriendshipGraphService.get_followee_ids(self.ann.id)
+        for user in users[:3]:
+            Friendship.objects.filter(from_user=self.ann, to_user=user).delete()
+
+        # a follow lands between reading the deltas and compacting them,
+        # the compaction is dropped instead of losing the new delta
+        merge_deltas = FriendshipGraphService._merge_deltas
+
+        def follow_while_compacting(ids, added, removed):
+            if merge_deltas_mock.call_count == 2:
+                Friendship.objects.create(from_user=self.ann, to_user=users[3])
+            return merge_deltas(ids, added, removed)
+
+        with mock.patch.object(
+            FriendshipGraphService,
+            '_merge_deltas',
+            side_effect=follow_while_compacting,
+        ) as merge_deltas_mock:
+            self.assertEqual(list(FriendshipGraphService.get_followee_ids(self.ann.id)), [])
+        key = FOLLOWEE_IDS_PATTERN.format(user_id=self.ann.id)
+        self.assertEqual(RedisClient.get_connection().scard(key + ':removed'), 3)
+        self.assertEqual(list(FriendshipGraphService.get_followee_ids(self.ann.id)), [users[3].id])
+
+
 class HBaseTests(TestCase):
 
     @property
@@ -90,3 +235,100 @@ class HBaseTests(TestCase):
             exception_raised = True
             self.assertEqual(str(e), 'created_at is missing in row key')
         self.assertTrue(exception_raised)
+
+    def test_filter_and_delete(self):
+        ts = self.ts_now
+        for to_user_id in [1, 2, 3]:
+            for i in range(3):
+                HBaseFollower.create(from_user_id=10 + i, to_user_id=to_user_id, created_at=ts + i)
+        # to_user_id=11 must not be matched by the prefix of to_user_id=1
+        HBaseFollower.create(from_user_id=20, to_user_id=11, created_at=ts)
+
+        followers = HBaseFollower.filter(prefix=(1,))
+        self.assertEqual([f.from_user_id for f in followers], [10, 11, 12])
+        self.assertEqual(len(HBaseFollower.filter(prefix=(11,))), 1)
+
+        followers = HBaseFollower.filter(prefix=(2,), limit=2)
+        self.assertEqual([f.created_at for f in followers], [ts, ts + 1])
+
+        # reverse scan from the newest
+        followers = HBaseFollower.filter(start=(2, ts + 1), stop=(2,), reverse=True)
+        self.assertEqual([f.from_user_id for f in followers], [11, 10])
+
+        followers[0].delete()
+        followers = HBaseFollower.filter(prefix=(2,))
+        self.assertEqual([f.from_user_id for f in followers], [10, 12])
+
+        HBaseFollower.batch_delete(followers)
+        self.assertEqual(HBaseFollower.filter(prefix=(2,)), [])
+        HBaseFollower.batch_create(followers)
+        self.assertEqual(len(HBaseFollower.filter(prefix=(2,))), 2)
+
+
+class FriendshipHBaseMigrationTests(TestCase):
+    def setUp(self):
+        super(FriendshipHBaseMigrationTests, self).setUp()
+        self.ann = self.create_user('ann')
+        self.bob = self.create_user('bob')
+        self.users = [self.create_user('user{}'.format(i)) for i in range(3)]
+
+    @override_settings(FRIENDSHIP_HBASE_DUAL_WRITE=True)
+    def test_dual_write_and_read_switch(self):
+        for user in self.users:
+            self.create_friendship(user, self.ann)
+        self.create_friendship(self.ann, self.bob)
+
+        followers = HBaseFollower.filter(prefix=(self.ann.id,))
+        self.assertEqual([f.from_user_id for f in followers], [user.id for user in self.users])
+        followings = HBaseFollowing.filter(prefix=(self.ann.id,))
+        self.assertEqual([f.to_user_id for f in followings], [self.bob.id])
+        friendship = Friendship.objects.get(from_user=self.ann, to_user=self.bob)
+        self.assertEqual(followings[0].created_at, datetime_to_timestamp(friendship.created_at))
+
+        Friendship.objects.filter(from_user=self.users[0], to_user=self.ann).delete()
+        self.assertEqual(len(HBaseFollower.filter(prefix=(self.ann.id,))), 2)
+        self.assertEqual(HBaseFollowing.filter(prefix=(self.users[0].id,)), [])
+
+        with override_settings(FRIENDSHIP_READ_FROM_HBASE=True):
+            with self.assertNumQueries(0):
+                follower_ids = FriendshipService.get_follower_ids(self.ann.id)
+        self.assertEqual(follower_ids, [self.users[1].id, self.users[2].id])
+
+        # bulk follow mirrors all the edges in one batch per table
+        FriendshipService.bulk_follow(self.bob.id, [user.id for user in self.users])
+        followings = HBaseFollowing.filter(prefix=(self.bob.id,))
+        self.assertEqual(
+            sorted(f.to_user_id for f in followings),
+            [user.id for user in self.users],
+        )
+        self.assertEqual(len(HBaseFollower.filter(prefix=(self.users[0].id,))), 1)
+
+    def test_backfill_and_check_commands(self):
+        for user in self.users:
+            self.create_friendship(user, self.ann)
+        self.create_friendship(self.ann, self.bob)
+
+        out = StringIO()
+        call_command('check_hbase_friendships', stdout=out)
+        self.assertIn('8 rows missing in HBase, 0 extra rows in HBase.', out.getvalue())
+
+        call_command('backfill_hbase_friendships', batch_size=3, stdout=StringIO())
+        self.assertEqual(len(HBaseFollower.filter(prefix=(self.ann.id,))), 3)
+        self.assertEqual(len(HBaseFollowing.filter(prefix=(self.ann.id,))), 1)
+        out = StringIO()
+        call_command('check_hbase_friendships', stdout=out)
+        self.assertIn('0 rows missing in HBase, 0 extra rows in HBase.', out.getvalue())
+
+        # unfollow without dual-write, HBase has an extra row
+        Friendship.objects.filter(from_user=self.ann, to_user=self.bob).delete()
+        out = StringIO()
+        call_command('check_hbase_friendships', user_ids=[self.bob.id], fix=True, stdout=out)
+        self.assertIn('0 rows missing in HBase, 1 extra rows in HBase. Fixed.', out.getvalue())
+        self.assertEqual(HBaseFollower.filter(prefix=(self.bob.id,)), [])
+        out = StringIO()
+        call_command('check_hbase_friendships', stdout=out)
+        self.assertIn('0 rows missing in HBase, 1 extra rows in HBase.', out.getvalue())
+        call_command('check_hbase_friendships', fix=True, stdout=StringIO())
+        out = StringIO()
+        call_command('check_hbase_friendships', stdout=out)
+        self.assertIn('0 rows missing in HBase, 0 extra rows in HBase.', out.getvalue())
@@ -1,8 +1,12 @@
+from inbox.services import NotificationService
 from rest_framework import serializers
 from notifications.models import Notification
 
 
 class NotificationSerializer(serializers.ModelSerializer):
+    # 合并之后的 notification 里有多少个不同的 actors，客户端可以显示成 "X and 9,999 others ..."
+    actor_count = serializers.SerializerMethodField()
+
     class Meta:
         model = Notification
         # HOMEWORK: make fields more straightforward, i.e. actor verb action on target
@@ -15,9 +19,13 @@ class NotificationSerializer(serializers.ModelSerializer):
             'action_object_object_id',
             'timestamp',
             'unread',
+            'actor_count',
         )
     # example: Ann (actor) liked (verb) your tweet1 (action_object) on Twitter (target)
 
+    def get_actor_count(self, obj):
+        return (obj.data or {}).get('actor_count', 1)
+
 
 class NotificationSerializerForUpdate(serializers.ModelSerializer):
     # BooleanField 会自动兼容 true, false, "true", "false", "True", "1", "0"
@@ -29,6 +37,11 @@ class NotificationSerializerForUpdate(serializers.ModelSerializer):
         fields = ('unread',)
 
     def update(self, instance, validated_data):
-        instance.unread = validated_data['unread']
+        unread = validated_data['unread']
+        if instance.unread == unread:
+            return instance
+        instance.unread = unread
         instance.save()
+        # 只有 unread 真的变化了才更新 Redis 里的 unread count
+        NotificationService.incr_unread_count(instance.recipient_id, 1 if unread else -1)
         return instance
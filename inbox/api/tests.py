@@ -35,6 +35,7 @@ class NotificationsTests(TestCase):
 
 class NotificationApiTests(TestCase):
     def setUp(self):
+        self.clear_cache()
         self.create_user_and_client()
         self.ann_tweet = self.create_tweet(self.ann)
 
@@ -56,6 +57,20 @@ class NotificationApiTests(TestCase):
         response = self.ann_client.get(UNREAD_COUNT_URL)
         self.assertEqual(response.data['unread_count'], 2)
 
+        # the count is kept in redis, polling doesn't touch db
+        self.bob_client.post(COMMENT_URL, {
+            'tweet_id': self.ann_tweet.id,
+            'content': 'a ha',
+        })
+        with self.assertNumQueries(0):
+            response = self.ann_client.get(UNREAD_COUNT_URL)
+        self.assertEqual(response.data['unread_count'], 3)
+
+        # cache miss, back-fill from db
+        self.clear_cache()
+        response = self.ann_client.get(UNREAD_COUNT_URL)
+        self.assertEqual(response.data['unread_count'], 3)
+
     def test_mark_all_as_read(self):
         self.bob_client.post(LIKE_URL, {
             'content_type': 'tweet',
@@ -84,6 +99,7 @@ class NotificationApiTests(TestCase):
         # ann sees 2 notifications
         response = self.ann_client.get(NOTIFICATION_URL)
         self.assertEqual(response.data['count'], 2)
+        self.assertEqual(response.data['results'][0]['actor_count'], 1)
 
         # mark one as read and one is left
         notification = self.ann.notifications.first()  # TODO: User.notifications?
@@ -102,6 +118,8 @@ class NotificationApiTests(TestCase):
         self.ann_client.post(READ_ALL_URL)
         response = self.ann_client.get(NOTIFICATION_URL, {'unread': True})
         self.assertEqual(response.data['count'], 0)
+        response = self.ann_client.get(UNREAD_COUNT_URL)
+        self.assertEqual(response.data['unread_count'], 0)
 
     def test_update(self):
         self.bob_client.post(LIKE_URL, {
@@ -134,6 +152,11 @@ class NotificationApiTests(TestCase):
         response = self.ann_client.get(UNREAD_COUNT_URL)
         self.assertEqual(response.data['unread_count'], 1)
 
+        # mark it as read twice, the count is not changed
+        self.ann_client.put(url, {'unread': False})
+        response = self.ann_client.get(UNREAD_COUNT_URL)
+        self.assertEqual(response.data['unread_count'], 1)
+
         # mark it as unread again
         self.ann_client.put(url, {'unread': True})
         response = self.ann_client.get(UNREAD_COUNT_URL)
@@ -3,13 +3,14 @@ from inbox.api.serializers import (
     NotificationSerializer,
     NotificationSerializerForUpdate,
 )
-from ratelimit.decorators import ratelimit
+from inbox.services import NotificationService
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from notifications.models import Notification
-from utils.decorators import required_params
+from utils.decorators import read_from_replica, required_params
+from utils.ratelimit import ratelimit
 
 
 class NotificationViewSet(
@@ -26,19 +27,25 @@ class NotificationViewSet(
         # return self.request.user.notifications.all()
         return Notification.objects.filter(recipient=self.request.user)
 
+    @read_from_replica
+    def list(self, request, *args, **kwargs):
+        return super(NotificationViewSet, self).list(request, *args, **kwargs)
+
     # url_path 可以指定 api 的 URL 名字不和 function 名字相同，这里这么做是因为
     # 默认的 URL 规则是不用下划线的，而 Python function 名字又不能用 dash -
     # GET /api/notifications/unread-count/
     @action(methods=['GET'], detail=False, url_path='unread-count')
     @method_decorator(ratelimit(key='user', rate='3/s', method='GET', block=True))
+    @read_from_replica
     def unread_count(self, request, *args, **kwargs):
-        count = self.get_queryset().filter(unread=True).count()
+        # 客户端会一直轮询这个 api，count 由 NotificationService 在 Redis 里维护
+        count = NotificationService.get_unread_count(request.user.id)
         return Response({'unread_count': count}, status=status.HTTP_200_OK)
 
     @action(methods=['POST'], detail=False, url_path='mark-all-as-read')
     @method_decorator(ratelimit(key='user', rate='3/s', method='POST', block=True))
     def mark_all_as_read(self, request, *args, **kwargs):
-        updated_count = self.get_queryset().filter(unread=True).update(unread=False)
+        updated_count = NotificationService.mark_all_as_read(request.user.id)
         return Response({'marked_count': updated_count}, status=status.HTTP_200_OK)
 
     @required_params(method='PUT', params=['unread'])
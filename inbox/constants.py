@@ -0,0 +1,7 @@
+from django.conf import settings
+
+# flush notification buffers 的时候每一批从 Redis 读出来的 like / comment ids 个数
+NOTIFICATION_FLUSH_BATCH_SIZE = 1000 if not settings.TESTING else 5
+
+# 校准 unread counts 的时候，每个 GROUP BY 查询包含的 users 个数
+RECONCILE_BATCH_SIZE = 1000 if not settings.TESTING else 3
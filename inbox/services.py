@@ -1,48 +1,260 @@
 from comments.models import Comment
+from django.conf import settings
+from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from notifications.signals import notify
+from django.db.models import Count
+from inbox.constants import NOTIFICATION_FLUSH_BATCH_SIZE
+from inbox.tasks import send_comment_notifications_task, send_like_notifications_task
+from likes.models import Like
+from notifications.models import Notification
 from tweets.models import Tweet
+from twitter.cache import (
+    NOTIFICATION_BUFFER_PATTERN,
+    NOTIFICATION_PROCESSING_PATTERN,
+    UNREAD_NOTIFICATIONS_COUNT_PATTERN,
+)
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+
+LIKE_NOTIFICATION_VERBS = {
+    Tweet: 'liked your tweet',
+    Comment: 'liked your comment',
+}
+
+
+# buffer 还没有开始 flush 的时候 RENAME 成 processing list，返回 processing list 的长度
+# 上一次 flush 失败留下来的 processing list 不会被覆盖，这次会先重试它
+# KEYS[1]: buffer, KEYS[2]: processing list
+START_FLUSH_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+return redis.call('LLEN', KEYS[2])
+"""
 
 
 class NotificationService(object):
     @classmethod
     def send_like_notification(cls, like):
-        target = like.content_object
-        # 给自己点赞不需要发提醒
-        if like.user == target.user:
+        # 打开 coalescing 的时候只把 like id 放进 Redis 的 buffer，由 celery beat 定期合并写入
+        if settings.NOTIFICATION_COALESCING:
+            cls._buffer_notification('like', like.id)
             return
-        # if like.content_type == ContentType.objects.get_for_model(Tweet):
-        #     notify.send(
-        #         like.user,
-        #         recipient=target.user,
-        #         verb='liked your tweet',
-        #         target=target,
-        #     )
-        # if like.content_type == ContentType.objects.get_for_model(Comment):
-        #     notify.send(
-        #         like.user,
-        #         recipient=target.user,
-        #         verb='liked your comment',
-        #         target=target,
-        #     )
-        if like.content_type == ContentType.objects.get_for_model(Tweet):
-            message = 'liked your tweet'
-        if like.content_type == ContentType.objects.get_for_model(Comment):
-            message = 'liked your comment'
-        notify.send(
-            like.user,
-            recipient=target.user,
-            verb=message,
-            target=target,
-        )
+        # notification 在 celery 里异步地写入，task 只带上 like id，like 的请求不需要等待
+        send_like_notifications_task.delay([like.id])
 
     @classmethod
     def send_comment_notification(cls, comment):
-        if comment.user == comment.tweet.user:
+        if settings.NOTIFICATION_COALESCING:
+            cls._buffer_notification('comment', comment.id)
             return
-        notify.send(
-            comment.user,
-            recipient=comment.tweet.user,
-            verb='commented your tweet',
-            target=comment.tweet,
+        send_comment_notifications_task.delay([comment.id])
+
+    @classmethod
+    def _buffer_notification(cls, kind, object_id):
+        key = NOTIFICATION_BUFFER_PATTERN.format(kind=kind)
+        RedisClient.get_connection().rpush(key, object_id)
+
+    @classmethod
+    def flush_notification_buffers(cls):
+        """
+        buffer 整个 RENAME 成 processing list，之后 push 进来的 ids 属于下一个 window
+        processing list 里的 ids 分批读出来，同一个 (recipient, target, verb) 跨 batch 合并，
+        一个 window 里同一条 tweet 的 1 万个 likes 只会产生 1 条 notification
+        notifications 写入 db 之后才删除 processing list，失败的时候留给下一次 flush 重试
+        """
+        conn = RedisClient.get_connection()
+        created_count = 0
+        for kind, build in [
+            ('like', cls.build_like_notifications),
+            ('comment', cls.build_comment_notifications),
+        ]:
+            key = NOTIFICATION_BUFFER_PATTERN.format(kind=kind)
+            processing_key = NOTIFICATION_PROCESSING_PATTERN.format(kind=kind)
+            if not RedisHelper.get_script(START_FLUSH_SCRIPT)(keys=[key, processing_key]):
+                continue
+
+            groups = {}
+            start = 0
+            while True:
+                object_ids = conn.lrange(processing_key, start, start + NOTIFICATION_FLUSH_BATCH_SIZE - 1)
+                if not object_ids:
+                    break
+                cls._coalesce_notifications(groups, build([int(object_id) for object_id in object_ids]))
+                start += NOTIFICATION_FLUSH_BATCH_SIZE
+
+            notifications = []
+            for notification, actor_ids in groups.values():
+                notification.data = {'actor_count': len(actor_ids)}
+                notifications.append(notification)
+            created_count += cls._bulk_create_notifications(notifications)
+            conn.delete(processing_key)
+        return created_count
+
+    @classmethod
+    def deliver_like_notifications(cls, like_ids):
+        """
+        一批 likes 的 notifications 一起创建：likes 1 次查询，每种 target 1 次查询，
+        notifications 1 次 bulk insert。已经被取消的 likes 会被跳过
+        """
+        return cls._bulk_create_notifications(cls.build_like_notifications(like_ids))
+
+    @classmethod
+    def deliver_comment_notifications(cls, comment_ids):
+        return cls._bulk_create_notifications(cls.build_comment_notifications(comment_ids))
+
+    @classmethod
+    def build_like_notifications(cls, like_ids):
+        likes = list(Like.objects.filter(id__in=like_ids))
+        # {content_type_id: {object_id: user_id of the target}}
+        target_user_ids = {}
+        for content_type_id in {like.content_type_id for like in likes}:
+            model_class = ContentType.objects.get_for_id(content_type_id).model_class()
+            target_user_ids[content_type_id] = dict(model_class.objects.filter(
+                id__in=[like.object_id for like in likes if like.content_type_id == content_type_id],
+            ).values_list('id', 'user_id'))
+
+        notifications = []
+        for like in likes:
+            recipient_id = target_user_ids[like.content_type_id].get(like.object_id)
+            # 给自己点赞不需要发提醒
+            if recipient_id is None or recipient_id == like.user_id:
+                continue
+            model_class = ContentType.objects.get_for_id(like.content_type_id).model_class()
+            notifications.append(cls._build_notification(
+                actor_id=like.user_id,
+                recipient_id=recipient_id,
+                verb=LIKE_NOTIFICATION_VERBS[model_class],
+                target_content_type_id=like.content_type_id,
+                target_id=like.object_id,
+                timestamp=like.created_at,
+            ))
+        return notifications
+
+    @classmethod
+    def build_comment_notifications(cls, comment_ids):
+        comments = Comment.objects.filter(id__in=comment_ids).select_related('tweet')
+        tweet_content_type = ContentType.objects.get_for_model(Tweet)
+        return [
+            cls._build_notification(
+                actor_id=comment.user_id,
+                recipient_id=comment.tweet.user_id,
+                verb='commented your tweet',
+                target_content_type_id=tweet_content_type.id,
+                target_id=comment.tweet_id,
+                timestamp=comment.created_at,
+            )
+            for comment in comments
+            if comment.user_id != comment.tweet.user_id
+        ]
+
+    @classmethod
+    def _build_notification(
+        cls,
+        actor_id,
+        recipient_id,
+        verb,
+        target_content_type_id,
+        target_id,
+        timestamp,
+    ):
+        # 和 notify.send(actor, recipient=recipient, verb=verb, target=target) 创建的 notification 一样
+        return Notification(
+            recipient_id=recipient_id,
+            actor_content_type=ContentType.objects.get_for_model(User),
+            actor_object_id=actor_id,
+            verb=verb,
+            target_content_type_id=target_content_type_id,
+            target_object_id=target_id,
+            timestamp=timestamp,
+        )
+
+    @classmethod
+    def _coalesce_notifications(cls, groups, notifications):
+        """
+        同一个 (recipient, target, verb) 的 notifications 合并到 groups 里，
+        groups: {(recipient, verb, target): (latest notification, actor ids)}
+        合并之后 actor 是最近的那个，actor ids 的个数就是 "X and 9,999 others liked your tweet"
+        """
+        for notification in notifications:
+            group_key = (
+                notification.recipient_id,
+                notification.verb,
+                notification.target_content_type_id,
+                notification.target_object_id,
+            )
+            latest, actor_ids = groups.get(group_key, (notification, set()))
+            if notification.timestamp >= latest.timestamp:
+                latest = notification
+            actor_ids.add(notification.actor_object_id)
+            groups[group_key] = (latest, actor_ids)
+
+    @classmethod
+    def _bulk_create_notifications(cls, notifications):
+        if not notifications:
+            return 0
+        # 一个 window 合并出来的 notifications 可能很多，分批 insert，bulk_create 本身是一个 transaction
+        Notification.objects.bulk_create(notifications, batch_size=NOTIFICATION_FLUSH_BATCH_SIZE)
+        # bulk create 不会触发 post_save 的 signal，按 recipient 合并之后更新 unread count
+        unread_counts = {}
+        for notification in notifications:
+            recipient_id = notification.recipient_id
+            unread_counts[recipient_id] = unread_counts.get(recipient_id, 0) + 1
+        for recipient_id, count in unread_counts.items():
+            cls.incr_unread_count(recipient_id, count)
+        return len(notifications)
+
+    @classmethod
+    def get_unread_count(cls, user_id):
+        """
+        unread count 存在 Redis 里，客户端不停地轮询也不会访问 db
+        cache miss 的时候用 (recipient, unread) 的 COUNT 从 db back-fill
+        """
+        key = UNREAD_NOTIFICATIONS_COUNT_PATTERN.format(user_id=user_id)
+        conn = RedisClient.get_connection()
+        count = conn.get(key)
+        # 并发的更新可能让 counter 变成负数，这时也重新从 db 加载
+        # 之后的 INCRBY 都以这个值为基础，从 primary 读
+        if count is not None and int(count) >= 0:
+            return int(count)
+        count = Notification.objects.using('default').filter(recipient_id=user_id, unread=True).count()
+        conn.set(key, count, ex=settings.REDIS_KEY_EXPIRE_TIME)
+        return count
+
+    @classmethod
+    def incr_unread_count(cls, user_id, delta):
+        key = UNREAD_NOTIFICATIONS_COUNT_PATTERN.format(user_id=user_id)
+        conn = RedisClient.get_connection()
+        # key 不存在的时候不需要更新，下次读的时候会从 db back-fill
+        if conn.exists(key):
+            conn.incrby(key, delta)
+
+    @classmethod
+    def mark_all_as_read(cls, user_id):
+        updated_count = Notification.objects.filter(
+            recipient_id=user_id,
+            unread=True,
+        ).update(unread=False)
+        # 删掉 counter 而不是写 0，UPDATE 和写 Redis 之间并发的 INCRBY 不会被覆盖掉，
+        # 下次轮询的时候从 db 重新加载。exists + incrby 之间被删掉留下的偏差由定期校准修正
+        key = UNREAD_NOTIFICATIONS_COUNT_PATTERN.format(user_id=user_id)
+        RedisClient.get_connection().delete(key)
+        return updated_count
+
+    @classmethod
+    def reconcile_unread_counts(cls, user_ids):
+        # 用 db 里的值覆盖 Redis 里的 unread counts，用于定期校准，从 primary 读
+        unread_counts = dict(
+            Notification.objects.using('default').filter(recipient_id__in=user_ids, unread=True)
+            .values_list('recipient_id').annotate(count=Count('id')).order_by()
         )
+        pipe = RedisClient.get_connection().pipeline()
+        for user_id in user_ids:
+            pipe.set(
+                UNREAD_NOTIFICATIONS_COUNT_PATTERN.format(user_id=user_id),
+                unread_counts.get(user_id, 0),
+                ex=settings.REDIS_KEY_EXPIRE_TIME,
+            )
+        pipe.execute()
+        return unread_counts
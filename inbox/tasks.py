@@ -0,0 +1,52 @@
+from celery import shared_task
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def send_like_notifications_task(like_ids):
+    # import 写在里面避免循环依赖
+    from inbox.services import NotificationService
+
+    created_count = NotificationService.deliver_like_notifications(like_ids)
+    return '{} notifications created.'.format(created_count)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def send_comment_notifications_task(comment_ids):
+    from inbox.services import NotificationService
+
+    created_count = NotificationService.deliver_comment_notifications(comment_ids)
+    return '{} notifications created.'.format(created_count)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_notification_buffers_task():
+    # NOTIFICATION_COALESCING 模式下由 celery beat 定期调用
+    from inbox.services import NotificationService
+
+    created_count = NotificationService.flush_notification_buffers()
+    return '{} notifications created.'.format(created_count)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def reconcile_unread_counts_task():
+    # incr_unread_count 里的 exists + incrby 不是原子的，定期用 db 里的值校准 Redis 里已经存在的 unread counts
+    from inbox.constants import RECONCILE_BATCH_SIZE
+    from inbox.services import NotificationService
+    from twitter.cache import UNREAD_NOTIFICATIONS_COUNT_PATTERN
+    from utils.redis_client import RedisClient
+
+    conn = RedisClient.get_connection()
+    pattern = UNREAD_NOTIFICATIONS_COUNT_PATTERN.format(user_id='*')
+    prefix = pattern[:-1]
+    user_ids, reconciled_count = [], 0
+    for key in conn.scan_iter(match=pattern, count=RECONCILE_BATCH_SIZE):
+        user_ids.append(int(key.decode('utf-8')[len(prefix):]))
+        if len(user_ids) >= RECONCILE_BATCH_SIZE:
+            NotificationService.reconcile_unread_counts(user_ids)
+            reconciled_count += len(user_ids)
+            user_ids = []
+    if user_ids:
+        NotificationService.reconcile_unread_counts(user_ids)
+        reconciled_count += len(user_ids)
+    return '{} users reconciled.'.format(reconciled_count)
@@ -1,6 +1,12 @@
+from django.db import DatabaseError
+from django.test import override_settings
 from inbox.services import NotificationService
+from inbox.tasks import flush_notification_buffers_task, reconcile_unread_counts_task
 from notifications.models import Notification
 from testing.testcases import TestCase
+from twitter.cache import UNREAD_NOTIFICATIONS_COUNT_PATTERN
+from unittest import mock
+from utils.redis_client import RedisClient
 
 
 class NotificationServiceTests(TestCase):
@@ -30,3 +36,100 @@ class NotificationServiceTests(TestCase):
         like = self.create_like(self.bob, self.ann_tweet)
         NotificationService.send_like_notification(like)
         self.assertEqual(Notification.objects.count(), 1)
+
+    def test_deliver_notifications_in_batch(self):
+        users = [self.create_user(f'user{i}') for i in range(3)]
+        comment = self.create_comment(self.bob, self.ann_tweet)
+        likes = [self.create_like(user, self.ann_tweet) for user in users]
+        likes.append(self.create_like(self.ann, self.ann_tweet))
+        likes.append(self.create_like(self.ann, comment))
+        like_ids = [like.id for like in likes]
+        # a cancelled like is skipped
+        likes[0].delete()
+
+        # likes + tweets + comments + bulk insert
+        with self.assertNumQueries(4):
+            created_count = NotificationService.deliver_like_notifications(like_ids)
+        self.assertEqual(created_count, 3)
+        self.assertEqual(Notification.objects.filter(recipient=self.ann).count(), 2)
+        notification = Notification.objects.get(recipient=self.bob)
+        self.assertEqual(notification.verb, 'liked your comment')
+        self.assertEqual(notification.actor, self.ann)
+        self.assertEqual(notification.target, comment)
+        self.assertEqual(NotificationService.get_unread_count(self.ann.id), 2)
+
+        comments = [self.create_comment(user, self.ann_tweet) for user in users]
+        comments.append(self.create_comment(self.ann, self.ann_tweet))
+        created_count = NotificationService.deliver_comment_notifications([c.id for c in comments])
+        self.assertEqual(created_count, 3)
+        # the unread count is updated along with the bulk insert
+        with self.assertNumQueries(0):
+            self.assertEqual(NotificationService.get_unread_count(self.ann.id), 5)
+
+    def test_mark_all_as_read_and_reconcile(self):
+        users = [self.create_user(f'user{i}') for i in range(4)]
+        for user in users:
+            NotificationService.send_like_notification(self.create_like(user, self.ann_tweet))
+        self.assertEqual(NotificationService.get_unread_count(self.ann.id), 4)
+        self.assertEqual(NotificationService.get_unread_count(self.bob.id), 0)
+
+        # the counter is dropped and reloaded from db on the next poll
+        self.assertEqual(NotificationService.mark_all_as_read(self.ann.id), 4)
+        conn = RedisClient.get_connection()
+        key = UNREAD_NOTIFICATIONS_COUNT_PATTERN.format(user_id=self.ann.id)
+        self.assertEqual(conn.exists(key), 0)
+        self.assertEqual(NotificationService.get_unread_count(self.ann.id), 0)
+
+        # drifted counters that are still in Redis are reset from db, 2 GROUP BY queries of 3 users
+        conn.set(key, 5)
+        conn.set(UNREAD_NOTIFICATIONS_COUNT_PATTERN.format(user_id=self.bob.id), -1)
+        Notification.objects.filter(recipient=self.ann).update(unread=True)
+        for user in users:
+            NotificationService.get_unread_count(user.id)
+        with self.assertNumQueries(2):
+            msg = reconcile_unread_counts_task()
+        self.assertEqual(msg, '6 users reconciled.')
+        self.assertEqual(int(conn.get(key)), 4)
+        with self.assertNumQueries(0):
+            self.assertEqual(NotificationService.get_unread_count(self.bob.id), 0)
+
+    @override_settings(NOTIFICATION_COALESCING=True)
+    def test_coalesce_notifications(self):
+        users = [self.create_user(f'user{i}') for i in range(7)]
+        bob_tweet = self.create_tweet(self.bob)
+        for user in users:
+            NotificationService.send_like_notification(self.create_like(user, self.ann_tweet))
+        NotificationService.send_like_notification(self.create_like(self.ann, bob_tweet))
+        for user in users[:2] + users[:2]:
+            NotificationService.send_comment_notification(self.create_comment(user, self.ann_tweet))
+        # nothing is written until the buffers are flushed
+        self.assertEqual(Notification.objects.count(), 0)
+
+        # likes are read in 2 batches of NOTIFICATION_FLUSH_BATCH_SIZE, but coalesced across batches
+        self.assertEqual(flush_notification_buffers_task(), '3 notifications created.')
+        self.assertEqual(flush_notification_buffers_task(), '0 notifications created.')
+        notification = Notification.objects.get(recipient=self.ann, verb='liked your tweet')
+        self.assertEqual(notification.data['actor_count'], 7)
+        # the latest actor is shown
+        self.assertEqual(notification.actor, users[-1])
+        notification = Notification.objects.get(recipient=self.ann, verb='commented your tweet')
+        self.assertEqual(notification.data['actor_count'], 2)
+        self.assertEqual(Notification.objects.filter(recipient=self.bob).count(), 1)
+
+    @override_settings(NOTIFICATION_COALESCING=True)
+    def test_flush_notification_buffers_retry(self):
+        NotificationService.send_like_notification(self.create_like(self.bob, self.ann_tweet))
+        with mock.patch.object(
+            Notification.objects,
+            'bulk_create',
+            side_effect=DatabaseError('deadlock'),
+        ):
+            with self.assertRaises(DatabaseError):
+                NotificationService.flush_notification_buffers()
+        self.assertEqual(Notification.objects.count(), 0)
+
+        # likes in the next window don't overwrite the ids that failed to be delivered
+        NotificationService.send_like_notification(self.create_like(self.ann, self.ann_tweet))
+        self.assertEqual(NotificationService.flush_notification_buffers(), 1)
+        self.assertEqual(Notification.objects.get(recipient=self.ann).actor, self.bob)
+        self.assertEqual(NotificationService.flush_notification_buffers(), 0)
@@ -1,18 +1,27 @@
-from accounts.api.serializers import UserSerializerForLike
+from accounts.api.serializers import UserCardSerializer, UserSerializerForLike
 from comments.models import Comment
 from django.contrib.contenttypes.models import ContentType
+from django.db import models
 from likes.models import Like
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from tweets.models import Tweet
 
 
+class LikeListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        likes = list(data.all() if isinstance(data, models.Manager) else data)
+        UserCardSerializer.prefetch([like.user_id for like in likes], self.context)
+        return super(LikeListSerializer, self).to_representation(likes)
+
+
 class LikeSerializer(serializers.ModelSerializer):
-    user = UserSerializerForLike(source='cached_user')
+    user = UserSerializerForLike(source='user_id')
 
     class Meta:
         model = Like
         fields = ('user', 'created_at')
+        list_serializer_class = LikeListSerializer
 
 
 class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
@@ -6,12 +6,12 @@ from likes.api.serializers import (
     LikeSerializerForCreate,
 )
 from likes.models import Like
-from ratelimit.decorators import ratelimit
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from utils.decorators import required_params
+from utils.ratelimit import ratelimit
 
 
 class LikeViewSet(viewsets.GenericViewSet):
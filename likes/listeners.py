@@ -1,14 +1,26 @@
+from django.conf import settings
 from utils.redis_helper import RedisHelper
 
 
 def incr_likes_count(sender, instance, created, **kwargs):
+    from django.contrib.contenttypes.models import ContentType
     from django.db.models import F
+    from likes.services import LikeService
 
     if not created:
         return
 
+    LikeService.add_to_user_liked_set(instance)
+    LikeService.push_like_to_cache(instance)
+    # get_for_id 会使用 ContentType 的进程内缓存，不会每次都去查 db
+    model_class = ContentType.objects.get_for_id(instance.content_type_id).model_class()  # Tweet or Comment class
+    if settings.COUNTER_WRITE_BEHIND:
+        # 热门内容会有大量的 like 同时去 UPDATE 同一行，write-behind 模式下只写 Redis，
+        # 由 likes.tasks.flush_likes_count_task 定期把增量批量写回 MySQL
+        RedisHelper.incr_count_write_behind(model_class, instance.object_id, 'likes_count')
+        return
+
     # Method 1:
-    model_class = instance.content_type.model_class()  # Tweet or Comment class
     # SQL -> UPDATE likes_count = likes_count + 1 FROM table_name WHERE id=object_id;
     # 这句话会触发 MySQL 的行锁，保证数据的原子性
     model_class.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') + 1)
@@ -21,8 +33,22 @@ def incr_likes_count(sender, instance, created, **kwargs):
 
 
 def decr_likes_count(sender, instance, **kwargs):
+    from django.contrib.contenttypes.models import ContentType
     from django.db.models import F
+    from likes.services import LikeService
+
+    LikeService.remove_from_user_liked_set(instance)
+    model_class = ContentType.objects.get_for_id(instance.content_type_id).model_class()
+    if settings.COUNTER_WRITE_BEHIND:
+        RedisHelper.incr_count_write_behind(model_class, instance.object_id, 'likes_count', -1)
+        return
 
-    model_class = instance.content_type.model_class()
     model_class.objects.filter(id=instance.object_id).update(likes_count=F('likes_count') - 1)
     RedisHelper.decr_count(instance.content_object, 'likes_count')
+
+
+def invalidate_likes_cache(sender, instance, **kwargs):
+    from likes.services import LikeService
+
+    # 删除之后再去掉 cache，避免删除之前又被重新加载进 cache
+    LikeService.invalidate_likes_cache(instance)
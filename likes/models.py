@@ -2,8 +2,8 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models.signals import pre_delete, post_save
-from likes.listeners import incr_likes_count, decr_likes_count
+from django.db.models.signals import post_delete, post_save, pre_delete
+from likes.listeners import decr_likes_count, incr_likes_count, invalidate_likes_cache
 from utils.memcached_helper import MemcachedHelper
 
 
@@ -52,3 +52,4 @@ class Like(models.Model):
 
 pre_delete.connect(decr_likes_count, sender=Like)
 post_save.connect(incr_likes_count, sender=Like)
+post_delete.connect(invalidate_likes_cache, sender=Like)
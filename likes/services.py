@@ -1,5 +1,34 @@
-from likes.models import Like
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from likes.models import Like
+from twitter.cache import OBJECT_LIKES_PATTERN, USER_LIKED_PATTERN
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.time_helpers import datetime_to_timestamp
+
+# user_liked 是一个 sorted set，member 是 object_id，score 是 like 的时间
+# 两个特殊 member 的 score 是 +inf，排在最后，trim 的时候不会被删除，object_id 都是正整数，不会冲突
+# LOADED: set 已经从 db 加载过了
+# TRUNCATED: 用户 like 过的 objects 超过了 USER_LIKED_CACHE_LIMIT，set 里只有最近的一部分
+LOADED_SENTINEL = 0
+TRUNCATED_SENTINEL = -1
+
+# set 存在的时候加入一个 like，超过 limit 的时候删除最早的 likes 并且标记为 TRUNCATED，同时刷新过期时间
+# KEYS[1]: user_liked key, ARGV[1]: object_id, ARGV[2]: score, ARGV[3]: limit, ARGV[4]: expire time
+ADD_USER_LIKED_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+local size = redis.call('ZCARD', KEYS[1]) - redis.call('ZCOUNT', KEYS[1], '+inf', '+inf')
+local limit = tonumber(ARGV[3])
+if size > limit then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, size - limit - 1)
+    redis.call('ZADD', KEYS[1], '+inf', '%d')
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+""" % TRUNCATED_SENTINEL
 
 
 class LikeService(object):
@@ -8,8 +37,134 @@ class LikeService(object):
         # 当前用户如果没有登陆
         if user.is_anonymous:
             return False
-        return Like.objects.filter(
-            content_type=ContentType.objects.get_for_model(target.__class__),
+        return cls.has_liked_many(user, [target]).get(target.id, False)
+
+    @classmethod
+    def has_liked_many(cls, user, targets):
+        """
+        批量判断 user 是否 like 了 targets，targets 必须是同一个 model 的 instances
+        返回 {target_id: True / False}
+        """
+        targets = [target for target in targets if target is not None]
+        if user.is_anonymous or not targets:
+            return {target.id: False for target in targets}
+
+        content_type = ContentType.objects.get_for_model(targets[0].__class__)
+        object_ids = list({target.id for target in targets})
+        if not settings.USER_LIKED_CACHE_ENABLED:
+            liked_ids = cls._get_liked_ids_from_db(user.id, content_type.id, object_ids)
+            return {object_id: object_id in liked_ids for object_id in object_ids}
+
+        # 一次 ZMSCORE 同时拿到 sentinels 和这一页所有 targets 的结果，不是 member 的时候是 None
+        key = cls.get_user_liked_key(user.id, content_type.id)
+        conn = RedisClient.get_connection()
+        members = [LOADED_SENTINEL, TRUNCATED_SENTINEL] + object_ids
+        loaded, truncated, *results = conn.execute_command('ZMSCORE', key, *members)
+        if loaded is None:
+            truncated = cls._load_user_liked_set(user.id, content_type.id)
+            results = conn.execute_command('ZMSCORE', key, *object_ids)
+
+        has_liked = {
+            object_id: result is not None
+            for object_id, result in zip(object_ids, results)
+        }
+        # set 里只有最近的 likes，不在 set 里的 objects 需要回到 db 确认
+        missed_ids = [object_id for object_id in object_ids if not has_liked[object_id]]
+        if truncated and missed_ids:
+            liked_ids = cls._get_liked_ids_from_db(user.id, content_type.id, missed_ids)
+            for object_id in liked_ids:
+                has_liked[object_id] = True
+        return has_liked
+
+    @classmethod
+    def get_user_liked_key(cls, user_id, content_type_id):
+        return USER_LIKED_PATTERN.format(user_id=user_id, content_type_id=content_type_id)
+
+    @classmethod
+    def _get_liked_ids_from_db(cls, user_id, content_type_id, object_ids):
+        return set(Like.objects.filter(
+            user_id=user_id,
+            content_type_id=content_type_id,
+            object_id__in=object_ids,
+        ).values_list('object_id', flat=True))
+
+    @classmethod
+    def _load_user_liked_set(cls, user_id, content_type_id):
+        # 用 <user, content_type, created_at> 的索引取最近的 likes，返回 set 是否被截断
+        # set 之后会被增量更新，从 primary 读
+        limit = settings.USER_LIKED_CACHE_LIMIT
+        likes = list(Like.objects.using('default').filter(
+            user_id=user_id,
+            content_type_id=content_type_id,
+        ).order_by('-created_at').values_list('object_id', 'created_at')[:limit + 1])
+        truncated = len(likes) > limit
+        members = {
+            object_id: datetime_to_timestamp(created_at)
+            for object_id, created_at in likes[:limit]
+        }
+        members[LOADED_SENTINEL] = float('inf')
+        if truncated:
+            members[TRUNCATED_SENTINEL] = float('inf')
+
+        key = cls.get_user_liked_key(user_id, content_type_id)
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        pipe.zadd(key, members)
+        pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipe.execute()
+        return truncated
+
+    @classmethod
+    def get_cached_likes(cls, target, limit=None):
+        # 使用 (content_type, object_id, created_at) 的索引，最新的 likes 在最前面
+        content_type = ContentType.objects.get_for_model(target.__class__)
+        queryset = Like.objects.filter(
+            content_type=content_type,
             object_id=target.id,
-            user=user,
-        ).exists()
+        ).order_by('-created_at', '-id')
+        key = cls.get_object_likes_key(content_type.id, target.id)
+        return RedisHelper.load_objects(key, queryset, limit=limit)
+
+    @classmethod
+    def get_object_likes_key(cls, content_type_id, object_id):
+        return OBJECT_LIKES_PATTERN.format(content_type_id=content_type_id, object_id=object_id)
+
+    @classmethod
+    def push_like_to_cache(cls, like):
+        queryset = Like.objects.filter(
+            content_type_id=like.content_type_id,
+            object_id=like.object_id,
+        ).order_by('-created_at', '-id')
+        key = cls.get_object_likes_key(like.content_type_id, like.object_id)
+        RedisHelper.push_object(key, like, queryset)
+
+    @classmethod
+    def invalidate_likes_cache(cls, like):
+        key = cls.get_object_likes_key(like.content_type_id, like.object_id)
+        RedisClient.get_connection().delete(key)
+
+    # CREATE & DELETE like will call these methods
+    @classmethod
+    def add_to_user_liked_set(cls, like):
+        if not settings.USER_LIKED_CACHE_ENABLED or like.user_id is None:
+            return
+        # set 不存在的时候不需要更新，下次读的时候会从 db 加载
+        RedisHelper.get_script(ADD_USER_LIKED_SCRIPT)(
+            keys=[cls.get_user_liked_key(like.user_id, like.content_type_id)],
+            args=[
+                like.object_id,
+                datetime_to_timestamp(like.created_at),
+                settings.USER_LIKED_CACHE_LIMIT,
+                settings.REDIS_KEY_EXPIRE_TIME,
+            ],
+        )
+
+    @classmethod
+    def remove_from_user_liked_set(cls, like):
+        if not settings.USER_LIKED_CACHE_ENABLED or like.user_id is None:
+            return
+        key = cls.get_user_liked_key(like.user_id, like.content_type_id)
+        conn = RedisClient.get_connection()
+        # 删除之后 set 不会变长，TRUNCATED 的标记保持不变，set 之外的 likes 仍然会回到 db 确认
+        if conn.zrem(key, like.object_id):
+            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
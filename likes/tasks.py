@@ -0,0 +1,14 @@
+from celery import shared_task
+from comments.models import Comment
+from tweets.models import Tweet
+from utils.redis_helper import RedisHelper
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_likes_count_task():
+    # write-behind 模式下把 Redis 里累积的 likes_count 增量批量写回 MySQL
+    flushed_count = 0
+    for model_class in [Tweet, Comment]:
+        flushed_count += RedisHelper.flush_count_deltas(model_class, 'likes_count')
+    return '{} likes_count flushed.'.format(flushed_count)
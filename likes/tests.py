@@ -0,0 +1,100 @@
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.contenttypes.models import ContentType
+from django.test import override_settings
+from likes.models import Like
+from likes.services import LOADED_SENTINEL, TRUNCATED_SENTINEL, LikeService
+from testing.testcases import TestCase
+from tweets.models import Tweet
+from utils.redis_client import RedisClient
+
+
+class LikeServiceTests(TestCase):
+    def setUp(self):
+        self.clear_cache()
+        self.ann = self.create_user('ann')
+        self.bob = self.create_user('bob')
+
+    def test_has_liked_many(self):
+        tweets = [self.create_tweet(self.ann) for _ in range(3)]
+        comment = self.create_comment(self.ann, tweets[0])
+        self.create_like(self.bob, tweets[0])
+        self.create_like(self.bob, comment)
+
+        has_liked = LikeService.has_liked_many(self.bob, tweets)
+        self.assertEqual(has_liked, {
+            tweets[0].id: True,
+            tweets[1].id: False,
+            tweets[2].id: False,
+        })
+        self.assertEqual(LikeService.has_liked_many(self.ann, tweets), {
+            tweet.id: False for tweet in tweets
+        })
+        self.assertEqual(LikeService.has_liked(self.bob, comment), True)
+        self.assertEqual(LikeService.has_liked(self.ann, comment), False)
+
+        # set is loaded, listeners keep it up to date
+        key = LikeService.get_user_liked_key(
+            self.bob.id,
+            ContentType.objects.get_for_model(Tweet).id,
+        )
+        self.assertEqual(RedisClient.get_connection().exists(key), 1)
+        self.create_like(self.bob, tweets[1])
+        Like.objects.filter(
+            user=self.bob,
+            content_type__model='tweet',
+            object_id=tweets[0].id,
+        ).delete()
+        has_liked = LikeService.has_liked_many(self.bob, tweets)
+        self.assertEqual(has_liked, {
+            tweets[0].id: False,
+            tweets[1].id: True,
+            tweets[2].id: False,
+        })
+
+        # anonymous user
+        self.assertEqual(LikeService.has_liked_many(AnonymousUser(), tweets), {
+            tweet.id: False for tweet in tweets
+        })
+
+    @override_settings(USER_LIKED_CACHE_LIMIT=3)
+    def test_has_liked_many_truncated(self):
+        tweets = [self.create_tweet(self.ann) for _ in range(5)]
+        for tweet in tweets:
+            self.create_like(self.bob, tweet)
+        other_tweet = self.create_tweet(self.ann)
+
+        # only the latest 3 likes are cached, the older ones fall back to db
+        has_liked = LikeService.has_liked_many(self.bob, tweets + [other_tweet])
+        self.assertEqual(has_liked, {
+            **{tweet.id: True for tweet in tweets},
+            other_tweet.id: False,
+        })
+
+    @override_settings(USER_LIKED_CACHE_LIMIT=3)
+    def test_user_liked_set_bounded_on_write(self):
+        tweets = [self.create_tweet(self.ann) for _ in range(5)]
+        self.create_like(self.bob, tweets[0])
+        # load the set, it is not truncated yet
+        self.assertEqual(LikeService.has_liked(self.bob, tweets[0]), True)
+        key = LikeService.get_user_liked_key(self.bob.id, ContentType.objects.get_for_model(Tweet).id)
+        conn = RedisClient.get_connection()
+        conn.expire(key, 10)
+
+        for tweet in tweets[1:]:
+            self.create_like(self.bob, tweet)
+        # only the latest 3 likes are kept, the expire time is refreshed
+        self.assertEqual(
+            [int(member) for member in conn.zrange(key, 0, -1)],
+            [tweet.id for tweet in tweets[2:]] + [TRUNCATED_SENTINEL, LOADED_SENTINEL],
+        )
+        self.assertEqual(conn.ttl(key) > 10, True)
+        # the trimmed likes fall back to db
+        has_liked = LikeService.has_liked_many(self.bob, tweets)
+        self.assertEqual(has_liked, {tweet.id: True for tweet in tweets})
+
+    @override_settings(USER_LIKED_CACHE_ENABLED=False)
+    def test_has_liked_many_without_cache(self):
+        tweets = [self.create_tweet(self.ann) for _ in range(2)]
+        self.create_like(self.bob, tweets[1])
+        has_liked = LikeService.has_liked_many(self.bob, tweets)
+        self.assertEqual(has_liked, {tweets[0].id: False, tweets[1].id: True})
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from newsfeeds.models import NewsFeed
+from newsfeeds.models import NewsFeed, NewsFeedTrimWatermark
 
 
 @admin.register(NewsFeed)
@@ -7,3 +7,7 @@ class NewsFeedAdmin(admin.ModelAdmin):
     list_display = ('user', 'tweet', 'created_at')
     date_hierarchy = 'created_at'
 
+
+@admin.register(NewsFeedTrimWatermark)
+class NewsFeedTrimWatermarkAdmin(admin.ModelAdmin):
+    list_display = ('user', 'trimmed_until')
@@ -1,6 +1,16 @@
 from rest_framework import serializers
 from newsfeeds.models import NewsFeed
-from tweets.api.serializers import TweetSerializer
+from tweets.api.serializers import TweetListSerializer, TweetSerializer
+
+
+class NewsFeedListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        newsfeeds = list(data)
+        TweetListSerializer.prefetch(
+            [newsfeed.cached_tweet for newsfeed in newsfeeds],
+            self.context,
+        )
+        return super(NewsFeedListSerializer, self).to_representation(newsfeeds)
 
 
 class NewsFeedSerializer(serializers.ModelSerializer):
@@ -9,3 +19,4 @@ class NewsFeedSerializer(serializers.ModelSerializer):
     class Meta:
         model = NewsFeed
         fields = ('id', 'created_at', 'user', 'tweet',)
+        list_serializer_class = NewsFeedListSerializer
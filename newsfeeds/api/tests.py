@@ -1,9 +1,18 @@
+from datetime import timedelta
 from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import override_settings
 from friendships.models import Friendship
+from newsfeeds.hbase_models import HBaseNewsFeed
 from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
+from newsfeeds.tasks import trim_newsfeeds_task
 from testing.testcases import TestCase
+from tweets.models import Tweet
+from twitter.cache import USER_NEWSFEEDS_PATTERN
 from utils.paginations import EndlessPagination
+from utils.redis_client import RedisClient
+from utils.time_helpers import utc_now
 
 NEWSFEEDS_URL = '/api/newsfeeds/'
 POST_TWEET_URL = '/api/tweets/'
@@ -12,7 +21,7 @@ FOLLOW_URL = '/api/friendships{}/follow/'
 
 class NewsFeedApiTests(TestCase):
     def setUp(self):
-        self.clear_cache()
+        super(NewsFeedApiTests, self).setUp()
         self.make_up_friendships()
 
     def test_list(self):
@@ -184,3 +193,96 @@ class NewsFeedApiTests(TestCase):
 
         # mock cache expired
         _test_newsfeeds_after_new_feed_pushed()
+
+    @override_settings(
+        NEWSFEED_HBASE_DUAL_WRITE=True,
+        NEWSFEED_READ_FROM_HBASE=True,
+        NEWSFEED_WRITE_TO_MYSQL=False,
+    )
+    def test_hbase_pagination_beyond_cache(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        page_size = EndlessPagination.page_size
+        tweet_ids = []
+        for i in range(list_limit + page_size // 2):
+            tweet = self.create_tweet(self.bob, f'feed{i}')
+            NewsFeedService.create_newsfeed(self.ann.id, tweet.id)
+            tweet_ids.append(tweet.id)
+        tweet_ids = tweet_ids[::-1]
+        self.assertEqual(NewsFeed.objects.count(), 0)
+
+        results, cursor = [], None
+        while True:
+            response = self.ann_client.get(NEWSFEEDS_URL, {'cursor': cursor} if cursor else {})
+            results.extend(response.data['results'])
+            if not response.data['has_next_page']:
+                break
+            cursor = response.data['next_cursor']
+        self.assertEqual([result['tweet']['id'] for result in results], tweet_ids)
+
+    @override_settings(
+        NEWSFEED_HBASE_DUAL_WRITE=True,
+        NEWSFEED_READ_FROM_HBASE=True,
+        NEWSFEED_WRITE_TO_MYSQL=False,
+    )
+    def test_hbase_pagination_in_the_same_microsecond(self):
+        # every newsfeed has the same created_at, pages are split by tweet_id
+        created_at = utc_now()
+        tweet_ids = []
+        for i in range(settings.REDIS_LIST_LENGTH_LIMIT + EndlessPagination.page_size // 2):
+            tweet_ids.append(self.create_tweet(self.bob, f'feed{i}').id)
+        HBaseNewsFeed.batch_create([
+            NewsFeedService.get_hbase_row(NewsFeed(user_id=self.ann.id, tweet_id=tweet_id, created_at=created_at))
+            for tweet_id in tweet_ids
+        ])
+        self.clear_cache()
+
+        results, cursor = [], None
+        while True:
+            response = self.ann_client.get(NEWSFEEDS_URL, {'cursor': cursor} if cursor else {})
+            results.extend(response.data['results'])
+            if not response.data['has_next_page']:
+                break
+            cursor = response.data['next_cursor']
+        self.assertEqual([result['tweet']['id'] for result in results], tweet_ids[::-1])
+
+    @override_settings(NEWSFEED_RETENTION_COUNT=3, NEWSFEED_RETENTION_DAYS=1)
+    def test_trim_newsfeeds_and_older_history(self):
+        self.create_friendship(self.ann, self.bob)
+        tweets, newsfeeds = [], []
+        for i in range(6):
+            tweet = self.create_tweet(self.bob, f'tweet{i}')
+            tweets.append(tweet)
+            newsfeeds.append(self.create_newsfeed(self.ann, tweet))
+        # the first 4 tweets were posted 2 days ago
+        two_days_ago = utc_now() - timedelta(days=2)
+        for i in range(4):
+            created_at = two_days_ago + timedelta(seconds=i)
+            Tweet.objects.filter(id=tweets[i].id).update(created_at=created_at)
+            NewsFeed.objects.filter(id=newsfeeds[i].id).update(created_at=created_at)
+        self.clear_cache()
+
+        # only the newest 3 newsfeeds or the ones within 1 day are kept, 2 rows per DELETE
+        msg = trim_newsfeeds_task()
+        self.assertEqual(msg, '{} users trimmed, 3 newsfeeds deleted.'.format(User.objects.count()))
+        self.assertEqual(
+            list(NewsFeed.objects.filter(user=self.ann).values_list('tweet_id', flat=True)),
+            [tweets[5].id, tweets[4].id, tweets[3].id],
+        )
+
+        # older history comes from the tweets of followings
+        response = self.ann_client.get(NEWSFEEDS_URL)
+        self.assertEqual(
+            [result['tweet']['id'] for result in response.data['results']],
+            [tweet.id for tweet in tweets[::-1]],
+        )
+        self.assertEqual(response.data['has_next_page'], False)
+        # user who doesn't have trimmed newsfeeds
+        response = self.bob_client.get(NEWSFEEDS_URL)
+        self.assertEqual(len(response.data['results']), 0)
+
+    def test_trim_extended_cache(self):
+        conn = RedisClient.get_connection()
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=self.ann.id)
+        conn.rpush(key, *range(settings.REDIS_LIST_LENGTH_LIMIT + 5))
+        trim_newsfeeds_task()
+        self.assertEqual(conn.llen(key), settings.REDIS_LIST_LENGTH_LIMIT)
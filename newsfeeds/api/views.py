@@ -1,11 +1,14 @@
+from django.conf import settings
 from django.utils.decorators import method_decorator
 from newsfeeds.api.serializers import NewsFeedSerializer
 from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
-from ratelimit.decorators import ratelimit
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
+from twitter.cache import USER_NEWSFEEDS_PATTERN
+from utils.decorators import read_from_replica
 from utils.paginations import EndlessPagination
+from utils.ratelimit import ratelimit
 
 
 class NewsFeedViewSet(viewsets.GenericViewSet):
@@ -20,14 +23,43 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
         return NewsFeed.objects.filter(user=self.request.user)
 
     @method_decorator(ratelimit(key='user', rate='5/s', method='GET', block=True))
+    @read_from_replica
     def list(self, request):
         # 因为做了 cache 长度限制，因此这里的 cached_newsfeeds 有可能是最新的 limit 个数据而不是全部数据
         cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
-        # page == None 是因为请求的数据不在 cache 里，需要直接去 DB 里获取
-        if page is None:
-            queryset = NewsFeed.objects.filter(user=request.user)
-            page = self.paginate_queryset(queryset)
+        if settings.NEWSFEED_READ_FROM_HBASE:
+            # 不在 cache 里的部分从 HBase 里 scan，HBase 里的 newsfeeds 没有 id，按 (created_at, tweet_id) 翻页
+            self.paginator.id_field = 'tweet_id'
+            page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
+            if page is None:
+                page = self.paginator.paginate_by_created_at(
+                    lambda created_at__lt, tweet_id__lt, limit: NewsFeedService.get_hbase_newsfeeds(
+                        request.user.id,
+                        created_at__lt=created_at__lt,
+                        tweet_id__lt=tweet_id__lt,
+                        limit=limit,
+                    ),
+                    request,
+                )
+        else:
+            # 请求的数据不在 cache 里的部分从 DB 里接着获取，并延长 cache 里的 list
+            page = self.paginator.paginate_cached_list(
+                cached_newsfeeds,
+                request,
+                queryset=NewsFeed.objects.filter(user=request.user),
+                cache_key=USER_NEWSFEEDS_PATTERN.format(user_id=request.user.id),
+            )
+            if not self.paginator.has_next_page and 'created_at__gt' not in request.query_params:
+                # 保留的 newsfeeds 已经翻完了，更早的内容从 followings 的 tweets 里按需获取
+                page = self.paginator.paginate_after_page(
+                    page,
+                    request,
+                    lambda created_at__lt, object_id__lt, limit: NewsFeedService.get_older_newsfeeds(
+                        request.user.id,
+                        created_at__lt,
+                        limit,
+                    ),
+                )
         serializer = NewsFeedSerializer(
             page,
             context={'request': request},
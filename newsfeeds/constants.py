@@ -1,3 +1,7 @@
 from django.conf import settings
 
 FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+# retention 每次处理多少个 users，每个 DELETE 最多删除多少行，每个 user 每次 task 最多 DELETE 多少次
+RETENTION_USER_BATCH_SIZE = 1000 if not settings.TESTING else 3
+RETENTION_DELETE_CHUNK_SIZE = 500 if not settings.TESTING else 2
+RETENTION_MAX_CHUNKS_PER_USER = 100 if not settings.TESTING else 2
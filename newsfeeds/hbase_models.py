@@ -0,0 +1,27 @@
+from django.conf import settings
+from django_hbase import models
+
+
+class HBaseNewsFeed(models.HBaseModel):
+    """
+    存储 user_id 能看到的 newsfeeds，row_key 按照 user_id + created_at + tweet_id 排序
+    可以支持查询：
+        - A 的 newsfeeds 按照时间倒序翻页
+        - A 在某个时间点之前的前 X 条 newsfeeds
+    每个 user 的 newsfeeds 都在一段连续的 row keys 里，不会像 MySQL 的 (user, created_at) 索引一样
+    随着总行数越来越深。过期的 newsfeeds 由 column family 的 TTL 自动删除
+    同一个 user 在同一个 microsecond 可能收到不同 tweets 的 newsfeeds，row key 的最后加上 tweet_key
+    （就是 tweet_id）保证每个 (user, tweet) 的 row key 不同，不会互相覆盖
+    HBase 的 row 至少要有一个 column，所以 tweet_id 同时也存在 column 里
+    """
+    # row key
+    user_id = models.IntegerField(reverse=True)
+    created_at = models.TimestampField()
+    tweet_key = models.IntegerField()
+    # column key
+    tweet_id = models.IntegerField(column_family='cf')
+
+    class Meta:
+        table_name = 'twitter_newsfeeds'
+        row_key = ('user_id', 'created_at', 'tweet_key',)
+        ttl = settings.NEWSFEED_HBASE_TTL
@@ -1,3 +1,6 @@
+from django.conf import settings
+
+
 def push_newsfeeds_to_cache(sender, instance, created, **kwargs):
     # if we changed the newsfeeds, it'll trigger post_save, because e.g.
     # newsfeed1.tweet = tweet1 -> newsfeed1.save()
@@ -5,5 +8,9 @@ def push_newsfeeds_to_cache(sender, instance, created, **kwargs):
     if not created:
         return
 
+    # 从 HBase 读的时候由 NewsFeedService.create_newsfeed 在写完 HBase 之后 push
+    if settings.NEWSFEED_READ_FROM_HBASE:
+        return
+
     from newsfeeds.services import NewsFeedService
     NewsFeedService.push_newsfeed_to_cache(instance)
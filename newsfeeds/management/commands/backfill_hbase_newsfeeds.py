@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from newsfeeds.hbase_models import HBaseNewsFeed
+from newsfeeds.models import NewsFeed
+from newsfeeds.services import NewsFeedService
+
+
+class Command(BaseCommand):
+    help = 'Copy MySQL newsfeeds into HBaseNewsFeed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        # 中途失败的时候可以从上一次输出的 id 继续
+        parser.add_argument('--start-id', type=int, default=0)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = options['start_id']
+        total = 0
+        while True:
+            # 按主键 keyset 翻页，不使用 OFFSET
+            newsfeeds = list(
+                NewsFeed.objects.filter(id__gt=last_id).order_by('id')[:batch_size]
+            )
+            if not newsfeeds:
+                break
+            hbase_rows = [
+                NewsFeedService.get_hbase_row(newsfeed)
+                for newsfeed in newsfeeds
+                if newsfeed.user_id is not None and newsfeed.tweet_id is not None
+            ]
+            # 写入是幂等的，重复执行只会覆盖相同的 row
+            HBaseNewsFeed.batch_create(hbase_rows, batch_size=batch_size)
+
+            total += len(hbase_rows)
+            last_id = newsfeeds[-1].id
+            self.stdout.write('{} newsfeeds backfilled, last id {}'.format(total, last_id))
+        self.stdout.write(self.style.SUCCESS('Done, {} newsfeeds backfilled.'.format(total)))
@@ -22,7 +22,22 @@ class NewsFeed(models.Model):
 
     @property
     def cached_tweet(self):
-        return MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
+        # 同一个 newsfeed 在 serialize 的时候会被访问多次，避免重复访问 memcached
+        if hasattr(self, '_cached_tweet'):
+            return self._cached_tweet
+        tweet = MemcachedHelper.get_object_through_cache(Tweet, self.tweet_id)
+        setattr(self, '_cached_tweet', tweet)
+        return tweet
+
+
+class NewsFeedTrimWatermark(models.Model):
+    # 每个被 trim 过的 user 一行，只有这些 users 的更早的 newsfeeds 需要从 followings 的 tweets 里获取
+    user = models.OneToOneField(User, on_delete=models.SET_NULL, null=True)
+    # trim_user_newsfeeds 删除过的最新的 newsfeed 的 created_at
+    trimmed_until = models.DateTimeField()
+
+    def __str__(self):
+        return f'newsfeeds of {self.user} trimmed until {self.trimmed_until}'
 
 
 post_save.connect(push_newsfeeds_to_cache, sender=NewsFeed)
@@ -1,7 +1,42 @@
-from newsfeeds.models import NewsFeed
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import Count, Q
+from friendships.services import FriendshipService
+from newsfeeds.constants import (
+    RETENTION_DELETE_CHUNK_SIZE,
+    RETENTION_MAX_CHUNKS_PER_USER,
+    RETENTION_USER_BATCH_SIZE,
+)
+from newsfeeds.hbase_models import HBaseNewsFeed
+from newsfeeds.models import NewsFeed, NewsFeedTrimWatermark
 from newsfeeds.tasks import fanout_newsfeeds_main_task
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from tweets.models import Tweet
+from twitter.cache import USER_NEWSFEEDS_PATTERN, USER_TWEETS_PATTERN
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
+from utils.time_helpers import (
+    MAX_TIMESTAMP,
+    datetime_to_timestamp,
+    timestamp_to_datetime,
+    utc_now,
+)
+
+import time
+
+
+class HBaseNewsFeedList:
+    """
+    一个 user 在 HBase 里按时间倒序的 newsfeeds，和 queryset 一样是 lazy 的，
+    只支持 RedisHelper 加载 cache 时用到的 [:limit]，每次是 1 次 reverse scan
+    """
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.start or item.step:
+            raise TypeError('only [:limit] is supported')
+        return NewsFeedService.get_hbase_newsfeeds(self.user_id, limit=item.stop)
 
 
 class NewsFeedService(object):
@@ -19,11 +54,17 @@ class NewsFeedService(object):
         # 如何 serialize Tweet。
         fanout_newsfeeds_main_task.delay(tweet.id, tweet.user_id)
 
+    @classmethod
+    def get_newsfeeds_source(cls, user_id):
+        # cache miss 的时候从哪里加载 newsfeeds，按 (created_at, id) 倒序
+        if settings.NEWSFEED_READ_FROM_HBASE:
+            return HBaseNewsFeedList(user_id)
+        return NewsFeed.objects.filter(user_id=user_id).order_by('-created_at', '-id')
+
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
-        queryset = NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, queryset)
+        return RedisHelper.load_objects(key, cls.get_newsfeeds_source(user_id))
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
@@ -31,6 +72,204 @@ class NewsFeedService(object):
         # 因为有可能存的时候 newsfeeds list 已经过期了，这时候我们需要把整个 queryset 取到的 newsfeeds
         # 全部存入 cache，这其中也包括了当前的 newsfeed。如果当前用户的 newsfeeds list 没有过期，
         # 直接 serialize 当前的 newsfeed 然后 lpush 进 cache 就行了。
-        queryset = NewsFeed.objects.filter(user_id=newsfeed.user_id).order_by('-created_at')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(key, newsfeed, queryset)
+        RedisHelper.push_object(key, newsfeed, cls.get_newsfeeds_source(newsfeed.user_id))
+
+    @classmethod
+    def create_newsfeed(cls, user_id, tweet_id):
+        if settings.NEWSFEED_WRITE_TO_MYSQL:
+            # 从 MySQL 读的时候 post_save 的 listener 会 push 到 cache 里
+            newsfeed = NewsFeed.objects.create(user_id=user_id, tweet_id=tweet_id)
+        else:
+            newsfeed = NewsFeed(user_id=user_id, tweet_id=tweet_id, created_at=utc_now())
+        if settings.NEWSFEED_HBASE_DUAL_WRITE:
+            cls.get_hbase_row(newsfeed).save()
+        # 从 HBase 读的时候 cache miss 会从 HBase 重新加载，所以要等 HBase 写完之后再 push
+        if settings.NEWSFEED_READ_FROM_HBASE or not settings.NEWSFEED_WRITE_TO_MYSQL:
+            cls.push_newsfeed_to_cache(newsfeed)
+        return newsfeed
+
+    @classmethod
+    def batch_create_newsfeeds(cls, user_ids, tweet_id):
+        newsfeeds = [
+            NewsFeed(user_id=user_id, tweet_id=tweet_id)
+            for user_id in user_ids
+        ]
+        if settings.NEWSFEED_WRITE_TO_MYSQL:
+            NewsFeed.objects.bulk_create(newsfeeds)
+        else:
+            created_at = utc_now()
+            for newsfeed in newsfeeds:
+                newsfeed.created_at = created_at
+        if settings.NEWSFEED_HBASE_DUAL_WRITE:
+            HBaseNewsFeed.batch_create([cls.get_hbase_row(newsfeed) for newsfeed in newsfeeds])
+
+        # bulk create 不会触发 post_save 的 signal，所以需要手动 push 到 cache 里
+        for newsfeed in newsfeeds:
+            cls.push_newsfeed_to_cache(newsfeed)
+        return newsfeeds
+
+    @classmethod
+    def get_hbase_row(cls, newsfeed):
+        return HBaseNewsFeed(
+            user_id=newsfeed.user_id,
+            created_at=datetime_to_timestamp(newsfeed.created_at),
+            tweet_key=newsfeed.tweet_id,
+            tweet_id=newsfeed.tweet_id,
+        )
+
+    @classmethod
+    def get_hbase_newsfeeds(cls, user_id, created_at__lt=None, tweet_id__lt=None, limit=None):
+        """
+        在 (user_id,) 的范围内按 (created_at, tweet_id) 倒序 scan，从 (created_at__lt, tweet_id__lt) 之后开始
+        同一个 microsecond 可能有多个 newsfeeds，只给 created_at__lt 的时候跳过这个 created_at 的所有 rows
+        """
+        if created_at__lt is None:
+            start = (user_id, MAX_TIMESTAMP)
+        elif not tweet_id__lt:
+            # (user_id, created_at) 的 prefix 比这个 created_at 的所有 rows 都小，不包括它们
+            start = (user_id, datetime_to_timestamp(created_at__lt))
+        else:
+            # reverse scan 包括 start 自己，从 tweet_id__lt - 1 开始才不会重复 cursor 所在的 row
+            start = (user_id, datetime_to_timestamp(created_at__lt), tweet_id__lt - 1)
+        hbase_rows = HBaseNewsFeed.filter(
+            start=start,
+            stop=(user_id,),
+            limit=limit,
+            reverse=True,
+        )
+        return cls.hbase_rows_to_newsfeeds(hbase_rows)
+
+    @classmethod
+    def hbase_rows_to_newsfeeds(cls, hbase_rows):
+        # HBase 里的 newsfeeds 没有 id，翻页的时候用 tweet_id 作为第二排序字段
+        return [
+            NewsFeed(
+                user_id=hbase_row.user_id,
+                tweet_id=hbase_row.tweet_id,
+                created_at=timestamp_to_datetime(hbase_row.created_at),
+            )
+            for hbase_row in hbase_rows
+        ]
+
+    @classmethod
+    def get_older_newsfeeds(cls, user_id, created_at__lt, limit):
+        """
+        MySQL 里只保留了最新的一部分 newsfeeds（见 trim_user_newsfeeds），翻过了保留的 newsfeeds 之后，
+        trim 掉的部分从 followings（包括自己）在 watermark 之前的 tweets 里按需获取，包装成没有保存的 NewsFeed
+        没有被 trim 过的 user 没有 watermark，也不会有更早的内容，返回 []
+        """
+        watermark = NewsFeedTrimWatermark.objects.filter(user_id=user_id).first()
+        if watermark is None:
+            return []
+
+        # watermark 之后的 newsfeeds 都还在 MySQL 里，只需要 watermark 之前的 tweets
+        tweets = Tweet.objects.filter(created_at__lte=watermark.trimmed_until)
+        if created_at__lt is not None:
+            tweets = tweets.filter(created_at__lt=created_at__lt)
+
+        user_ids = FriendshipService.get_following_user_id_set(user_id) | {user_id}
+        tweets = tweets.filter(user_id__in=user_ids).order_by('-created_at', '-id')[:limit]
+        newsfeeds = []
+        for tweet in tweets:
+            newsfeed = NewsFeed(user_id=user_id, tweet_id=tweet.id, created_at=tweet.created_at)
+            newsfeed._cached_tweet = tweet
+            newsfeeds.append(newsfeed)
+        return newsfeeds
+
+    @classmethod
+    def trim_user_newsfeeds(cls, user_id, deadline=None):
+        """
+        删除比最新的 NEWSFEED_RETENTION_COUNT 条更旧，并且在 NEWSFEED_RETENTION_DAYS 天之前的 newsfeeds
+        按 (created_at, id) 从旧到新每次删除 RETENTION_DELETE_CHUNK_SIZE 行，每个 DELETE 只锁住
+        (user, created_at) 索引上很小的一段，批次之间 sleep 一下给正常的写入让路
+        每次最多 DELETE RETENTION_MAX_CHUNKS_PER_USER 次，剩下的留给下一次 task，
+        每个 DELETE 之后检查 deadline (time.monotonic())，至少会删除一批，保证每次 task 都有进展
+        每次 DELETE 之前把这一批最新的 created_at 记到 user 的 NewsFeedTrimWatermark 里，
+        中途失败的时候只会多出一些重复的 newsfeeds，不会有缺失
+        返回 (删除了多少行, 是否在 deadline 之前结束)
+        """
+        queryset = NewsFeed.objects.filter(user_id=user_id)
+        keep = settings.NEWSFEED_RETENTION_COUNT
+        boundary = list(
+            queryset.order_by('-created_at', '-id').values_list('created_at', 'id')[keep:keep + 1]
+        )
+        if not boundary:
+            return 0, True
+
+        created_at, newsfeed_id = boundary[0]
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lte=newsfeed_id),
+            created_at__lt=utc_now() - timedelta(days=settings.NEWSFEED_RETENTION_DAYS),
+        )
+        deleted_count = 0
+        for _ in range(RETENTION_MAX_CHUNKS_PER_USER):
+            chunk = list(
+                queryset.order_by('created_at', 'id').values_list('id', 'created_at')[:RETENTION_DELETE_CHUNK_SIZE]
+            )
+            if not chunk:
+                break
+            newsfeed_ids = [newsfeed_id for newsfeed_id, _ in chunk]
+            NewsFeedTrimWatermark.objects.update_or_create(
+                user_id=user_id,
+                defaults={'trimmed_until': chunk[-1][1]},
+            )
+            deleted, _ = NewsFeed.objects.filter(id__in=newsfeed_ids).delete()
+            deleted_count += deleted
+            if len(newsfeed_ids) < RETENTION_DELETE_CHUNK_SIZE:
+                break
+            if deadline is not None and time.monotonic() > deadline:
+                return deleted_count, False
+            time.sleep(settings.NEWSFEED_RETENTION_SLEEP)
+        return deleted_count, True
+
+    @classmethod
+    def get_user_ids_to_trim(cls, user_ids):
+        # 1 次 GROUP BY 找出这一批里超过 NEWSFEED_RETENTION_COUNT 条 newsfeeds 的 users，
+        # 其他的 users 不需要再去查询 boundary
+        return list(
+            NewsFeed.objects.filter(user_id__in=user_ids)
+            .values('user_id')
+            .annotate(newsfeeds_count=Count('id'))
+            .filter(newsfeeds_count__gt=settings.NEWSFEED_RETENTION_COUNT)
+            .order_by('user_id')
+            .values_list('user_id', flat=True)
+        )
+
+    @classmethod
+    def trim_newsfeeds(cls, start_user_id=0, time_budget=None):
+        """
+        按 user id 的 keyset 分批处理 id > start_user_id 的 users，
+        翻页时被 extend_objects 延长的 newsfeeds / tweets lists 也 trim 回 REDIS_LIST_LENGTH_LIMIT
+        超过 time_budget (in seconds) 之后停下来，返回 (last_user_id, 处理了多少个 users, 删除了多少行)，
+        所有 users 都处理完的时候 last_user_id 是 None
+        """
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+        last_user_id = start_user_id
+        user_count, deleted_count = 0, 0
+        while True:
+            user_ids = list(
+                User.objects.filter(id__gt=last_user_id).order_by('id')
+                .values_list('id', flat=True)[:RETENTION_USER_BATCH_SIZE]
+            )
+            if not user_ids:
+                break
+
+            pipe = RedisClient.get_connection().pipeline()
+            for user_id in user_ids:
+                pipe.ltrim(USER_NEWSFEEDS_PATTERN.format(user_id=user_id), 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+                pipe.ltrim(USER_TWEETS_PATTERN.format(user_id=user_id), 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+            pipe.execute()
+
+            for user_id in cls.get_user_ids_to_trim(user_ids):
+                deleted, finished = cls.trim_user_newsfeeds(user_id, deadline)
+                deleted_count += deleted
+                if not finished:
+                    # 下一次从这个 user 继续
+                    return user_id - 1, user_count + user_ids.index(user_id), deleted_count
+
+            user_count += len(user_ids)
+            last_user_id = user_ids[-1]
+            if deadline is not None and time.monotonic() > deadline:
+                return last_user_id, user_count, deleted_count
+        return None, user_count, deleted_count
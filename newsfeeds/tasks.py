@@ -1,8 +1,6 @@
 from celery import shared_task
 from friendships.services import FriendshipService
 from newsfeeds.constants import FANOUT_BATCH_SIZE
-from newsfeeds.models import NewsFeed
-from tweets.models import Tweet
 from utils.time_constants import ONE_HOUR
 
 
@@ -11,23 +9,20 @@ def fanout_newsfeeds_batch_task(tweet_id, follower_ids):
     # import 写在里面避免循环依赖
     from newsfeeds.services import NewsFeedService
 
-    newsfeeds = [
-        NewsFeed(user_id=follower_id, tweet_id=tweet_id)
-        for follower_id in follower_ids
-    ]
-    NewsFeed.objects.bulk_create(newsfeeds)
-
-    # bulk create 不会触发 post_save 的 signal，所以需要手动 push 到 cache 里
-    for newsfeed in newsfeeds:
-        NewsFeedService.push_newsfeed_to_cache(newsfeed)
-
+    newsfeeds = NewsFeedService.batch_create_newsfeeds(follower_ids, tweet_id)
     return "{} newsfeeds created.".format(len(newsfeeds))
 
 
 @shared_task(routing_key='default', time_limit=ONE_HOUR)
 def fanout_newsfeeds_main_task(tweet_id, tweet_user_id):
+    from newsfeeds.services import NewsFeedService
+
     # create newsfeed for the tweet-posing user, make sure he/she sees it ASAP
-    NewsFeed.objects.create(user_id=tweet_user_id, tweet_id=tweet_id)
+    NewsFeedService.create_newsfeed(tweet_user_id, tweet_id)
+
+    # 用 Redis 里的 follower counter 做 fanout 的规划，没有 followers 的时候不需要查询 follower ids
+    if FriendshipService.get_follower_count(tweet_user_id) == 0:
+        return '0 newsfeeds going to fanout, 0 batches created.'
 
     # get all follower ids, split them by batch size
     follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
@@ -40,4 +35,18 @@ def fanout_newsfeeds_main_task(tweet_id, tweet_user_id):
     return '{} newsfeeds going to fanout, {} batches created.'.format(
         len(follower_ids),
         (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
-    )
\ No newline at end of file
+    )
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def trim_newsfeeds_task(start_user_id=0):
+    from newsfeeds.services import NewsFeedService
+
+    last_user_id, user_count, deleted_count = NewsFeedService.trim_newsfeeds(
+        start_user_id,
+        time_budget=ONE_HOUR // 2,
+    )
+    if last_user_id is not None:
+        # 剩下的 users 交给下一个 task 继续，不会被 time_limit 中断
+        trim_newsfeeds_task.delay(last_user_id)
+    return '{} users trimmed, {} newsfeeds deleted.'.format(user_count, deleted_count)
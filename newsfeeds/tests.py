@@ -1,9 +1,16 @@
-from newsfeeds.models import NewsFeed
+from datetime import timedelta
+from django.core.management import call_command
+from django.test import override_settings
+from io import StringIO
+from newsfeeds.hbase_models import HBaseNewsFeed
+from newsfeeds.models import NewsFeed, NewsFeedTrimWatermark
 from newsfeeds.services import NewsFeedService
 from newsfeeds.tasks import fanout_newsfeeds_main_task
 from testing.testcases import TestCase
+from tweets.models import Tweet
 from twitter.cache import USER_NEWSFEEDS_PATTERN
 from utils.redis_client import RedisClient
+from utils.time_helpers import utc_now
 
 
 class NewsFeedServiceTests(TestCase):
@@ -49,6 +56,128 @@ class NewsFeedServiceTests(TestCase):
         self.assertEqual([f.id for f in feeds], [feed2.id, feed1.id])
 
 
+class NewsFeedHBaseMigrationTests(TestCase):
+    def setUp(self):
+        super(NewsFeedHBaseMigrationTests, self).setUp()
+        self.ann = self.create_user('ann')
+        self.bob = self.create_user('bob')
+
+    @override_settings(NEWSFEED_HBASE_DUAL_WRITE=True)
+    def test_dual_write_and_read_switch(self):
+        tweets = [self.create_tweet(self.bob) for _ in range(3)]
+        newsfeeds = [NewsFeedService.create_newsfeed(self.ann.id, tweets[0].id)]
+        newsfeeds += NewsFeedService.batch_create_newsfeeds([self.ann.id, self.bob.id], tweets[1].id)
+        self.assertEqual(NewsFeed.objects.count(), 3)
+        hbase_newsfeeds = NewsFeedService.get_hbase_newsfeeds(self.ann.id)
+        self.assertEqual([f.tweet_id for f in hbase_newsfeeds], [tweets[1].id, tweets[0].id])
+        self.assertEqual(
+            [f.created_at for f in hbase_newsfeeds],
+            [newsfeeds[1].created_at, newsfeeds[0].created_at],
+        )
+        hbase_newsfeeds = NewsFeedService.get_hbase_newsfeeds(
+            self.ann.id,
+            created_at__lt=newsfeeds[1].created_at,
+        )
+        self.assertEqual([f.tweet_id for f in hbase_newsfeeds], [tweets[0].id])
+
+        # read from HBase, without writing to MySQL
+        with self.settings(NEWSFEED_READ_FROM_HBASE=True, NEWSFEED_WRITE_TO_MYSQL=False):
+            NewsFeedService.create_newsfeed(self.ann.id, tweets[2].id)
+            self.assertEqual(NewsFeed.objects.count(), 3)
+            RedisClient.clear()
+            cached = NewsFeedService.get_cached_newsfeeds(self.ann.id)
+            self.assertEqual([f.tweet_id for f in cached], [t.id for t in tweets[::-1]])
+
+    @override_settings(NEWSFEED_HBASE_DUAL_WRITE=True, NEWSFEED_READ_FROM_HBASE=True)
+    def test_create_newsfeed_when_reading_from_hbase(self):
+        # migration step: still writing to MySQL, but reading from HBase
+        tweets = [self.create_tweet(self.bob) for _ in range(2)]
+        NewsFeedService.create_newsfeed(self.ann.id, tweets[0].id)
+        # cache miss, the cached list is reloaded from HBase after the HBase row is written
+        RedisClient.clear()
+        NewsFeedService.create_newsfeed(self.ann.id, tweets[1].id)
+        cached = NewsFeedService.get_cached_newsfeeds(self.ann.id)
+        self.assertEqual([f.tweet_id for f in cached], [tweets[1].id, tweets[0].id])
+        self.assertEqual(NewsFeed.objects.count(), 2)
+
+    def test_newsfeeds_in_the_same_microsecond(self):
+        # two fanout batches reach ann in the same microsecond, neither row is overwritten
+        tweets = [self.create_tweet(self.bob) for _ in range(2)]
+        created_at = utc_now()
+        HBaseNewsFeed.batch_create([
+            NewsFeedService.get_hbase_row(NewsFeed(user_id=self.ann.id, tweet_id=tweet.id, created_at=created_at))
+            for tweet in tweets
+        ])
+        hbase_newsfeeds = NewsFeedService.get_hbase_newsfeeds(self.ann.id)
+        self.assertEqual([f.tweet_id for f in hbase_newsfeeds], [tweets[1].id, tweets[0].id])
+        self.assertEqual(NewsFeedService.get_hbase_newsfeeds(self.ann.id, created_at__lt=created_at), [])
+        # tweet_id breaks the tie, the scan continues right after the cursor row
+        hbase_newsfeeds = NewsFeedService.get_hbase_newsfeeds(
+            self.ann.id,
+            created_at__lt=created_at,
+            tweet_id__lt=tweets[1].id,
+        )
+        self.assertEqual([f.tweet_id for f in hbase_newsfeeds], [tweets[0].id])
+
+    def test_backfill(self):
+        for _ in range(3):
+            self.create_newsfeed(self.ann, self.create_tweet(self.bob))
+        call_command('backfill_hbase_newsfeeds', batch_size=2, stdout=StringIO())
+        hbase_rows = HBaseNewsFeed.filter(prefix=(self.ann.id,))
+        self.assertEqual(
+            sorted(row.tweet_id for row in hbase_rows),
+            sorted(NewsFeed.objects.values_list('tweet_id', flat=True)),
+        )
+
+
+class NewsFeedRetentionTests(TestCase):
+    def setUp(self):
+        self.clear_cache()
+        self.ann = self.create_user('ann')
+        self.bob = self.create_user('bob')
+
+    @override_settings(NEWSFEED_RETENTION_COUNT=1, NEWSFEED_RETENTION_DAYS=1)
+    def test_trim_newsfeeds_in_budget(self):
+        for _ in range(8):
+            self.create_newsfeed(self.ann, self.create_tweet(self.bob))
+        self.create_newsfeed(self.bob, self.create_tweet(self.bob))
+        NewsFeed.objects.update(created_at=utc_now() - timedelta(days=2))
+        # bob doesn't have more newsfeeds than NEWSFEED_RETENTION_COUNT
+        self.assertEqual(NewsFeedService.get_user_ids_to_trim([self.ann.id, self.bob.id]), [self.ann.id])
+
+        # the time budget is checked after every DELETE, ann is trimmed again in the next task
+        last_user_id, _, deleted_count = NewsFeedService.trim_newsfeeds(time_budget=0)
+        self.assertEqual((last_user_id, deleted_count), (self.ann.id - 1, 2))
+        # at most RETENTION_MAX_CHUNKS_PER_USER DELETEs for a user in a task
+        last_user_id, _, deleted_count = NewsFeedService.trim_newsfeeds(last_user_id)
+        self.assertEqual((last_user_id, deleted_count), (None, 4))
+        last_user_id, _, deleted_count = NewsFeedService.trim_newsfeeds()
+        self.assertEqual((last_user_id, deleted_count), (None, 1))
+        self.assertEqual(NewsFeed.objects.filter(user=self.ann).count(), 1)
+        self.assertEqual(NewsFeed.objects.filter(user=self.bob).count(), 1)
+
+    @override_settings(NEWSFEED_RETENTION_COUNT=2, NEWSFEED_RETENTION_DAYS=1)
+    def test_older_newsfeeds_after_watermark(self):
+        self.create_friendship(self.ann, self.bob)
+        tweets = [self.create_tweet(self.bob) for _ in range(5)]
+        newsfeeds = [self.create_newsfeed(self.ann, tweet) for tweet in tweets]
+        two_days_ago = utc_now() - timedelta(days=2)
+        for i, tweet in enumerate(tweets):
+            Tweet.objects.filter(id=tweet.id).update(created_at=two_days_ago + timedelta(seconds=i))
+            NewsFeed.objects.filter(id=newsfeeds[i].id).update(created_at=two_days_ago + timedelta(seconds=i))
+        # ann has more than NEWSFEED_RETENTION_COUNT newsfeeds but nothing was trimmed yet
+        self.assertEqual(NewsFeedService.get_older_newsfeeds(self.ann.id, None, 10), [])
+
+        NewsFeedService.trim_user_newsfeeds(self.ann.id)
+        watermark = NewsFeedTrimWatermark.objects.get(user=self.ann)
+        self.assertEqual(watermark.trimmed_until, two_days_ago + timedelta(seconds=2))
+        # only the tweets of the trimmed newsfeeds come back, newest first
+        older_newsfeeds = NewsFeedService.get_older_newsfeeds(self.ann.id, None, 10)
+        self.assertEqual([f.tweet_id for f in older_newsfeeds], [tweets[2].id, tweets[1].id, tweets[0].id])
+        older_newsfeeds = NewsFeedService.get_older_newsfeeds(self.ann.id, older_newsfeeds[0].created_at, 1)
+        self.assertEqual([f.tweet_id for f in older_newsfeeds], [tweets[1].id])
+
+
 class NewsFeedTaskTests(TestCase):
     def setUp(self):
         self.clear_cache()
@@ -9,6 +9,7 @@ from likes.models import Like
 from newsfeeds.models import NewsFeed
 from rest_framework.test import APIClient
 from tweets.models import Tweet
+from utils.ratelimit import LocalRateLimiter
 from utils.redis_client import RedisClient
 
 
@@ -35,6 +36,7 @@ class TestCase(DjangoTestCase):
     def clear_cache(self):
         RedisClient.clear()
         caches['testing'].clear()
+        LocalRateLimiter.clear()
 
     def create_user(self, username, email=None, password=None):
         if password is None:
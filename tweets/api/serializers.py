@@ -1,17 +1,45 @@
-from accounts.api.serializers import UserSerializerForTweet
+from accounts.api.serializers import UserCardSerializer, UserSerializerForTweet
 from comments.api.serializers import CommentSerializer
+from comments.services import CommentService
+from django.db import models
 from likes.api.serializers import LikeSerializer
 from likes.services import LikeService
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
-from tweets.constants import TWEET_PHOTO_UPLOAD_LIMIT
+from tweets.constants import TWEET_DETAIL_PREVIEW_SIZE, TWEET_PHOTO_UPLOAD_LIMIT
 from tweets.models import Tweet
 from tweets.serivces import TweetService
 from utils.redis_helper import RedisHelper
 
 
+class TweetListSerializer(serializers.ListSerializer):
+    """
+    serialize 一整页 tweets 的时候，先批量取出这一页需要的数据放进 context，
+    避免每个 tweet 单独访问一次 Redis
+    """
+    def to_representation(self, data):
+        tweets = list(data.all() if isinstance(data, models.Manager) else data)
+        self.prefetch(tweets, self.context)
+        return super(TweetListSerializer, self).to_representation(tweets)
+
+    @classmethod
+    def prefetch(cls, tweets, context):
+        # 1 get_many for the user cards of the whole page
+        UserCardSerializer.prefetch([tweet.user_id for tweet in tweets], context)
+        # 1 MGET for the whole page instead of 2 GETs per tweet
+        context['tweet_counts'] = RedisHelper.get_counts(
+            tweets,
+            ['likes_count', 'comments_count'],
+        )
+        # 1 SMISMEMBER for the whole page instead of 1 query per tweet
+        context['tweet_has_liked'] = LikeService.has_liked_many(
+            context['request'].user,
+            tweets,
+        )
+
+
 class TweetSerializer(serializers.ModelSerializer):
-    user = UserSerializerForTweet(source='cached_user')
+    user = UserSerializerForTweet(source='user_id')
     comments_count = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
     has_liked = serializers.SerializerMethodField()
@@ -29,17 +57,28 @@ class TweetSerializer(serializers.ModelSerializer):
             'has_liked',
             'photo_urls',
         )
+        list_serializer_class = TweetListSerializer
+
+    def _get_count(self, obj, attr):
+        counts = self.context.get('tweet_counts', {}).get(obj.id)
+        if counts is not None:
+            return counts[attr]
+        return RedisHelper.get_count(obj, attr)
 
     def get_likes_count(self, obj):
         # 这里的优化，从之前的 obj.like_set.count() | SELECT COUNT(*)
         # 变成了 Redis get, 虽然还是 N + 1 Queries， 但是
         # N 次 db queries 变成了 N 次 cache queries
-        return RedisHelper.get_count(obj, 'likes_count')
+        # 在 list 中则由 TweetListSerializer 用 1 次 MGET 批量取出
+        return self._get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
-        return RedisHelper.get_count(obj, 'comments_count')
+        return self._get_count(obj, 'comments_count')
 
     def get_has_liked(self, obj):
+        has_liked = self.context.get('tweet_has_liked', {}).get(obj.id)
+        if has_liked is not None:
+            return has_liked
         return LikeService.has_liked(self.context['request'].user, obj)
 
     def get_photo_urls(self, obj):
@@ -90,8 +129,10 @@ class TweetSerializerForCreate(serializers.ModelSerializer):
 # Tweet + comments + likes + photos
 class TweetSerializerForDetail(TweetSerializer):
     # user = UserSerializer()
-    comments = CommentSerializer(source='comment_set', many=True)
-    likes = LikeSerializer(source='like_set', many=True)
+    # 热门的 tweet 会有几十万条 comments 和 likes，详情页里只带上从 cache 里取的 preview
+    # 完整的列表通过 GET /api/comments/?tweet_id= 和 GET /api/tweets/<id>/likes/ 分页获取
+    comments = serializers.SerializerMethodField()
+    likes = serializers.SerializerMethodField()
 
     class Meta:
         model = Tweet
@@ -109,8 +150,10 @@ class TweetSerializerForDetail(TweetSerializer):
             'photo_urls',  # from TweetSerializer
         )
 
-    # <HOMEWORK> 用 serializers.SerializerMethodField 的方式实现 comments 的获取
-    # comments = serializers.SerializerMethodField()
-    # get_comments 需要返回已经序列化过的数据
-    # def get_comments(self, obj):  # obj -> Tweet
-    #     return CommentSerializer(obj.comment_set.all(), many=True).data
+    def get_comments(self, obj):  # obj -> Tweet
+        comments = CommentService.get_cached_comments(obj.id, limit=TWEET_DETAIL_PREVIEW_SIZE)
+        return CommentSerializer(comments, many=True, context=self.context).data
+
+    def get_likes(self, obj):
+        likes = LikeService.get_cached_likes(obj, limit=TWEET_DETAIL_PREVIEW_SIZE)
+        return LikeSerializer(likes, many=True, context=self.context).data
@@ -1,9 +1,13 @@
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
 from rest_framework import status
 from rest_framework.test import APIClient
 from testing.testcases import TestCase
+from tweets.constants import TWEET_DETAIL_PREVIEW_SIZE
 from tweets.models import Tweet, TweetPhoto
+from twitter.cache import USER_TWEETS_PATTERN
 from utils.paginations import EndlessPagination
+from utils.redis_client import RedisClient
 
 # `/` is required otherwise --> 303 redirect
 # /api/tweets/?user_id=id/ -> list user's tweets
@@ -11,6 +15,7 @@ TWEET_LIST_API = '/api/tweets/'
 TWEET_CREATE_API = '/api/tweets/'
 # /api/tweets/tweet_id/ -> list a tweet with id == tweet id
 TWEET_RETRIEVE_API = '/api/tweets/{}/'
+TWEET_LIKES_API = '/api/tweets/{}/likes/'
 
 
 class TweetApiTests(TestCase):
@@ -160,6 +165,74 @@ class TweetApiTests(TestCase):
         self.assertEqual(response.data['user']['nickname'], profile.nickname)
         self.assertEqual(response.data['user']['avatar_url'], None)
 
+    def test_retrieve_previews(self):
+        tweet = self.create_tweet(self.user1)
+        comments = [
+            self.create_comment(self.user2, tweet, 'comment {}'.format(i))
+            for i in range(TWEET_DETAIL_PREVIEW_SIZE + 2)
+        ]
+        users = [
+            self.create_user('liker{}'.format(i))
+            for i in range(TWEET_DETAIL_PREVIEW_SIZE + 2)
+        ]
+        for user in users:
+            self.create_like(user, tweet)
+
+        # 只带上最新的几条 comments 和 likes
+        url = TWEET_RETRIEVE_API.format(tweet.id)
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.data['comments_count'], len(comments))
+        self.assertEqual(response.data['likes_count'], len(users))
+        self.assertEqual(
+            [comment['id'] for comment in response.data['comments']],
+            [comment.id for comment in comments[::-1][:TWEET_DETAIL_PREVIEW_SIZE]],
+        )
+        self.assertEqual(
+            [like['user']['id'] for like in response.data['likes']],
+            [user.id for user in users[::-1][:TWEET_DETAIL_PREVIEW_SIZE]],
+        )
+
+        # 完整的 likes 列表分页获取
+        response = self.anonymous_client.get(TWEET_LIKES_API.format(tweet.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [like['user']['id'] for like in response.data['results']],
+            [user.id for user in users[::-1]],
+        )
+        response = self.anonymous_client.get(TWEET_LIKES_API.format(-1))
+        self.assertEqual(response.status_code, 404)
+
+    def test_likes_pagination(self):
+        page_size = EndlessPagination.page_size
+        tweet = self.create_tweet(self.user1)
+        likes = [
+            self.create_like(self.create_user('liker{}'.format(i)), tweet)
+            for i in range(page_size * 2)
+        ]
+        likes = likes[::-1]
+        url = TWEET_LIKES_API.format(tweet.id)
+
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(
+            [like['user']['id'] for like in response.data['results']],
+            [like.user_id for like in likes[:page_size]],
+        )
+        response = self.anonymous_client.get(url, {
+            'created_at__lt': likes[page_size - 1].created_at,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(
+            [like['user']['id'] for like in response.data['results']],
+            [like.user_id for like in likes[page_size:]],
+        )
+
+        # cancel a like
+        likes[0].delete()
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.data['results'][0]['user']['id'], likes[1].user_id)
+
     def test_endless_pagination(self):
         page_size = EndlessPagination.page_size
 
@@ -205,3 +278,44 @@ class TweetApiTests(TestCase):
         self.assertEqual(response.data['has_next_page'], False)
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['id'], new_tweet.id)
+
+    @override_settings(REDIS_LIST_LENGTH_LIMIT=10, REDIS_EXTENDED_LIST_LENGTH_LIMIT=30)
+    def test_pagination_beyond_cache(self):
+        page_size = EndlessPagination.page_size
+        for i in range(page_size * 2 - len(self.tweets1) + 5):
+            self.tweets1.append(self.create_tweet(self.user1, f'tweet_{i}'))
+        tweets = self.tweets1[::-1]
+        self.clear_cache()
+        key = USER_TWEETS_PATTERN.format(user_id=self.user1.id)
+        conn = RedisClient.get_connection()
+
+        # the first page has 10 tweets from the cache and 10 from db,
+        # tweets from db are appended to the cache together with the next page
+        response = self.anonymous_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        self.assertEqual([t['id'] for t in response.data['results']], [t.id for t in tweets[:page_size]])
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(conn.llen(key), 30)
+
+        # the second page straddles the extended cache and db, the list can't grow any more
+        response = self.anonymous_client.get(TWEET_LIST_API, {
+            'user_id': self.user1.id,
+            'cursor': response.data['next_cursor'],
+        })
+        self.assertEqual(
+            [t['id'] for t in response.data['results']],
+            [t.id for t in tweets[page_size:page_size * 2]],
+        )
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(conn.llen(key), 30)
+
+        # the last page is from db only
+        response = self.anonymous_client.get(TWEET_LIST_API, {
+            'user_id': self.user1.id,
+            'cursor': response.data['next_cursor'],
+        })
+        self.assertEqual([t['id'] for t in response.data['results']], [t.id for t in tweets[page_size * 2:]])
+        self.assertEqual(response.data['has_next_page'], False)
+
+        # a new tweet trims the list back to REDIS_LIST_LENGTH_LIMIT
+        self.create_tweet(self.user1)
+        self.assertEqual(conn.llen(key), 10)
@@ -1,7 +1,10 @@
+from django.contrib.contenttypes.models import ContentType
 from django.utils.decorators import method_decorator
+from likes.api.serializers import LikeSerializer
+from likes.services import LikeService
 from newsfeeds.services import NewsFeedService
-from ratelimit.decorators import ratelimit
 from rest_framework import viewsets
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.response import Response
 from tweets.api.serializers import (
@@ -11,8 +14,10 @@ from tweets.api.serializers import (
 )
 from tweets.models import Tweet
 from tweets.serivces import TweetService
-from utils.decorators import required_params
+from twitter.cache import USER_TWEETS_PATTERN
+from utils.decorators import read_from_replica, required_params
 from utils.paginations import EndlessPagination
+from utils.ratelimit import ratelimit
 
 
 class TweetViewSet(viewsets.GenericViewSet):
@@ -24,26 +29,30 @@ class TweetViewSet(viewsets.GenericViewSet):
     pagination_class = EndlessPagination
 
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'likes']:
             return [AllowAny()]
         return [IsAuthenticated()]
 
     @required_params(params=['user_id'])
+    @read_from_replica
     def list(self, request, *args, **kwargs):
         # if 'user_id' not in request.query_params:
         #     return Response('missing user_id', status=400)
         user_id = request.query_params['user_id']
         cached_tweets = TweetService.get_cached_tweets(user_id)
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
-        if page is None:
-            # SQL statement:
-            # select * from twitter_tweets
-            # where user_id = xxx
-            # order by created_at desc
-            # this SQL query uses indexing (user, -created_at)
-            # indexing only (user) is not sufficient
-            queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
-            page = self.paginate_queryset(queryset)
+        # 翻过了 cache 的部分从 db 接着取，并且把取到的 tweets 放进 cache
+        # SQL statement:
+        # select * from twitter_tweets
+        # where user_id = xxx
+        # order by created_at desc
+        # this SQL query uses indexing (user, -created_at)
+        # indexing only (user) is not sufficient
+        page = self.paginator.paginate_cached_list(
+            cached_tweets,
+            request,
+            queryset=Tweet.objects.filter(user_id=user_id),
+            cache_key=USER_TWEETS_PATTERN.format(user_id=user_id),
+        )
         serializer = TweetSerializer(
             page,
             many=True,
@@ -54,8 +63,8 @@ class TweetViewSet(viewsets.GenericViewSet):
         # return Response({'tweets': serializer.data})
         return self.get_paginated_response(serializer.data)
 
-    @method_decorator(ratelimit(key='user', rate='1/s', method='POST', block=True))
-    @method_decorator(ratelimit(key='user', rate='5/m', method='POST', block=True))
+    # 两个 rules 在同一次 Redis round-trip 里检查
+    @method_decorator(ratelimit(key='user', rate=['1/s', '5/m'], method='POST', block=True))
     def create(self, request, *args, **kwargs):
         """
         Re-write create method to use current login user
@@ -75,12 +84,32 @@ class TweetViewSet(viewsets.GenericViewSet):
         NewsFeedService.fanout_to_followers(tweet)
         return Response(TweetSerializer(tweet, context={'request': request}).data, status=201)
 
-    @method_decorator(ratelimit(key='user_or_ip', rate='5/s', method='GET', block=True))
+    @method_decorator(ratelimit(key='user_or_ip', rate='5/s', method='GET', block=True, local=True))
+    @read_from_replica
     def retrieve(self, request, *args, **kwargs):
-        # <HOMEWORK 1> 通过某个query参数with_all_comments来决定是否需要带上所有comments
-        # <HOMEWORK 2> 通过某个query参数with_preview_comments来决定是否带上前3条comments
+        # 详情里只带上最新的几条 comments 和 likes，完整的列表需要分页获取
         tweet = self.get_object()
         return Response(TweetSerializerForDetail(
             tweet,
             context={'request': request}).data,
         )
+
+    @action(methods=['GET'], detail=True)
+    @method_decorator(ratelimit(key='user_or_ip', rate='5/s', method='GET', block=True, local=True))
+    @read_from_replica
+    def likes(self, request, *args, **kwargs):
+        # GET /api/tweets/<id>/likes/ 按时间倒序分页获取所有的 likes
+        tweet = self.get_object()
+        cached_likes = LikeService.get_cached_likes(tweet)
+        # 使用 (content_type, object_id, created_at) 的索引
+        page = self.paginator.paginate_cached_list(
+            cached_likes,
+            request,
+            queryset=tweet.like_set.all(),
+            cache_key=LikeService.get_object_likes_key(
+                ContentType.objects.get_for_model(Tweet).id,
+                tweet.id,
+            ),
+        )
+        serializer = LikeSerializer(page, many=True, context={'request': request})
+        return self.get_paginated_response(serializer.data)
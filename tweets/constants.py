@@ -13,3 +13,6 @@ TWEET_PHOTO_STATUS_CHOICES = (
 )
 
 TWEET_PHOTO_UPLOAD_LIMIT = 9
+
+# tweet 详情页里只带上最新的几条 comments 和 likes，完整的列表通过分页的 API 获取
+TWEET_DETAIL_PREVIEW_SIZE = 3
@@ -22,13 +22,13 @@ class TweetService(object):
         # Here queryset = xxx hasn't really queried the db because Queryset uses lazy loading
         # If we iterate over a queryset, e.g. list(queryset) or do_something for x in queryset
         # will really query the DB
-        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
+        queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at', '-id')
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
         return RedisHelper.load_objects(key, queryset)
 
     @classmethod
     def push_tweet_to_cache(cls, tweet):
         # Queryset is lazy loading
-        queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at')
+        queryset = Tweet.objects.filter(user_id=tweet.user_id).order_by('-created_at', '-id')
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
         RedisHelper.push_object(key, tweet, queryset)
@@ -1,9 +1,30 @@
 # memcached
-FOLLOWINGS_PATTERN = 'followings:{user_id}'
 USER_PROFILE_PATTERN = 'userprofile:{user_id}'
+# id, username, nickname and avatar file name of a user, see UserService.get_user_cards
+USER_CARD_PATTERN = 'usercard:v2:{user_id}'
 
 # redis
 # tweets posted by a user
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
 # a user's newsfeeds list
 USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+# ids of users followed by a user
+FOLLOWINGS_PATTERN = 'followings:{user_id}'
+# sorted int64 arrays of followee / follower ids of a user, see FriendshipGraphService
+FOLLOWEE_IDS_PATTERN = 'graph_followee_ids:{user_id}'
+FOLLOWER_IDS_PATTERN = 'graph_follower_ids:{user_id}'
+# follower / following counts of a user
+FOLLOWERS_COUNT_PATTERN = 'followers_count:{user_id}'
+FOLLOWINGS_COUNT_PATTERN = 'followings_count:{user_id}'
+# object ids of a content type liked by a user, a sorted set scored by the like time
+USER_LIKED_PATTERN = 'user_liked:v2:{user_id}:{content_type_id}'
+# comments under a tweet
+TWEET_COMMENTS_PATTERN = 'tweet_comments:{tweet_id}'
+# likes of a tweet or comment
+OBJECT_LIKES_PATTERN = 'object_likes:{content_type_id}:{object_id}'
+# unread notifications count of a user
+UNREAD_NOTIFICATIONS_COUNT_PATTERN = 'unread_notifications_count:{user_id}'
+# like / comment ids waiting to be delivered as coalesced notifications
+NOTIFICATION_BUFFER_PATTERN = 'notification_buffer:{kind}'
+# the ids of the window being flushed, kept until the notifications are written
+NOTIFICATION_PROCESSING_PATTERN = 'notification_processing:{kind}'
@@ -14,6 +14,7 @@ from kombu import Queue
 from pathlib import Path
 import os
 import sys
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -60,9 +61,8 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend', ],
-    # Override the default Error handler for ratelimit, because by default the status code
-    # for massive requests is 403 Forbidden, but 429 Too Many Requests is more suitable
-    # TODO: read django-ratelimit src, implement token method
+    # Override the default Error handler for ratelimit, 429 Too Many Requests comes with
+    # Retry-After and X-RateLimit-Remaining headers
     'EXCEPTION_HANDLER': 'utils.ratelimit.exception_handler',
 }
 
@@ -72,6 +72,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'utils.middlewares.ReplicaStickinessMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
@@ -111,6 +112,18 @@ DATABASES = {
         'PASSWORD': os.getenv('MYSQL_PASSWORD'),
     }
 }
+# read replicas, e.g. MYSQL_REPLICA_HOSTS=db-replica-1,db-replica-2
+# 只读的 view actions 可以从 replicas 读，见 utils.db_routers.ReplicaRouter
+DATABASE_REPLICAS = []
+for index, host in enumerate(filter(None, os.getenv('MYSQL_REPLICA_HOSTS', '').split(','))):
+    alias = 'replica_{}'.format(index)
+    # 测试的时候 replicas 就是 default，不会创建单独的 test databases
+    DATABASES[alias] = {**DATABASES['default'], 'HOST': host, 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['utils.db_routers.ReplicaRouter']
+# 写过数据之后多久之内继续从 primary 读，需要大于 replication lag
+REPLICA_STICKY_SECONDS = 5
+REPLICA_STICKY_COOKIE_NAME = 'replica_sticky_until'
 
 
 # Password validation
@@ -131,6 +144,16 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# 登陆的时间基本都花在 PBKDF2 上，iterations 可以根据 benchmark_login 的结果调整，
+# 调整之后旧的 password hash 会在用户下一次登陆的时候自动用新的 iterations 重新 hash
+PASSWORD_HASHERS = [
+    'accounts.hashers.ConfigurablePBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+]
+PASSWORD_HASH_ITERATIONS = 216000
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/3.1/topics/i18n/
@@ -164,6 +187,8 @@ DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'  # AWS S3
 TESTING = ((' '.join(sys.argv)).find('manage.py test') != -1)
 if TESTING:
     DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'  # local file storage
+    # 测试上传的文件放在临时目录里，不会写进 repo 的 media/
+    MEDIA_ROOT = tempfile.mkdtemp(prefix='twitter_test_media_')
 
 # https://docs.djangoproject.com/en/3.1/topics/cache/
 # sudo apt install memcached
@@ -181,12 +206,6 @@ CACHES = {
         'TIMEOUT': 86400,
         'KEY_PREFIX': 'testing',
     },
-    'ratelimit': {
-        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
-        'LOCATION': 'memcached:11211',
-        'TIMEOUT': 86400 * 7,
-        'KEY_PREFIX': 'rl',
-    },
 }
 
 # Redis
@@ -197,6 +216,19 @@ REDIS_PORT = 6379
 REDIS_DB = 0 if TESTING else 1  # which db, 0: testing, 1: production
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds -> 7 days
 REDIS_LIST_LENGTH_LIMIT = 1000 if not TESTING else 20
+# 翻页翻过了 cache 的时候，从 db 接着取到的数据可以把 list 延长到这个长度
+REDIS_EXTENDED_LIST_LENGTH_LIMIT = 2000 if not TESTING else 40
+# write-behind 模式下 likes_count / comments_count 只写 Redis，由 celery beat 定期
+# 把累积的增量批量写回 MySQL，避免热门内容的行锁竞争
+COUNTER_WRITE_BEHIND = False
+COUNTER_FLUSH_INTERVAL = 10  # in seconds
+# has_liked 使用 Redis 里每个用户 like 过的 object ids，只保存最近的 USER_LIKED_CACHE_LIMIT 个
+USER_LIKED_CACHE_ENABLED = True
+USER_LIKED_CACHE_LIMIT = 1000 if not TESTING else 20
+# like / comment notifications 先放在 Redis 的 buffer 里，每 NOTIFICATION_COALESCE_WINDOW 秒
+# 由 celery beat 批量写入，同一个 (recipient, target, verb) 只产生 1 条 notification
+NOTIFICATION_COALESCING = not TESTING
+NOTIFICATION_COALESCE_WINDOW = 10  # in seconds
 
 # Celery Configuration Options
 # 使用如下命令把 worker 进程（只执行异步任务的进程，可以在不同的机器上）单独跑起来
@@ -210,14 +242,67 @@ CELERY_QUEUES = {
     Queue('default', routing_key='default'),
     Queue('newsfeeds', routing_key='newsfeeds'),
 }
+# 定时任务需要另外跑一个 beat 进程: celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    'flush-likes-count': {
+        'task': 'likes.tasks.flush_likes_count_task',
+        'schedule': COUNTER_FLUSH_INTERVAL,
+    },
+    'flush-comments-count': {
+        'task': 'comments.tasks.flush_comments_count_task',
+        'schedule': COUNTER_FLUSH_INTERVAL,
+    },
+    'flush-notification-buffers': {
+        'task': 'inbox.tasks.flush_notification_buffers_task',
+        'schedule': NOTIFICATION_COALESCE_WINDOW,
+    },
+    'reconcile-unread-counts': {
+        'task': 'inbox.tasks.reconcile_unread_counts_task',
+        'schedule': 60 * 60,  # every hour
+    },
+    'reconcile-friendship-counts': {
+        'task': 'friendships.tasks.reconcile_friendship_counts_task',
+        'schedule': 60 * 60,  # every hour
+    },
+    'trim-newsfeeds': {
+        'task': 'newsfeeds.tasks.trim_newsfeeds_task',
+        'schedule': 24 * 60 * 60,  # every day
+    },
+}
 
 # Rate Limiter
-RATELIMIT_USE_CACHE = 'ratelimit'
-RATELIMIT_CACHE_PREFIX = 'rl:'   # 避免和其他的 key 冲突
+# token buckets 存在 Redis 里，见 utils/ratelimit.py
+RATELIMIT_KEY_PREFIX = 'rl:'   # 避免和其他的 key 冲突
+# ratelimit(local=True) 的时候每个进程在内存里最多保存多少个 keys 的 token buckets
+RATELIMIT_LOCAL_CACHE_SIZE = 10000
 RATELIMIT_ENABLE = not TESTING  # 在某些环境下，比如内部测试等环境下，一般也会关掉
 
 # HBase Database
 HBASE_HOST = '127.0.0.1'
+# friendships 迁移到 HBase 的开关
+# 1. 打开 dual-write，follow / unfollow 的时候同时写 HBaseFollowing 和 HBaseFollower
+# 2. python manage.py backfill_hbase_friendships 把已有的 friendships 写进 HBase
+# 3. python manage.py check_hbase_friendships 检查 MySQL 和 HBase 的数据是否一致
+# 4. 打开 read 开关，followers / followings 的读取（包括 fanout）改成 HBase 的 prefix scan
+FRIENDSHIP_HBASE_DUAL_WRITE = False
+FRIENDSHIP_READ_FROM_HBASE = False
+# newsfeeds 迁移到 HBase 的开关，HBaseNewsFeed 的 row key 是 (user_id, created_at)
+# 1. 打开 dual-write，fanout 的时候同时写 HBaseNewsFeed
+# 2. python manage.py backfill_hbase_newsfeeds 把已有的 newsfeeds 写进 HBase
+# 3. 打开 read 开关，newsfeeds 的读取（包括 cache 的加载）改成 HBase 的 scan
+# 4. 关掉 NEWSFEED_WRITE_TO_MYSQL，MySQL 里的 newsfeeds 表不再增长
+NEWSFEED_HBASE_DUAL_WRITE = False
+NEWSFEED_READ_FROM_HBASE = False
+NEWSFEED_WRITE_TO_MYSQL = True
+# HBaseNewsFeed 的 column family TTL，过期的 newsfeeds 由 HBase compaction 删除，不需要 DELETE
+NEWSFEED_HBASE_TTL = 90 * 86400  # in seconds -> 90 days
+# MySQL 里每个 user 保留最新的 NEWSFEED_RETENTION_COUNT 条 newsfeeds，以及 NEWSFEED_RETENTION_DAYS 天之内的
+# newsfeeds，其他的由 trim_newsfeeds_task 分批删除。更早的内容翻页的时候从 followings 的 tweets 里按需获取
+# NEWSFEED_RETENTION_COUNT 不能小于 REDIS_LIST_LENGTH_LIMIT
+NEWSFEED_RETENTION_COUNT = 1000 if not TESTING else 20
+NEWSFEED_RETENTION_DAYS = 30
+# 每删除一批之后 sleep 的时间，避免长时间占用 (user, created_at) 索引的锁和 replication 的带宽
+NEWSFEED_RETENTION_SLEEP = 0.05 if not TESTING else 0  # in seconds
 
 # 把本地的设置，例如debug配置，放入local_settings.py，不push到remote repo
 # 这样在production环境中不会引入这些设置
@@ -0,0 +1,33 @@
+from contextvars import ContextVar
+from django.conf import settings
+
+import random
+
+# 当前的 request / task 是否可以从 replicas 读，由 utils.decorators.read_from_replica 设置
+# 用 ContextVar 而不是 threading.local，这样在 async views 里也是安全的
+replica_reads_enabled = ContextVar('replica_reads_enabled', default=False)
+
+
+class ReplicaRouter:
+    """
+    所有的写都去 default (primary)，只有在 read_from_replica 包裹的只读 view actions 里
+    发生的读才会随机发给 settings.DATABASE_REPLICAS 中的一个
+    cache miss 之后 refill 到 cache 里的查询会用 .using('default') 从 primary 读，
+    这些值会被 cache 很久，并且之后的增量更新都以它为基础
+    """
+
+    def db_for_read(self, model, **hints):
+        if settings.DATABASE_REPLICAS and replica_reads_enabled.get():
+            return random.choice(settings.DATABASE_REPLICAS)
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas 和 primary 是同一份数据
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas 通过 MySQL replication 同步 schema
+        return db == 'default'
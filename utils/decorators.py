@@ -1,4 +1,5 @@
 from functools import wraps
+from utils.db_routers import replica_reads_enabled
 from rest_framework.response import Response
 from rest_framework import status
 
@@ -35,3 +36,18 @@ def required_params(method='GET', params=None):
             return view_func(instance, request, *args, **kwargs)
         return _wrapped_view
     return decorator
+
+
+def read_from_replica(view_func):
+    # 只读的 view actions 用 @read_from_replica 包裹之后，里面的 ORM 读会由 ReplicaRouter 发给 replicas
+    # 刚写过数据的 client（见 ReplicaStickinessMiddleware）继续从 primary 读
+    @wraps(view_func)
+    def _wrapped_view(instance, request, *args, **kwargs):
+        if getattr(request, 'replica_sticky', False):
+            return view_func(instance, request, *args, **kwargs)
+        token = replica_reads_enabled.set(True)
+        try:
+            return view_func(instance, request, *args, **kwargs)
+        finally:
+            replica_reads_enabled.reset(token)
+    return _wrapped_view
@@ -19,7 +19,8 @@ class MemcachedHelper:
             return obj
 
         # cache miss, search db
-        obj = model_class.objects.get(id=object_id)
+        # 只有在 object 改变的时候才会 invalidate，从 primary 读，replica 上旧的数据不会被 cache 一整天
+        obj = model_class.objects.using('default').get(id=object_id)
         # using default expire time
         cache.set(key, obj)
         return obj
@@ -0,0 +1,32 @@
+from django.conf import settings
+from rest_framework.permissions import SAFE_METHODS
+
+import time
+
+
+class ReplicaStickinessMiddleware:
+    """
+    read-your-writes: 一个 client 写过之后的 REPLICA_STICKY_SECONDS 秒内，
+    它的读都留在 primary 上，不会因为 replication lag 读不到自己刚写的数据
+    写的时间放在 cookie 里，判断的时候不需要访问 cache
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            sticky_until = float(request.COOKIES.get(settings.REPLICA_STICKY_COOKIE_NAME, 0))
+        except ValueError:
+            sticky_until = 0
+        request.replica_sticky = sticky_until > time.time()
+
+        response = self.get_response(request)
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(
+                settings.REPLICA_STICKY_COOKIE_NAME,
+                str(time.time() + settings.REPLICA_STICKY_SECONDS),
+                max_age=settings.REPLICA_STICKY_SECONDS,
+                httponly=True,
+            )
+        return response
@@ -1,47 +1,111 @@
+from bisect import bisect_left, bisect_right
 from dateutil import parser
 from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import BasePagination
 from rest_framework.response import Response
+from utils.redis_helper import RedisHelper
+from utils.time_helpers import datetime_to_timestamp, timestamp_to_datetime
+
+import base64
+import functools
+import math
+
+
+def encode_cursor(created_at, object_id):
+    # cursor 对客户端是不透明的，只需要原样传回来，里面是微秒级的 timestamp，解析时不需要 isoparse
+    raw = '{},{}'.format(datetime_to_timestamp(created_at), object_id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    # return (created_at, object_id), raise ValueError if the cursor is invalid
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, object_id = raw.split(',')
+        return timestamp_to_datetime(int(timestamp)), int(object_id)
+    except (TypeError, UnicodeError, ValueError, OverflowError) as e:
+        raise ValueError('invalid cursor: {}'.format(cursor)) from e
+
+
+def _object_id(obj, id_field='id'):
+    # bulk_create 出来的 objects 没有 id，当作 0，这时只按 created_at 排序
+    return getattr(obj, id_field) or 0
+
+
+def _ordering_key(obj, id_field='id'):
+    # cached list 按 (created_at, id_field) 倒序排列，取负数之后是升序的，可以直接 bisect
+    return -datetime_to_timestamp(obj.created_at), -_object_id(obj, id_field)
 
 
 class EndlessPagination(BasePagination):
     page_size = 20
+    cursor_query_param = 'cursor'
+    # created_at 相同的时候用来排序的第二个字段，也是 cursor 里的 object_id
+    # 没有 id 的数据源要换成别的唯一字段，比如 HBase 里的 newsfeeds 用 tweet_id
+    id_field = 'id'
 
     def __init__(self):
         # super(xxx) explicitly specifies which parent class's __init__ is being called.
         super(EndlessPagination, self).__init__()
         self.has_next_page = False
+        self.next_cursor = None
 
     def to_html(self):
         pass
 
+    def get_cursor(self, request):
+        # cursor 优先于 created_at__lt，带上了 id，created_at 相同的 objects 不会重复或者被跳过
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            return decode_cursor(cursor)
+        except ValueError:
+            raise NotFound('Invalid cursor')
+
+    def set_next_cursor(self, page):
+        self.next_cursor = None
+        if self.has_next_page and page:
+            self.next_cursor = encode_cursor(page[-1].created_at, _object_id(page[-1], self.id_field))
+
     def paginate_ordered_list(self, reverse_ordered_list, request):
-        # reverse_ordered_list 是从 cache 得到的 obj list
+        # reverse_ordered_list 是从 cache 得到的 obj list，按 (created_at, id_field) 倒序排列
+        # 用 bisect 找到翻页的起点，翻到再深的页面都只需要 O(log n) 次比较
+        ordering_key = functools.partial(_ordering_key, id_field=self.id_field)
         if 'created_at__gt' in request.query_params:  # 刷新最新内容的时候
             # Parse an ISO-8601 datetime string into a :class:`datetime.datetime`.
             created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
-            objects = []
-            for obj in reverse_ordered_list:
-                # get all objects created after created_at__gt
-                if obj.created_at > created_at__gt:
-                    objects.append(obj)
-                else:
-                    break
+            # get all objects created after created_at__gt
+            index = bisect_left(
+                reverse_ordered_list,
+                (-datetime_to_timestamp(created_at__gt), -math.inf),
+                key=ordering_key,
+            )
             self.has_next_page = False
-            return objects
+            return reverse_ordered_list[:index]
 
         index = 0
-        if 'created_at__lt' in request.query_params:
+        cursor = self.get_cursor(request)
+        if cursor is not None:
+            created_at, object_id = cursor
+            index = bisect_right(
+                reverse_ordered_list,
+                (-datetime_to_timestamp(created_at), -object_id),
+                key=ordering_key,
+            )
+        elif 'created_at__lt' in request.query_params:
             created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
-            for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
-                    break
-            else:
-                # if no object meets the requirements, return an empty list
-                # NOTE: this is a for-else statement, not if-else
-                reverse_ordered_list = []
+            index = bisect_right(
+                reverse_ordered_list,
+                (-datetime_to_timestamp(created_at__lt), math.inf),
+                key=ordering_key,
+            )
         self.has_next_page = len(reverse_ordered_list) > index + self.page_size
-        return reverse_ordered_list[index: index + self.page_size]
+        page = reverse_ordered_list[index: index + self.page_size]
+        self.set_next_cursor(page)
+        return page
 
     def paginate_queryset(self, queryset, request, view=None):
         if 'created_at__gt' in request.query_params:
@@ -52,9 +116,16 @@ class EndlessPagination(BasePagination):
             created_at__gt = request.query_params['created_at__gt']
             queryset = queryset.filter(created_at__gt=created_at__gt)
             self.has_next_page = False
-            return queryset.order_by('-created_at')
+            return queryset.order_by('-created_at', '-id')
 
-        if 'created_at__lt' in request.query_params:
+        cursor = self.get_cursor(request)
+        if cursor is not None:
+            # (created_at, id) 的 keyset 翻页，id 作为第二排序字段也能用上 (xxx, created_at) 的索引
+            created_at, object_id = cursor
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=object_id),
+            )
+        elif 'created_at__lt' in request.query_params:
             """
             用于向上划动屏幕（向下翻页）时加载下一页的数据
             查询符合条件的 （created_at < created_at__lt）的，按照时间倒序排列的，
@@ -63,27 +134,105 @@ class EndlessPagination(BasePagination):
             created_at__lt = request.query_params['created_at__lt']
             queryset = queryset.filter(created_at__lt=created_at__lt)
 
-        queryset = queryset.order_by('-created_at')[:self.page_size + 1]
-        self.has_next_page = len(queryset) > self.page_size
-        return queryset[:self.page_size]
+        page = list(queryset.order_by('-created_at', '-id')[:self.page_size + 1])
+        self.has_next_page = len(page) > self.page_size
+        page = page[:self.page_size]
+        self.set_next_cursor(page)
+        return page
 
-    def paginate_cached_list(self, cached_list, request):
-        # Video 097
+    def paginate_cached_list(self, cached_list, request, queryset=None, cache_key=None):
+        """
+        queryset: 和 cached_list 排序相同的 db 查询，cache 里取不够一页的时候从 db 接着取
+        cache_key: 如果提供，从 db 接着取到的 objects 会 append 到 Redis list 的尾部，下一页就可以直接从 cache 里取
+        没有提供 queryset 的时候，cache 不够用的时候返回 None，由调用方去 db 查询
+        """
         paginated_list = self.paginate_ordered_list(cached_list, request)
-        # 如果是上翻页，paginated_list 里是所有的最新暑假，直接返回
+        # 如果是上翻页，paginated_list 里是所有的最新数据，直接返回
         if 'created_at__gt' in request.query_params:
             return paginated_list
         # 如果还有下一页，说明 cached_list 里面的数据还没取完，也直接返回
         if self.has_next_page:
             return paginated_list
-        # 如果 cached_list 的长度不组最大限制，说明 cached_list 里已经是所有数据了
+        # 如果 cached_list 的长度不足最大限制，说明 cached_list 里已经是所有数据了
         if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
             return paginated_list
-        # 如果进入这里，说明可能存在在数据库里没有 load 进 cache 的数据，需要直接去数据库查询
-        return None
+        # 如果进入这里，说明可能存在在数据库里没有 load 进 cache 的数据，需要去数据库查询
+        if queryset is None:
+            return None
+        return self._paginate_after_cached_list(cached_list, paginated_list, request, queryset, cache_key)
+
+    def _paginate_after_cached_list(self, cached_list, paginated_list, request, queryset, cache_key):
+        # 这一页由 cache 的尾部和 db 里紧接着的 objects 拼接而成
+        cursor = self.get_cursor(request)
+        if paginated_list:
+            boundary = paginated_list[-1].created_at, _object_id(paginated_list[-1], self.id_field)
+        elif cursor is not None:
+            boundary = cursor
+        else:
+            boundary = None
+        # 只有紧接着 cache 尾部的 objects 才能放进 cache，否则 list 中间会缺失数据
+        is_contiguous = boundary is not None and boundary == (
+            cached_list[-1].created_at,
+            _object_id(cached_list[-1], self.id_field),
+        )
+
+        if boundary is not None:
+            created_at, object_id = boundary
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=object_id),
+            )
+        else:
+            queryset = queryset.filter(created_at__lt=request.query_params['created_at__lt'])
+
+        remaining = self.page_size - len(paginated_list)
+        limit = remaining
+        if cache_key is not None and is_contiguous:
+            # 多取一页放进 cache
+            limit += self.page_size
+        db_objects = list(queryset.order_by('-created_at', '-id')[:limit + 1])
+        page = paginated_list + db_objects[:remaining]
+        self.has_next_page = len(db_objects) > remaining
+        self.set_next_cursor(page)
+
+        if cache_key is not None and is_contiguous and db_objects:
+            RedisHelper.extend_objects(cache_key, db_objects, cached_list[-1].id)
+        return page
+
+    def paginate_by_created_at(self, load_objects, request):
+        """
+        用于没有 db queryset 的数据源，比如 HBase 里的 newsfeeds，按 (created_at, id_field) 倒序翻页
+        load_objects(created_at__lt, object_id__lt, limit) 返回排在 (created_at__lt, object_id__lt)
+        之后的前 limit 个 objects，object_id__lt=None 的时候返回 created_at < created_at__lt 的，
+        created_at__lt=None 的时候从最新的开始
+        """
+        return self.paginate_after_page([], request, load_objects)
+
+    def paginate_after_page(self, page, request, load_objects):
+        """
+        page 是一个数据源的最后一页，不足 page_size 的部分用 load_objects 从另一个数据源接着取
+        load_objects 和 paginate_by_created_at 里的相同
+        """
+        created_at__lt, object_id__lt = None, None
+        if page:
+            created_at__lt = page[-1].created_at
+            object_id__lt = _object_id(page[-1], self.id_field)
+        else:
+            cursor = self.get_cursor(request)
+            if cursor is not None:
+                created_at__lt, object_id__lt = cursor
+            elif 'created_at__lt' in request.query_params:
+                created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
+
+        remaining = self.page_size - len(page)
+        objects = load_objects(created_at__lt, object_id__lt, remaining + 1)
+        self.has_next_page = len(objects) > remaining
+        page = page + objects[:remaining]
+        self.set_next_cursor(page)
+        return page
 
     def get_paginated_response(self, data):
         return Response({
             'has_next_page': self.has_next_page,
+            'next_cursor': self.next_cursor,
             'results': data,
         })
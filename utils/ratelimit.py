@@ -1,6 +1,206 @@
+from collections import OrderedDict
+from django.conf import settings
+from functools import partial, wraps
 from rest_framework import status
+from rest_framework.exceptions import Throttled
 from rest_framework.views import exception_handler as drf_exception_handler
-from ratelimit.exceptions import Ratelimited
+from utils.redis_helper import RedisHelper
+
+import ipaddress
+import math
+import re
+import threading
+import time
+
+RATE_PATTERN = re.compile(r'^(\d+)/(\d*)([smhd])$')
+PERIODS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+}
+
+# 一次 EVALSHA 检查一个 request 的所有 rules，所有 buckets 都有 token 的时候才会各扣掉 1 个，
+# 否则一个都不扣，返回 {allowed, retry_after_ms, remaining}
+# 当前时间用 Redis 的 TIME，不受各个 app server 时钟偏差的影响，Redis >= 5 按 effects 复制 script，
+# 所以在 script 里调用 TIME 之后再写入是安全的
+# KEYS[i]: bucket i 的 key, ARGV[2i - 1], ARGV[2i]: bucket i 的容量和装满需要的时间 (ms)
+TOKEN_BUCKET_SCRIPT = """
+local redis_time = redis.call('TIME')
+local now = tonumber(redis_time[1]) * 1000 + math.floor(tonumber(redis_time[2]) / 1000)
+local tokens = {}
+local allowed = 1
+local retry_after = 0
+for i = 1, #KEYS do
+    local capacity = tonumber(ARGV[i * 2 - 1])
+    local period = tonumber(ARGV[i * 2])
+    local bucket = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local count = tonumber(bucket[1])
+    local ts = tonumber(bucket[2])
+    if count == nil or ts == nil then
+        count = capacity
+        ts = now
+    end
+    count = math.min(capacity, count + math.max(0, now - ts) * capacity / period)
+    tokens[i] = count
+    if count < 1 then
+        allowed = 0
+        retry_after = math.max(retry_after, math.ceil((1 - count) * period / capacity))
+    end
+end
+local remaining = -1
+for i = 1, #KEYS do
+    local period = tonumber(ARGV[i * 2])
+    local count = tokens[i]
+    if allowed == 1 then
+        count = count - 1
+    end
+    redis.call('HSET', KEYS[i], 'tokens', tostring(count), 'ts', tostring(now))
+    redis.call('PEXPIRE', KEYS[i], period)
+    if remaining < 0 or count < remaining then
+        remaining = count
+    end
+end
+return {allowed, retry_after, math.floor(remaining)}
+"""
+
+
+class Ratelimited(Throttled):
+    # Throttled 的 status code 是 429，wait 会被 DRF 放进 Retry-After 的 header 里
+    pass
+
+
+def parse_rate(rate):
+    # '5/m' -> (5, 60), '10/5s' -> (10, 5)
+    match = RATE_PATTERN.match(rate)
+    if match is None:
+        raise ValueError('invalid rate: {}'.format(rate))
+    count, multiplier, period = match.groups()
+    return int(count), int(multiplier or 1) * PERIODS[period]
+
+
+def get_ip(request):
+    ip = request.META['REMOTE_ADDR']
+    # 同一个 IPv6 /64 网段下的地址通常属于同一个用户
+    mask = 64 if ':' in ip else 32
+    return str(ipaddress.ip_network('{}/{}'.format(ip, mask), strict=False).network_address)
+
+
+def get_user_or_ip(request):
+    if request.user.is_authenticated:
+        return str(request.user.pk)
+    return get_ip(request)
+
+
+KEY_FUNCTIONS = {
+    'ip': get_ip,
+    'user': lambda request: str(request.user.pk),
+    'user_or_ip': get_user_or_ip,
+}
+
+
+class RateLimiter(object):
+    @classmethod
+    def consume(cls, keys, rates):
+        """
+        对每个 (key, rate) 的 token bucket 各扣 1 个 token，1 次 round-trip
+        返回 (allowed, retry_after in seconds, remaining)
+        """
+        args = []
+        for rate in rates:
+            count, period = parse_rate(rate)
+            args.extend([count, period * 1000])
+        # register_script 会用 EVALSHA 执行，script 不在 Redis 里的时候自动 fallback 到 EVAL
+        allowed, retry_after, remaining = RedisHelper.get_script(TOKEN_BUCKET_SCRIPT)(keys=keys, args=args)
+        return bool(allowed), math.ceil(retry_after / 1000), max(int(remaining), 0)
+
+
+class LocalRateLimiter(object):
+    """
+    每个进程自己在内存里维护的 token buckets，放在一个最多 RATELIMIT_LOCAL_CACHE_SIZE 个 keys 的 LRU 里
+    一个进程只能看到一部分请求，所以单个进程里的 bucket 空了，整体上一定也超过了限制，
+    这时可以不访问 Redis 直接拒绝。没有被拒绝的请求仍然需要由 RateLimiter 检查
+    """
+    buckets = OrderedDict()
+    lock = threading.Lock()
+
+    @classmethod
+    def consume(cls, keys, rates):
+        # 和 RateLimiter.consume 相同，返回 (allowed, retry_after in seconds)
+        now = time.monotonic()
+        with cls.lock:
+            counts, retry_after = [], 0
+            for key, rate in zip(keys, rates):
+                capacity, period = parse_rate(rate)
+                count, ts = cls.buckets.get(key, (capacity, now))
+                count = min(capacity, count + (now - ts) * capacity / period)
+                counts.append(count)
+                if count < 1:
+                    retry_after = max(retry_after, math.ceil((1 - count) * period / capacity))
+
+            allowed = retry_after == 0
+            for key, count in zip(keys, counts):
+                cls.buckets[key] = (count - 1 if allowed else count, now)
+                cls.buckets.move_to_end(key)
+            while len(cls.buckets) > settings.RATELIMIT_LOCAL_CACHE_SIZE:
+                cls.buckets.popitem(last=False)
+        return allowed, retry_after
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.buckets.clear()
+
+
+def ratelimit(key, rate, method=None, group=None, block=True, local=False):
+    """
+    用法和 django-ratelimit 相同：
+        @method_decorator(ratelimit(key='user', rate='10/s', method='POST', block=True))
+    rate 可以是一个 list，比如 rate=['1/s', '5/m']，所有 rules 在同一次 Redis round-trip 里检查
+    block=False 的时候不会抛出异常，而是设置 request.limited = True
+    local=True 的时候先用进程内的 LocalRateLimiter 按照相同的 rate 检查，明显超过限制的请求
+    （比如爬虫）不需要访问 Redis 就会被拒绝
+    """
+    rates = [rate] if isinstance(rate, str) else list(rate)
+    for _rate in rates:
+        parse_rate(_rate)
+    methods = None
+    if method is not None:
+        methods = [method] if isinstance(method, str) else list(method)
+        methods = [m.upper() for m in methods]
+    key_function = KEY_FUNCTIONS[key] if isinstance(key, str) else key
+
+    def decorator(view_func):
+        # method_decorator 传进来的是 bound method 的 functools.partial
+        func = view_func.func if isinstance(view_func, partial) else view_func
+        rate_group = group or '{}.{}'.format(func.__module__, func.__qualname__)
+
+        @wraps(view_func)
+        def _wrapped_view(request, *args, **kwargs):
+            request.limited = getattr(request, 'limited', False)
+            if not settings.RATELIMIT_ENABLE or (methods and request.method not in methods):
+                return view_func(request, *args, **kwargs)
+
+            value = key_function(request)
+            keys = [
+                '{}{}:{}:{}'.format(settings.RATELIMIT_KEY_PREFIX, rate_group, value, _rate)
+                for _rate in rates
+            ]
+            allowed, retry_after = True, 0
+            if local:
+                allowed, retry_after = LocalRateLimiter.consume(keys, rates)
+            if allowed:
+                allowed, retry_after, remaining = RateLimiter.consume(keys, rates)
+            if not allowed:
+                request.limited = True
+                if block:
+                    raise Ratelimited(wait=retry_after)
+            response = view_func(request, *args, **kwargs)
+            if allowed:
+                response['X-RateLimit-Remaining'] = remaining
+            return response
+        return _wrapped_view
+    return decorator
 
 
 def exception_handler(exc, context):
@@ -8,10 +208,11 @@ def exception_handler(exc, context):
     # to get the standard error response
     response = drf_exception_handler(exc, context)
 
-    # Then change the HTTP status code and message to the response
-    # if it's a `Ratelimited instance
+    # Then change the message and add the headers to the response
+    # if it's a `Ratelimited` instance
     if isinstance(exc, Ratelimited):
         response.data['detail'] = 'Too many requests, try again later.'
         response.status_code = status.HTTP_429_TOO_MANY_REQUESTS
+        response['X-RateLimit-Remaining'] = 0
 
     return response
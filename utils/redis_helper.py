@@ -1,10 +1,55 @@
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, QuerySet, Value, When
+from redis.exceptions import WatchError
 from utils.redis_client import RedisClient
 from utils.redis_serializers import DjangoModelSerializer
+from utils.time_constants import ONE_HOUR
+
+COUNT_FLUSH_BATCH_SIZE = 500
+
+# write-behind 的 +delta：HINCRBY deltas hash，count key 存在的时候同时 INCRBY，在同一个 script 里执行，
+# 和 back-fill 的 script 不会交错，同一个 delta 不会既被 back-fill 读到又被 INCRBY 一次
+# KEYS[1]: deltas hash, KEYS[2]: count key, ARGV[1]: object_id, ARGV[2]: delta
+INCR_COUNT_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return redis.call('INCRBY', KEYS[2], ARGV[2])
+end
+return false
+"""
+
+# count key 的 back-fill：db 里的值 + 还没有写回 db 的增量 (deltas 和 flushing hash)
+# flush_count_deltas 写回 db 期间 epoch 是奇数，写回之后 epoch 和 flushing hash 的删除一起 +1，
+# epoch 和读 db 之前看到的不同的时候，db 里的值不知道有没有包括 flushing 的增量，这时只返回不写入 cache
+# KEYS[1]: count key, KEYS[2]: deltas hash, KEYS[3]: flushing hash, KEYS[4]: epoch
+# ARGV[1]: object_id, ARGV[2]: count in db, ARGV[3]: epoch before reading db, ARGV[4]: expire time
+BACKFILL_COUNT_SCRIPT = """
+local count = redis.call('GET', KEYS[1])
+if count then
+    return tonumber(count)
+end
+count = tonumber(ARGV[2])
+    + tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+    + tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+local epoch = tonumber(redis.call('GET', KEYS[4]) or '0')
+if epoch == tonumber(ARGV[3]) and epoch % 2 == 0 then
+    redis.call('SET', KEYS[1], count, 'EX', ARGV[4])
+end
+return count
+"""
 
 
 # TODO: _load_objects_to_cache & push_objet, kind of duplicate?
 class RedisHelper:
+    scripts = {}
+
+    @classmethod
+    def get_script(cls, script):
+        if script not in cls.scripts:
+            cls.scripts[script] = RedisClient.get_connection().register_script(script)
+        return cls.scripts[script]
+
     @classmethod
     def _load_objects_to_cache(cls, key, objects):
         conn = RedisClient.get_connection()
@@ -22,12 +67,21 @@ class RedisHelper:
             conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
 
     @classmethod
-    def load_objects(cls, key, queryset):
+    def _using_primary(cls, queryset):
+        # cache 里的数据之后会被增量更新，refill 要从 primary 读，
+        # 否则 replica 的延迟会一直留在 cache 里，而不只是 replication lag 那么久
+        if isinstance(queryset, QuerySet):
+            return queryset.using('default')
+        return queryset
+
+    @classmethod
+    def load_objects(cls, key, queryset, limit=None):
+        # limit: 只需要最前面的 limit 个 objects 的时候（比如 preview），只 LRANGE 这一部分
         conn = RedisClient.get_connection()
 
         # if key exists in cache, get and return - cache hit
         if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
+            serialized_list = conn.lrange(key, 0, -1 if limit is None else limit - 1)
             objects = []
             for serialized_data in serialized_list:
                 deserialized_obj = DjangoModelSerializer.deserialize(serialized_data)
@@ -35,9 +89,11 @@ class RedisHelper:
             return objects
 
         # if key doesn't exist, push to cache and return list of obj from queryset - cache miss
-        cls._load_objects_to_cache(key, queryset)
+        # 只取 cache 的上限个 objects 并且只查询一次 db，超出的部分由 paginator 去 db 翻页
         # 转换为 list 的原因是保持返回类型的统一，因为存在 Redis 里的数据是 list 形式
-        return list(queryset)
+        objects = list(cls._using_primary(queryset)[:settings.REDIS_LIST_LENGTH_LIMIT])
+        cls._load_objects_to_cache(key, objects)
+        return objects if limit is None else objects[:limit]
 
     @classmethod
     def push_object(cls, key, obj, queryset):
@@ -49,17 +105,54 @@ class RedisHelper:
             # 某用户的发帖 (key = user_tweets:{user_id}) 如果不在 Redis 里面
             # 可能是没存过，也可能是到期了，那就需要把这些帖子从数据库取出来(queryset)
             # 然后存入Redis
-            cls._load_objects_to_cache(key, queryset)
+            cls._load_objects_to_cache(key, cls._using_primary(queryset))
             return
         # 如果 key 存在，那就把这次新发的帖子存入 key 对应的 list 的最左边
         serialized_data = DjangoModelSerializer.serialize(obj)
         conn.lpush(key, serialized_data)
         conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
 
+    @classmethod
+    def extend_objects(cls, key, objects, last_object_id):
+        """
+        翻页翻过了 cache 的时候，把 db 里紧接着 list 尾部的 objects append 到 list 里，
+        list 最长可以到 REDIS_EXTENDED_LIST_LENGTH_LIMIT。新的 object push 进来的时候会被 trim
+        回 REDIS_LIST_LENGTH_LIMIT，所以只有 list 的尾部还是 last_object_id 的时候才 append，
+        否则 list 中间会缺失数据。返回 append 了多少个 objects
+        """
+        conn = RedisClient.get_connection()
+        with conn.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                tail = pipe.lindex(key, -1)
+                if tail is None or DjangoModelSerializer.deserialize(tail).id != last_object_id:
+                    return 0
+                objects = objects[:settings.REDIS_EXTENDED_LIST_LENGTH_LIMIT - pipe.llen(key)]
+                if not objects:
+                    return 0
+                pipe.multi()
+                pipe.rpush(key, *[DjangoModelSerializer.serialize(obj) for obj in objects])
+                pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+                pipe.execute()
+            except WatchError:
+                # list 在这期间被修改了，这次不 append，下次翻页的时候再试
+                return 0
+        return len(objects)
+
     @classmethod
     def get_count_key(cls, obj, attr):
         # attr -> an attr name of a model, e.g. Tweet model's 'likes_count'
-        return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
+        return cls.get_count_key_by_id(obj.__class__, obj.id, attr)
+
+    @classmethod
+    def get_count_key_by_id(cls, model_class, object_id, attr):
+        return '{}.{}:{}'.format(model_class.__name__, attr, object_id)
+
+    @classmethod
+    def get_count_deltas_key(cls, model_class, attr):
+        # write-behind 模式下还没有写回 MySQL 的增量, hash: object_id -> delta
+        # 正在写回的增量在 <key>:flushing 里，<key>:epoch 在写回期间是奇数
+        return 'count_deltas:{}.{}'.format(model_class.__name__, attr)
 
     @classmethod
     def incr_count(cls, obj, attr):
@@ -68,7 +161,7 @@ class RedisHelper:
         # cache miss - back-fill cache from db
         # 这里不执行 +1 操作，因为在调用 incr_count() 之前已经完成了 +1
         if not conn.exists(key):
-            obj.refresh_from_db()
+            obj.refresh_from_db(using='default')
             conn.set(key, getattr(obj, attr))
             conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
             return getattr(obj, attr)
@@ -81,7 +174,7 @@ class RedisHelper:
         key = cls.get_count_key(obj, attr)
         # cache miss
         if not conn.exists(key):
-            obj.refresh_from_db()
+            obj.refresh_from_db(using='default')
             conn.set(key, getattr(obj, attr))
             conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
             return getattr(obj, attr)
@@ -90,14 +183,158 @@ class RedisHelper:
 
     @classmethod
     def get_count(cls, obj, attr):
+        return cls.get_counts([obj], [attr])[obj.id][attr]
+
+    @classmethod
+    def get_counts(cls, objects, attrs):
+        """
+        get_count 的批量版本，objects 必须是同一个 model 的 instances
+        返回 {object_id: {attr: count}}
+        """
+        objects = [obj for obj in objects if obj is not None]
+        if not objects:
+            return {}
+        return cls.get_counts_by_ids(
+            objects[0].__class__,
+            [obj.id for obj in objects],
+            attrs,
+        )
+
+    @classmethod
+    def get_counts_by_ids(cls, model_class, object_ids, attrs):
+        """
+        - 所有的 count keys 只用 1 次 MGET
+        - cache miss 的 objects 只用 1 次 values_list 查询，只取需要的 count 字段
+        - back-fill 用 1 次 pipeline 的 SET EX，避免 count keys 永远不过期
+        """
+        counts = {object_id: {} for object_id in object_ids}
+        if not counts:
+            return counts
+
         conn = RedisClient.get_connection()
-        key = cls.get_count_key(obj, attr)
-        count = conn.get(key)
+        pairs = [(object_id, attr) for object_id in counts for attr in attrs]
+        keys = [
+            cls.get_count_key_by_id(model_class, object_id, attr)
+            for object_id, attr in pairs
+        ]
+        missed_ids = set()
+        for (object_id, attr), count in zip(pairs, conn.mget(keys)):
+            # cache hit
+            if count is not None:
+                counts[object_id][attr] = int(count)
+            else:
+                missed_ids.add(object_id)
+        if not missed_ids:
+            return counts
+
+        # cache miss - back-fill cache from db
+        # write-behind 模式下 db 里的值可能落后，back-fill 的 script 会加上还没有写回 db 的增量，
+        # 读 db 之前先记下 epoch，读 db 期间有 flush 写回过的话不写入 cache
+        missed_ids = sorted(missed_ids)
+        deltas_keys = {attr: cls.get_count_deltas_key(model_class, attr) for attr in attrs}
+        epochs = dict(zip(attrs, conn.mget([deltas_keys[attr] + ':epoch' for attr in attrs])))
+        # 之后的 INCR 都以这个值为基础，从 primary 读
+        rows = model_class.objects.using('default').filter(id__in=missed_ids).values_list('id', *attrs)
+        script = cls.get_script(BACKFILL_COUNT_SCRIPT)
+        pipe = conn.pipeline()
+        backfilled = []
+        for object_id, *values in rows:
+            for attr, count in zip(attrs, values):
+                if attr in counts[object_id]:
+                    continue
+                script(
+                    keys=[
+                        cls.get_count_key_by_id(model_class, object_id, attr),
+                        deltas_keys[attr],
+                        deltas_keys[attr] + ':flushing',
+                        deltas_keys[attr] + ':epoch',
+                    ],
+                    args=[object_id, count or 0, int(epochs[attr] or 0), settings.REDIS_KEY_EXPIRE_TIME],
+                    client=pipe,
+                )
+                backfilled.append((object_id, attr))
+        for (object_id, attr), count in zip(backfilled, pipe.execute()):
+            counts[object_id][attr] = int(count)
+
+        # object has been deleted from db, don't cache it
+        for object_id in missed_ids:
+            for attr in attrs:
+                counts[object_id].setdefault(attr, 0)
+        return counts
+
+    @classmethod
+    def incr_count_write_behind(cls, model_class, object_id, attr, delta=1):
+        """
+        write-behind 模式：不去 UPDATE MySQL 里的热点行（避免大量的行锁竞争），
+        只在 Redis 里累加 count，同时把增量记录在 deltas hash 里，
+        由 flush_count_deltas 定期批量写回 MySQL。Redis 里的 count 是读的 source of truth
+        """
+        count = cls.get_script(INCR_COUNT_SCRIPT)(
+            keys=[
+                cls.get_count_deltas_key(model_class, attr),
+                cls.get_count_key_by_id(model_class, object_id, attr),
+            ],
+            args=[object_id, delta],
+        )
         # cache hit
         if count is not None:
-            return int(count)  # TODO: why int?
-        # cache miss
-        obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
-        return count
+            return count
+        # cache miss - back-fill 的时候会加上 deltas, 已经包括了这一次的 delta
+        return cls.get_counts_by_ids(model_class, [object_id], [attr])[object_id][attr]
+
+    @classmethod
+    def flush_count_deltas(cls, model_class, attr):
+        """
+        把 deltas hash 里累积的增量用 bulk CASE UPDATE 写回 MySQL
+        UPDATE table SET attr = attr + CASE id WHEN 1 THEN 5 WHEN 2 THEN -1 ... END
+        WHERE id IN (1, 2, ...)
+        返回写回了多少个 objects
+        """
+        conn = RedisClient.get_connection()
+        deltas_key = cls.get_count_deltas_key(model_class, attr)
+        flushing_key = deltas_key + ':flushing'
+        epoch_key = deltas_key + ':epoch'
+        lock_key = deltas_key + ':lock'
+        # 同一时间只能有一个 flush 在执行，否则同一批增量会被写回两次
+        if not conn.set(lock_key, 1, nx=True, ex=ONE_HOUR):
+            return 0
+
+        try:
+            # 上一次 flush 中途失败留下的 flushing key 需要先写回，否则会丢数据，
+            # 那一次的 epoch 可能停在了奇数，同样当作没有写回
+            if int(conn.get(epoch_key) or 0) % 2 == 1:
+                conn.incr(epoch_key)
+            # renamenx 之后新的增量会累加在新的 deltas key 里，不会影响这一次 flush
+            if not conn.exists(flushing_key) and conn.exists(deltas_key):
+                conn.renamenx(deltas_key, flushing_key)
+            deltas = {}
+            for object_id, delta in conn.hgetall(flushing_key).items():
+                if int(delta) != 0:
+                    deltas[int(object_id)] = int(delta)
+
+            object_ids = sorted(deltas)
+            # epoch 是奇数的时候 back-fill 不会写入 cache，因为不知道读到的 db 里的值有没有包括 flushing 的增量
+            conn.incr(epoch_key)
+            try:
+                with transaction.atomic():
+                    for index in range(0, len(object_ids), COUNT_FLUSH_BATCH_SIZE):
+                        batch_ids = object_ids[index: index + COUNT_FLUSH_BATCH_SIZE]
+                        model_class.objects.filter(id__in=batch_ids).update(**{
+                            attr: F(attr) + Case(
+                                *[When(id=object_id, then=Value(deltas[object_id])) for object_id in batch_ids],
+                                default=Value(0),
+                                output_field=IntegerField(),
+                            ),
+                        })
+            except Exception:
+                # rollback 了，flushing 的增量还没有写回
+                conn.incr(epoch_key)
+                raise
+            # commit 之后 flushing hash 的删除和 epoch +1 在同一个 MULTI 里
+            pipe = conn.pipeline()
+            pipe.delete(flushing_key)
+            pipe.incr(epoch_key)
+            pipe.execute()
+        finally:
+            conn.delete(lock_key)
+        return len(object_ids)
@@ -1,5 +1,28 @@
+from comments.tasks import flush_comments_count_task
+from django.contrib.contenttypes.models import ContentType
+from django.db import DatabaseError, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from friendships.services import FriendshipService
+from inbox.services import NotificationService
+from likes.models import Like
+from likes.services import LikeService
+from likes.tasks import flush_likes_count_task
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
 from testing.testcases import TestCase
+from tweets.models import Tweet
+from tweets.serivces import TweetService
+from utils.db_routers import ReplicaRouter, replica_reads_enabled
+from utils.decorators import read_from_replica
+from utils.middlewares import ReplicaStickinessMiddleware
+from utils.paginations import EndlessPagination
+from unittest import mock
+from utils.ratelimit import LocalRateLimiter, RateLimiter, parse_rate
 from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.time_helpers import utc_now
 
 
 class UtilsTests(TestCase):
@@ -16,3 +39,290 @@ class UtilsTests(TestCase):
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
         self.assertEqual(cached_list, [])
+
+    def test_get_counts(self):
+        ann = self.create_user('ann')
+        tweets = [self.create_tweet(ann) for _ in range(3)]
+        self.create_like(ann, tweets[0])
+        self.create_comment(ann, tweets[1])
+        self.create_comment(ann, tweets[1])
+        RedisClient.clear()
+
+        # cache miss, back-fill from db
+        counts = RedisHelper.get_counts(tweets, ['likes_count', 'comments_count'])
+        self.assertEqual(counts[tweets[0].id], {'likes_count': 1, 'comments_count': 0})
+        self.assertEqual(counts[tweets[1].id], {'likes_count': 0, 'comments_count': 2})
+        self.assertEqual(counts[tweets[2].id], {'likes_count': 0, 'comments_count': 0})
+
+        # back-filled keys have expire time
+        conn = RedisClient.get_connection()
+        key = RedisHelper.get_count_key(tweets[1], 'comments_count')
+        self.assertEqual(conn.get(key), b'2')
+        self.assertEqual(conn.ttl(key) > 0, True)
+
+        # cache hit
+        conn.set(key, 10)
+        counts = RedisHelper.get_counts(tweets, ['comments_count'])
+        self.assertEqual(counts[tweets[1].id], {'comments_count': 10})
+        self.assertEqual(RedisHelper.get_count(tweets[1], 'comments_count'), 10)
+
+        self.assertEqual(RedisHelper.get_counts([], ['likes_count']), {})
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_write_behind_counts(self):
+        ann = self.create_user('ann')
+        bob = self.create_user('bob')
+        tweet = self.create_tweet(ann)
+        comment = self.create_comment(ann, tweet)
+        self.create_like(ann, tweet)
+        self.create_like(bob, tweet)
+        self.create_like(bob, comment)
+
+        # only redis has been updated
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
+        self.assertEqual(RedisHelper.get_count(tweet, 'comments_count'), 1)
+        self.assertEqual(RedisHelper.get_count(comment, 'likes_count'), 1)
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.likes_count, 0)
+        self.assertEqual(tweet.comments_count, 0)
+
+        # pending deltas are included when the count key is back-filled
+        RedisClient.get_connection().delete(RedisHelper.get_count_key(tweet, 'likes_count'))
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 2)
+
+        Like.objects.filter(user=bob, content_type__model='tweet', object_id=tweet.id).delete()
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 1)
+
+        # flush deltas to db
+        self.assertEqual(flush_likes_count_task(), '2 likes_count flushed.')
+        self.assertEqual(flush_comments_count_task(), '1 comments_count flushed.')
+        tweet.refresh_from_db()
+        comment.refresh_from_db()
+        self.assertEqual(tweet.likes_count, 1)
+        self.assertEqual(tweet.comments_count, 1)
+        self.assertEqual(comment.likes_count, 1)
+        self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 1)
+
+        # nothing left to flush
+        self.assertEqual(flush_likes_count_task(), '0 likes_count flushed.')
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.likes_count, 1)
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    def test_write_behind_counts_during_flush(self):
+        ann = self.create_user('ann')
+        tweet = self.create_tweet(ann)
+        self.create_comment(ann, tweet)
+        conn = RedisClient.get_connection()
+        count_key = RedisHelper.get_count_key(tweet, 'comments_count')
+        deltas_key = RedisHelper.get_count_deltas_key(Tweet, 'comments_count')
+
+        # the UPDATE is rolled back, the deltas are kept and the epoch is even again
+        with mock.patch.object(transaction, 'atomic', side_effect=DatabaseError('deadlock')):
+            with self.assertRaises(DatabaseError):
+                RedisHelper.flush_count_deltas(Tweet, 'comments_count')
+        self.assertEqual(conn.hgetall(deltas_key + ':flushing'), {b'%d' % tweet.id: b'1'})
+        self.assertEqual(conn.get(deltas_key + ':epoch'), b'2')
+
+        # while the deltas are being written back, the back-filled value is not cached
+        conn.delete(count_key)
+        conn.incr(deltas_key + ':epoch')
+        self.assertEqual(RedisHelper.get_count(tweet, 'comments_count'), 1)
+        self.assertEqual(conn.exists(count_key), 0)
+        # the increment and the back-fill don't count the same delta twice
+        self.create_comment(ann, tweet)
+        self.assertEqual(RedisHelper.get_count(tweet, 'comments_count'), 2)
+        self.assertEqual(conn.exists(count_key), 0)
+
+        # the next flush writes back the deltas left by the failed one
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, 'comments_count'), 1)
+        self.assertEqual(RedisHelper.flush_count_deltas(Tweet, 'comments_count'), 1)
+        tweet.refresh_from_db()
+        self.assertEqual(tweet.comments_count, 2)
+        self.assertEqual(conn.get(deltas_key + ':epoch'), b'8')
+        self.assertEqual(RedisHelper.get_count(tweet, 'comments_count'), 2)
+        self.assertEqual(conn.get(count_key), b'2')
+
+    def test_endless_pagination_cursor(self):
+        ann = self.create_user('ann')
+        tweets = [self.create_tweet(ann) for _ in range(25)]
+        # tweets created at the same time are ordered by id
+        Tweet.objects.filter(id__in=[t.id for t in tweets[5:15]]).update(created_at=utc_now())
+        ordered = list(Tweet.objects.order_by('-created_at', '-id'))
+        factory = APIRequestFactory()
+
+        def paginate(paginate_method, source, page_size, **params):
+            paginator = EndlessPagination()
+            paginator.page_size = page_size
+            request = Request(factory.get('/', params))
+            return paginator, paginate_method(paginator, source, request)
+
+        for method, source in [
+            (EndlessPagination.paginate_ordered_list, ordered),
+            (EndlessPagination.paginate_queryset, Tweet.objects.all()),
+        ]:
+            ids, params = [], {}
+            while True:
+                paginator, page = paginate(method, source, 4, **params)
+                ids.extend(tweet.id for tweet in page)
+                if not paginator.has_next_page:
+                    break
+                params = {'cursor': paginator.next_cursor}
+            # no duplicated or skipped tweets
+            self.assertEqual(ids, [tweet.id for tweet in ordered])
+
+        # created_at__lt and created_at__gt still work on cached lists
+        _, page = paginate(
+            EndlessPagination.paginate_ordered_list,
+            ordered,
+            20,
+            created_at__lt=ordered[12].created_at,
+        )
+        self.assertEqual(page[0].id, ordered[13].id)
+        _, page = paginate(
+            EndlessPagination.paginate_ordered_list,
+            ordered,
+            20,
+            created_at__gt=ordered[13].created_at,
+        )
+        self.assertEqual([tweet.id for tweet in page], [tweet.id for tweet in ordered[:13]])
+        # the 10 tweets with the same created_at are skipped together
+        _, page = paginate(
+            EndlessPagination.paginate_ordered_list,
+            ordered,
+            20,
+            created_at__lt=ordered[0].created_at,
+        )
+        self.assertEqual(page[0].id, ordered[10].id)
+
+        # invalid cursor
+        with self.assertRaises(NotFound):
+            paginate(EndlessPagination.paginate_ordered_list, ordered, 4, cursor='invalid')
+
+    def test_rate_limiter(self):
+        self.assertEqual(parse_rate('5/m'), (5, 60))
+        self.assertEqual(parse_rate('10/5s'), (10, 5))
+        with self.assertRaises(ValueError):
+            parse_rate('5/x')
+
+        keys, rates = ['rl:test:1/s', 'rl:test:3/m'], ['1/s', '3/m']
+        self.assertEqual(RateLimiter.consume(keys, rates), (True, 0, 0))
+        # the 1/s bucket is empty, no token is taken from the 3/m bucket
+        allowed, retry_after, _ = RateLimiter.consume(keys, rates)
+        self.assertEqual((allowed, retry_after), (False, 1))
+        self.assertEqual(RateLimiter.consume(keys[1:], rates[1:]), (True, 0, 1))
+
+    @override_settings(RATELIMIT_LOCAL_CACHE_SIZE=2)
+    def test_local_rate_limiter(self):
+        keys, rates = ['rl:local:1/s', 'rl:local:3/m'], ['1/s', '3/m']
+        with mock.patch('utils.ratelimit.time.monotonic', return_value=1000.0) as monotonic:
+            self.assertEqual(LocalRateLimiter.consume(keys, rates), (True, 0))
+            self.assertEqual(LocalRateLimiter.consume(keys, rates), (False, 1))
+            self.assertEqual(LocalRateLimiter.consume(keys[1:], rates[1:]), (True, 0))
+
+            # least recently used buckets are evicted
+            LocalRateLimiter.consume(['rl:local:other'], ['1/s'])
+            self.assertEqual(list(LocalRateLimiter.buckets), ['rl:local:3/m', 'rl:local:other'])
+            self.assertEqual(LocalRateLimiter.consume(keys[:1], rates[:1]), (True, 0))
+
+            # buckets are refilled by the monotonic clock
+            self.assertEqual(LocalRateLimiter.consume(keys[:1], rates[:1]), (False, 1))
+            monotonic.return_value = 1001.0
+            self.assertEqual(LocalRateLimiter.consume(keys[:1], rates[:1]), (True, 0))
+
+    @override_settings(RATELIMIT_ENABLE=True)
+    def test_ratelimit_local_precheck(self):
+        ann = self.create_user('ann')
+        client = APIClient()
+        # the local clock stands still, the local bucket is not refilled however slow the requests are
+        with mock.patch('utils.ratelimit.time.monotonic', return_value=1000.0) as monotonic, \
+                mock.patch.object(RateLimiter, 'consume', wraps=RateLimiter.consume) as consume:
+            for _ in range(3):
+                response = client.get('/api/friendships/{}/followers/'.format(ann.id))
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(consume.call_count, 3)
+
+            # the local bucket is empty, the shared limiter is not called
+            response = client.get('/api/friendships/{}/followers/'.format(ann.id))
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], '1')
+            self.assertEqual(consume.call_count, 3)
+
+            # 1 second later the local bucket is refilled, the shared limiter decides again
+            monotonic.return_value = 1001.0
+            client.get('/api/friendships/{}/followers/'.format(ann.id))
+            self.assertEqual(consume.call_count, 4)
+
+    @override_settings(RATELIMIT_ENABLE=True)
+    def test_ratelimit_decorator(self):
+        ann = self.create_user('ann')
+        client = APIClient()
+        client.force_authenticate(ann)
+
+        response = client.post('/api/tweets/', {'content': 'the first tweet'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response['X-RateLimit-Remaining'], '0')
+
+        # 1/s and 5/m are checked together
+        response = client.post('/api/tweets/', {'content': 'the second tweet'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(response['X-RateLimit-Remaining'], '0')
+        self.assertEqual(response.data['detail'], 'Too many requests, try again later.')
+        self.assertEqual(Tweet.objects.count(), 1)
+
+        # other methods are not limited by the rule
+        response = client.get('/api/tweets/', {'user_id': ann.id})
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(DATABASE_REPLICAS=['replica_0'])
+    def test_replica_router(self):
+        router = ReplicaRouter()
+
+        class View:
+            @read_from_replica
+            def list(self, request):
+                return router.db_for_read(Tweet)
+
+        def get_response(request):
+            if request.method == 'POST':
+                return HttpResponse(status=201)
+            return HttpResponse(View().list(request))
+
+        middleware = ReplicaStickinessMiddleware(get_response)
+        factory = RequestFactory()
+        # reads go to replicas only inside read_from_replica, writes always go to default
+        self.assertEqual(middleware(factory.get('/')).content, b'replica_0')
+        self.assertEqual(router.db_for_read(Tweet), 'default')
+        self.assertEqual(router.db_for_write(Tweet), 'default')
+
+        # reads stick to default for a while after a write
+        response = middleware(factory.post('/'))
+        request = factory.get('/')
+        request.COOKIES.update({key: morsel.value for key, morsel in response.cookies.items()})
+        self.assertEqual(middleware(request).content, b'default')
+        request = factory.get('/')
+        request.COOKIES['replica_sticky_until'] = str(utc_now().timestamp() - 1)
+        self.assertEqual(middleware(request).content, b'replica_0')
+
+    @override_settings(DATABASE_REPLICAS=['replica_0'])
+    def test_cache_refills_read_from_primary(self):
+        ann = self.create_user('ann')
+        bob = self.create_user('bob')
+        tweet = self.create_tweet(ann)
+        self.create_like(bob, tweet)
+        self.create_friendship(bob, ann)
+        self.clear_cache()
+        content_type = ContentType.objects.get_for_model(Tweet)
+
+        # replica_0 doesn't exist in DATABASES, any query routed to it would fail
+        token = replica_reads_enabled.set(True)
+        try:
+            self.assertEqual(RedisHelper.get_count(tweet, 'likes_count'), 1)
+            self.assertEqual(FriendshipService.get_follower_count(ann.id), 1)
+            self.assertEqual(FriendshipService.has_followed(bob, ann), True)
+            self.assertEqual(LikeService._load_user_liked_set(bob.id, content_type.id), False)
+            self.assertEqual(NotificationService.get_unread_count(ann.id), 0)
+            self.assertEqual(len(TweetService.get_cached_tweets(ann.id)), 1)
+        finally:
+            replica_reads_enabled.reset(token)
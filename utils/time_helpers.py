@@ -1,6 +1,20 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+# 比任何一个微秒级的 timestamp 都大，用于在 HBase 里从最新的数据开始倒序 scan
+MAX_TIMESTAMP = 10 ** 16 - 1
+
 
 def utc_now():
     return datetime.now().replace(tzinfo=pytz.utc)
+
+
+def datetime_to_timestamp(dt):
+    # HBase 里的 TimestampField 存的是微秒级的 timestamp
+    # 用整数运算，避免 dt.timestamp() 的浮点数精度问题
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def timestamp_to_datetime(ts):
+    return EPOCH + timedelta(microseconds=ts)